@@ -0,0 +1,426 @@
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    # python-multipart before 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+import waste_classification_api as api
+from metrics import StageTimer
+from upload_stream import SniffingUpload, UploadRejected
+from image_pipeline import ImageTooLarge
+import fast_json
+
+# Asyncio serving variant of waste_classification_api:
+#
+#   uvicorn asgi_app:app --host 0.0.0.0 --port 10000
+#
+# Uploads are received and responses written on the event loop, so slow
+# mobile connections only cost a socket. Hashing, decoding and outbox writes
+# run in a small thread pool, and inference goes through the same
+# micro-batcher as the Flask app. The model, caches and backend delivery are
+# the ones set up by waste_classification_api.
+
+logger = logging.getLogger("waste_classifier_asgi")
+
+# Threads for CPU work that must not block the event loop (cache lookup, decode, outbox writes)
+ASGI_CPU_WORKERS = int(os.environ.get("ASGI_CPU_WORKERS", 4))
+# Uploads being decoded or classified at once; more than this answers 429
+ASGI_MAX_PENDING = int(os.environ.get("ASGI_MAX_PENDING", 64))
+ASGI_RETRY_AFTER = os.environ.get("ASGI_RETRY_AFTER", "1")
+
+executor = ThreadPoolExecutor(max_workers=ASGI_CPU_WORKERS, thread_name_prefix="asgi-cpu")
+# Only touched from the event loop, so no lock is needed
+inference_state = {"pending": 0, "rejected": 0}
+
+api.serving_state["mode"] = "asgi"
+
+CORS_HEADERS = [
+    (b"access-control-allow-headers", b"Content-Type,Authorization"),
+    (b"access-control-allow-methods", b"GET,PUT,POST,DELETE,OPTIONS"),
+]
+
+
+def cors_headers(scope):
+    """CORS headers for a request, with the origin allowed by CORS_ALLOWED_ORIGINS"""
+    request_origin = None
+    for name, value in scope.get("headers", []):
+        if name == b"origin":
+            request_origin = value.decode("latin-1")
+            break
+    origin = api.cors_origin(request_origin)
+    headers = list(CORS_HEADERS)
+    if origin is not None:
+        headers.append((b"access-control-allow-origin", origin.encode("latin-1")))
+    if origin != "*":
+        headers.append((b"vary", b"Origin"))
+    return headers
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded through fast_json, like the Flask app's jsonify"""
+
+    def render(self, content):
+        return fast_json.dumps(content)
+
+
+class CORSMiddleware:
+    """Same CORS headers as the Flask app's after_request hook, and answers to preflight requests"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = cors_headers(scope)
+        if scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+def error_response(message, status, error_type, headers=None):
+    api.ERRORS.inc(error_type)
+    return FastJSONResponse({"error": message, "success": False}, status_code=status, headers=headers)
+
+
+def instrumented(route):
+    """Record request count, latency and stage timings like the Flask hooks do"""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request):
+            timer = StageTimer(api.STAGE_SECONDS)
+            response = await handler(request, timer)
+            seconds = timer.elapsed()
+            api.REQUESTS.inc(route, str(response.status_code))
+            api.REQUEST_SECONDS.observe(seconds, route)
+            if route.startswith("/predict"):
+                logger.info(
+                    "%s %s status=%d total_ms=%.1f stages=%s",
+                    request.method, route, response.status_code, seconds * 1000.0, timer.as_ms()
+                )
+            return response
+        return wrapper
+    return decorator
+
+
+class ImagePartParser:
+    """Multipart parser that streams the first 'image' file part into a SniffingUpload.
+
+    Other parts are skipped as they arrive, so nothing but the image is
+    buffered, and a refused image stops being buffered too.
+    """
+
+    def __init__(self, boundary, upload):
+        self.upload = upload
+        self.filename = None
+        self.found = False
+        self._in_image = False
+        self._headers = {}
+        self._field = self._value = b""
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._part_begin,
+            "on_header_field": self._header_field,
+            "on_header_value": self._header_value,
+            "on_header_end": self._header_end,
+            "on_headers_finished": self._headers_finished,
+            "on_part_data": self._part_data,
+            "on_part_end": self._part_end,
+        })
+
+    def _part_begin(self):
+        self._headers = {}
+
+    def _header_field(self, data, start, end):
+        self._field += data[start:end]
+
+    def _header_value(self, data, start, end):
+        self._value += data[start:end]
+
+    def _header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b""
+
+    def _headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if not self.found and options.get(b"name") == b"image" and b"filename" in options:
+            self.found = self._in_image = True
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+
+    def _part_data(self, data, start, end):
+        if self._in_image and self.upload.rejected is None:
+            self.upload.write(data[start:end])
+
+    def _part_end(self):
+        self._in_image = False
+
+    def write(self, chunk):
+        self._parser.write(chunk)
+
+    def finalize(self):
+        self._parser.finalize()
+
+
+async def read_image(request, timer):
+    """Stream the 'image' form field into a SniffingUpload; returns (filename, upload) or (None, None).
+
+    Body bytes are counted as they arrive, so a request without (or with a
+    false) Content-Length is still refused with UploadRejected (413) once
+    it passes MAX_UPLOAD_MB.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        return None, None
+    upload = SniffingUpload(
+        api.APIRequest.upload_max_bytes, api.APIRequest.upload_max_pixels, api.APIRequest.upload_formats
+    )
+    parser = ImagePartParser(boundary, upload)
+    limit = int(api.MAX_UPLOAD_MB * 1024 * 1024) if api.MAX_UPLOAD_MB > 0 else None
+    received = 0
+    with timer.stage("upload"):
+        try:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if limit and received > limit:
+                    raise UploadRejected(f"Upload too large (maximum {api.MAX_UPLOAD_MB:g} MB)", 413, "upload_too_large")
+                parser.write(chunk)
+            parser.finalize()
+        except UploadRejected:
+            raise
+        except ValueError as e:
+            # python-multipart's parse errors are ValueErrors
+            raise UploadRejected(f"Malformed multipart body: {e}", 400, "malformed_upload")
+    if not parser.found:
+        return None, None
+    return parser.filename, upload
+
+
+def finish_prediction(version, cache_key, image, prediction, cached, filename, submission_id, auth_header, timer):
+    """Cache, count and queue a finished prediction; runs in the CPU pool"""
+    if image is not None:
+        api.remember_prediction(cache_key, prediction, version)
+    result, confidence, _, near_duplicate = prediction
+    api.record_prediction(result, confidence, "cache" if cached is not None else "model", version)
+    if not auth_header:
+        return None
+    classification_data = api.build_classification_data(
+        result, confidence, filename, version, submission_id=submission_id, near_duplicate=near_duplicate
+    )
+    with timer.stage("backend_enqueue"):
+        return api.queue_for_backend([classification_data], auth_header)
+
+
+# ROOT ROUTE - Test if server is working
+@instrumented("/")
+async def home(request, timer):
+    return FastJSONResponse({
+        "message": "Waste Classification API is running successfully!",
+        "server_info": {
+            "device": str(api.device),
+            "model_loaded": api.startup.ready,
+            "backend_url": api.BACKEND_URL,
+            "routes_available": [
+                "GET  / - This route (server status)",
+                "GET  /health - Health check",
+                "GET  /metrics - Prometheus metrics",
+                "POST /predict - Image classification and send to backend"
+            ]
+        }
+    })
+
+
+# HEALTH CHECK ROUTE
+@instrumented("/health")
+async def health_check(request, timer):
+    report, status_code = await asyncio.get_running_loop().run_in_executor(executor, api.health_report)
+    report["asgi"] = {
+        "cpu_workers": ASGI_CPU_WORKERS,
+        "max_pending": ASGI_MAX_PENDING,
+        **inference_state
+    }
+    return FastJSONResponse(report, status_code=status_code)
+
+
+# METRICS ROUTE - Prometheus text format
+async def metrics_endpoint(request):
+    body = await asyncio.get_running_loop().run_in_executor(executor, api.metrics.render)
+    return Response(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# PREDICTION ROUTE - Classify image and send to backend
+@instrumented("/predict")
+async def predict_image(request, timer):
+    if not api.startup.ready:
+        api.ERRORS.inc("model_not_ready")
+        return FastJSONResponse(
+            {"error": f"Model is not ready yet (status: {api.startup.status})", "success": False},
+            status_code=503,
+            headers={"Retry-After": "5"}
+        )
+
+    try:
+        content_length = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        return error_response("Invalid Content-Length header", 400, "invalid_content_length")
+    if api.MAX_UPLOAD_MB > 0 and content_length > api.MAX_UPLOAD_MB * 1024 * 1024:
+        return error_response(f"Upload too large (maximum {api.MAX_UPLOAD_MB:g} MB)", 413, "upload_too_large")
+
+    # Refused before the upload is read
+    retry_after = api.check_rate_limit(
+        request.client.host if request.client else None,
+        request.headers.get("X-Forwarded-For")
+    )
+    if retry_after is not None:
+        return error_response("Rate limit exceeded, retry later", 429, "rate_limited", headers={"Retry-After": retry_after})
+
+    try:
+        options = api.response_options(request.query_params)
+    except ValueError as e:
+        return error_response(str(e), 400, "invalid_option")
+
+    # Backpressure: refuse new work before its body is read, instead of queueing it without bound
+    if inference_state["pending"] >= ASGI_MAX_PENDING:
+        inference_state["rejected"] += 1
+        return error_response(
+            "Server is busy, retry shortly", 429, "overloaded", headers={"Retry-After": ASGI_RETRY_AFTER}
+        )
+
+    if not api.acquire_inference():
+        return error_response(
+            "Server is busy, retry shortly", 503, "overloaded", headers={"Retry-After": api.OVERLOAD_RETRY_AFTER}
+        )
+
+    inference_state["pending"] += 1
+    loop = asyncio.get_running_loop()
+    auth_header = request.headers.get("Authorization")
+    upload = None
+    try:
+        filename, upload = await read_image(request, timer)
+        if upload is None:
+            logger.info("No image in request")
+            return error_response("No image uploaded", 400, "no_image")
+
+        version, shadow = api.registry.route(auth_header)
+        cached, cache_key, image = await loop.run_in_executor(
+            executor, api.lookup_prediction, upload.value(), timer, version
+        )
+        if cached is not None:
+            prediction = cached
+        else:
+            with timer.stage("inference"):
+                prediction = await asyncio.wrap_future(api.batcher.submit((version, image)))
+            if shadow is not None:
+                api.run_shadow(shadow, image, prediction[0])
+
+        backend_result = await loop.run_in_executor(
+            executor, finish_prediction, version, cache_key, image, prediction, cached,
+            filename, request.headers.get("X-Submission-Id"), auth_header, timer
+        )
+        if not auth_header:
+            return error_response("Missing Authorization header", 401, "unauthorized")
+
+        return FastJSONResponse(api.prediction_body(prediction, cached is not None, version, backend_result, options))
+
+    except UploadRejected as e:
+        return error_response(str(e), e.status, e.reason)
+
+    except ImageTooLarge as e:
+        return error_response(str(e), 413, "image_too_large")
+
+    except Exception as e:
+        logger.exception("Error in prediction: %s", e)
+        return error_response(f"Classification failed: {str(e)}", 500, type(e).__name__)
+
+    finally:
+        inference_state["pending"] -= 1
+        api.inference_limiter.release()
+        # Deletes the temporary file of a spilled upload
+        if upload is not None:
+            upload.close()
+
+
+# ADMIN ROUTES - Model registry, guarded by ADMIN_TOKEN (X-Admin-Token header)
+async def admin_models(request):
+    if not api.ADMIN_TOKEN:
+        return error_response("Admin API is disabled (set ADMIN_TOKEN)", 404, "admin_disabled")
+    if not api.admin_authorized(request.headers.get("X-Admin-Token")):
+        return error_response("Invalid admin token", 403, "admin_forbidden")
+    action = request.path_params.get("action", "list")
+    try:
+        payload = await request.json() if request.method == "POST" else {}
+    except ValueError:
+        payload = {}
+    body, status_code = await asyncio.get_running_loop().run_in_executor(
+        executor, api.admin_action, action, payload if isinstance(payload, dict) else {}
+    )
+    return FastJSONResponse(body, status_code=status_code)
+
+
+async def not_found(request, exc):
+    return FastJSONResponse({
+        "error": "Route not found",
+        "available_routes": [
+            "GET  /",
+            "GET  /health",
+            "GET  /metrics",
+            "POST /predict"
+        ]
+    }, status_code=404)
+
+
+async def method_not_allowed(request, exc):
+    return FastJSONResponse({
+        "error": "Method not allowed",
+        "message": "Check the HTTP method (GET/POST) for this route"
+    }, status_code=405)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Registry polling runs in the serving process, like a gunicorn worker's
+    api.registry.start()
+    yield
+    # Same as a gunicorn worker exit: stop reporting ready and flush queued submissions
+    api.on_worker_exit()
+    executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route("/", home, methods=["GET"]),
+        Route("/health", health_check, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+        Route("/predict", predict_image, methods=["POST"]),
+        Route("/admin/models", admin_models, methods=["GET"]),
+        Route("/admin/models/{action}", admin_models, methods=["POST"]),
+    ],
+    exception_handlers={404: not_found, 405: method_not_allowed},
+    lifespan=lifespan
+)
+app = CORSMiddleware(app)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(os.environ.get("PORT", 10000))
+    logger.info("Starting Waste Classification API (ASGI) on http://0.0.0.0:%d", port)
+    # One process: the model is loaded once per process, and concurrency comes from the event loop
+    uvicorn.run(app, host="0.0.0.0", port=port, log_level=api.LOG_LEVEL.lower())
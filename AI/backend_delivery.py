@@ -0,0 +1,355 @@
+import os
+import time
+import queue
+import random
+import logging
+import threading
+from collections import deque
+
+from batching import percentiles
+
+logger = logging.getLogger(__name__)
+
+# Statuses that mean the backend validated a submission and refused it; only these drop it for good
+REJECTED_STATUSES = (400, 422)
+# Statuses after which a bulk POST is retried as one POST per submission: the bulk endpoint is
+# missing, or the backend refused the batch as a whole and may accept most of it item by item
+BULK_FALLBACK_STATUSES = (400, 404, 405, 413, 422)
+
+
+class Delivery:
+    """One pending backend POST: a single submission or a bulk of submissions"""
+
+    def __init__(self, submissions, auth_header, bulk=False):
+        self.submissions = submissions
+        self.auth_header = auth_header
+        self.bulk = bulk
+        self.attempts = 0
+        self.enqueued_at = time.perf_counter()
+
+    @property
+    def submission_ids(self):
+        return [submission["submission_id"] for submission in self.submissions]
+
+
+class BackendDelivery:
+    """Background pipeline that forwards classification results to the backend.
+
+    Requests only enqueue submissions; a fixed pool of worker threads posts
+    them over a shared keep-alive session, retrying connection errors and
+    5xx/429 responses with exponential backoff. Bulk POSTs (body
+    {"submissions": [...]}) go to `bulk_url` and are only made when it is
+    set; without it, every submission is posted to `url` on its own. With
+    `coalesce_max > 1` and a `bulk_url`, queued single submissions that share
+    an Authorization header are merged into one bulk POST.
+
+    With an `outbox`, every submission is persisted before it is queued and
+    marked delivered once the backend accepts it. Only a 400 or 422 from the
+    backend drops a submission; other 4xx (a missing endpoint, an expired
+    token) are retried like server errors. Submissions that run out of
+    retries (or never fit in the in-memory queue) stay pending on disk and
+    are replayed in batches by a background thread. While the backend is
+    failing, replay sends one submission at a time as a probe.
+    """
+
+    def __init__(self, url, bulk_url=None, workers=4, max_queue=10000, max_retries=3,
+                 backoff_base=0.5, backoff_max=30.0, coalesce_max=1, timeout=10, stats_window=1000,
+                 outbox=None, replay_interval=5.0, replay_batch=100, on_post=None):
+        self.url = url
+        self.bulk_url = bulk_url
+        self.workers = max(1, int(workers))
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.coalesce_max = max(1, int(coalesce_max))
+        self.timeout = timeout
+        self.outbox = outbox
+        # Optional callback(seconds, outcome) for every POST, e.g. to feed a latency histogram
+        self.on_post = on_post
+        self.replay_interval = float(replay_interval)
+        self.replay_batch = max(1, int(replay_batch))
+        self._backend_healthy = True
+        self._tracked = set()
+        self._max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self.session = None
+
+        # Stats
+        self._latencies = deque(maxlen=stats_window)
+        self._post_times = deque(maxlen=stats_window)
+        self._in_flight = 0
+        self._counters = {
+            "enqueued": 0,
+            "delivered": 0,
+            "failed": 0,
+            "rejected": 0,
+            "dropped": 0,
+            "retries": 0,
+            "posts": 0,
+            "bulk_posts": 0,
+            "bulk_fallbacks": 0,
+        }
+
+    def submit(self, submission, auth_header):
+        """Queue one submission; returns one of queued/stored/duplicate/dropped"""
+        return self._accept([submission], auth_header, bulk=False)
+
+    def submit_bulk(self, submissions, auth_header):
+        """Queue several submissions, as one bulk POST if there is a bulk_url, else one POST each"""
+        return self._accept(list(submissions), auth_header, bulk=True)
+
+    def _accept(self, submissions, auth_header, bulk):
+        self._ensure_started()
+        if self.outbox is not None:
+            added = set(self.outbox.add(submissions, auth_header))
+            submissions = [s for s in submissions if s["submission_id"] in added]
+            if not submissions:
+                return "duplicate"
+
+        if bulk and self.bulk_url:
+            deliveries = [Delivery(submissions, auth_header, bulk=True)]
+        else:
+            deliveries = [Delivery([submission], auth_header) for submission in submissions]
+        # Every delivery is tried, so as much as fits is queued
+        if all([self._enqueue(delivery) for delivery in deliveries]):
+            return "queued"
+        # Already on disk, so the replay thread will pick it up once the queue drains
+        return "stored" if self.outbox is not None else "dropped"
+
+    def _enqueue(self, delivery):
+        with self._lock:
+            self._tracked.update(delivery.submission_ids)
+        try:
+            self._queue.put_nowait(delivery)
+        except queue.Full:
+            with self._lock:
+                self._tracked.difference_update(delivery.submission_ids)
+            if self.outbox is None:
+                self._count("dropped", len(delivery.submissions))
+            return False
+        self._count("enqueued", len(delivery.submissions))
+        return True
+
+    def _ensure_started(self):
+        # Threads and pooled sockets do not survive a fork, so rebuild them per process
+        if self._threads and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._threads and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self._max_queue)
+            self._stop.clear()
+            # requests is only needed once something is delivered, so keep it off the import path
+            import requests
+            from requests.adapters import HTTPAdapter
+            self._request_error = requests.exceptions.RequestException
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.workers)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            self._threads = []
+            self._tracked = set()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"backend-delivery-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            if self.outbox is not None:
+                thread = threading.Thread(target=self._replay, name="backend-replay", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def close(self, timeout=5.0):
+        """Give queued deliveries up to `timeout` seconds to finish, then stop the workers"""
+        if not self._threads or self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and (self._queue.qsize() or self._in_flight):
+            time.sleep(0.05)
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        self._threads = []
+        if self.session is not None:
+            self.session.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            for delivery in self._coalesce(first):
+                with self._lock:
+                    self._in_flight += 1
+                try:
+                    self._deliver(delivery)
+                finally:
+                    with self._lock:
+                        self._in_flight -= 1
+                        self._tracked.difference_update(delivery.submission_ids)
+
+    def _replay(self):
+        last_prune = 0.0
+        while not self._stop.wait(self.replay_interval):
+            try:
+                if time.monotonic() - last_prune > 3600:
+                    self.outbox.prune()
+                    last_prune = time.monotonic()
+
+                room = self._max_queue - self._queue.qsize()
+                if room <= 0:
+                    continue
+                limit = min(room, self.replay_batch if self._backend_healthy else 1)
+                for auth_header, submissions in self.outbox.claim_due(limit):
+                    with self._lock:
+                        submissions = [s for s in submissions if s["submission_id"] not in self._tracked]
+                    self._enqueue_replay(submissions, auth_header)
+            except Exception as e:
+                logger.exception("Outbox replay failed: %s", e)
+
+    def _enqueue_replay(self, submissions, auth_header):
+        # Replay as bulk posts only when the backend is known to accept them
+        if self.coalesce_max > 1 and self.bulk_url:
+            for start in range(0, len(submissions), self.coalesce_max):
+                chunk = submissions[start:start + self.coalesce_max]
+                self._enqueue(Delivery(chunk, auth_header, bulk=len(chunk) > 1))
+        else:
+            for submission in submissions:
+                self._enqueue(Delivery([submission], auth_header))
+
+    def _coalesce(self, first):
+        if self.coalesce_max <= 1 or not self.bulk_url or first.bulk:
+            return [first]
+
+        pending = [first]
+        while len(pending) < self.coalesce_max:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # Merge singles per Authorization header; bulk deliveries stay as they are
+        merged = {}
+        deliveries = []
+        for delivery in pending:
+            if delivery.bulk:
+                deliveries.append(delivery)
+                continue
+            group = merged.get(delivery.auth_header)
+            if group is None:
+                merged[delivery.auth_header] = delivery
+                deliveries.append(delivery)
+            else:
+                group.submissions.extend(delivery.submissions)
+                group.enqueued_at = min(group.enqueued_at, delivery.enqueued_at)
+        for delivery in deliveries:
+            if len(delivery.submissions) > 1:
+                delivery.bulk = True
+        return deliveries
+
+    def _deliver(self, delivery):
+        count = len(delivery.submissions)
+        while True:
+            delivery.attempts += 1
+            status = self._post(delivery)
+
+            if status is not None and 200 <= status < 300:
+                if self.outbox is not None:
+                    self.outbox.mark_delivered(delivery.submission_ids)
+                with self._lock:
+                    self._backend_healthy = True
+                    self._counters["delivered"] += count
+                    self._latencies.append(time.perf_counter() - delivery.enqueued_at)
+                return True
+
+            if delivery.bulk and status in BULK_FALLBACK_STATUSES:
+                logger.warning("Bulk POST of %d submission(s) got status %s, posting them one by one", count, status)
+                self._count("bulk_fallbacks")
+                singles = [Delivery([submission], delivery.auth_header) for submission in delivery.submissions]
+                return all([self._deliver(single) for single in singles])
+
+            if status in REJECTED_STATUSES:
+                # The backend refused the submission itself; retrying will not help
+                logger.warning("Backend rejected %d submission(s) with status %s", count, status)
+                if self.outbox is not None:
+                    self.outbox.mark_rejected(delivery.submission_ids)
+                self._count("rejected", count)
+                return False
+
+            if delivery.attempts > self.max_retries or self._stop.is_set():
+                logger.warning("Giving up on %d submission(s) after %d attempts", count, delivery.attempts)
+                if self.outbox is not None:
+                    # Stays pending on disk; the replay thread retries it later
+                    self.outbox.mark_failed(delivery.submission_ids, retry_in=self.backoff_max)
+                with self._lock:
+                    self._backend_healthy = False
+                    self._counters["failed"] += count
+                return False
+
+            self._count("retries")
+            delay = min(self.backoff_max, self.backoff_base * (2 ** (delivery.attempts - 1)))
+            self._stop.wait(delay * random.uniform(0.5, 1.0))
+
+    def _post(self, delivery):
+        """POST a delivery; returns the HTTP status, or None on a connection error"""
+        if delivery.bulk:
+            url, payload = self.bulk_url, {"submissions": delivery.submissions}
+        else:
+            url, payload = self.url, delivery.submissions[0]
+
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            response = self.session.post(
+                url,
+                json=payload,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": delivery.auth_header
+                },
+                timeout=self.timeout
+            )
+            # Drain the body so the connection goes back to the pool
+            response.content
+            outcome = str(response.status_code)
+            return response.status_code
+        except self._request_error as e:
+            logger.warning("Error sending to backend: %s", e)
+            return None
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._counters["posts"] += 1
+                if delivery.bulk:
+                    self._counters["bulk_posts"] += 1
+                self._post_times.append(elapsed)
+            if self.on_post is not None:
+                self.on_post(elapsed, outcome)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def stats(self):
+        """Queue depth, delivery counters and latency percentiles"""
+        with self._lock:
+            counters = dict(self._counters)
+            latencies = sorted(self._latencies)
+            post_times = sorted(self._post_times)
+            in_flight = self._in_flight
+
+        return {
+            "workers": self.workers,
+            "backend_healthy": self._backend_healthy,
+            "queue_depth": self._queue.qsize(),
+            "in_flight": in_flight,
+            "coalesce_max": self.coalesce_max,
+            **counters,
+            "delivery_latency_ms": percentiles(latencies),
+            "post_time_ms": percentiles(post_times),
+        }
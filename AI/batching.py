@@ -0,0 +1,135 @@
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """Collect concurrent requests into a single batched call.
+
+    Callers submit one item and block on the returned Future. A background
+    thread waits for the first item, then keeps collecting until either
+    `max_batch_size` items are queued or `max_wait_ms` has passed, and calls
+    `batch_fn(items)` once. `batch_fn` must return one result per item, in order.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=10, stats_window=1000):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        # Stats
+        self._batch_sizes = deque(maxlen=stats_window)
+        self._queue_waits = deque(maxlen=stats_window)
+        self._batch_times = deque(maxlen=stats_window)
+        self._total_batches = 0
+        self._total_items = 0
+        self._total_errors = 0
+
+    def submit(self, item):
+        """Queue one item and return a Future for its result"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def predict(self, item, timeout=None):
+        """Submit one item and wait for its result"""
+        return self.submit(item).result(timeout=timeout)
+
+    def _ensure_started(self):
+        # The worker thread does not survive a fork, so restart it per process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            items = [item for item, _, _ in batch]
+            try:
+                results = self.batch_fn(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"batch_fn returned {len(results)} results for {len(items)} items")
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                with self._lock:
+                    self._total_errors += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finished = time.perf_counter()
+
+            with self._lock:
+                self._total_batches += 1
+                self._total_items += len(batch)
+                self._batch_sizes.append(len(batch))
+                self._batch_times.append(finished - started)
+                for _, _, enqueued in batch:
+                    self._queue_waits.append(started - enqueued)
+
+    def stats(self):
+        """Batch size and queue wait statistics over the recent window"""
+        with self._lock:
+            sizes = list(self._batch_sizes)
+            waits = sorted(self._queue_waits)
+            times = sorted(self._batch_times)
+            total_batches = self._total_batches
+            total_items = self._total_items
+            total_errors = self._total_errors
+
+        histogram = {}
+        for size in sizes:
+            histogram[size] = histogram.get(size, 0) + 1
+
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queue_depth": self._queue.qsize(),
+            "total_batches": total_batches,
+            "total_items": total_items,
+            "total_errors": total_errors,
+            "avg_batch_size": round(sum(sizes) / len(sizes), 2) if sizes else 0.0,
+            "batch_size_histogram": {str(k): histogram[k] for k in sorted(histogram)},
+            "queue_wait_ms": percentiles(waits),
+            "batch_time_ms": percentiles(times),
+        }
+
+
+def percentiles(sorted_values):
+    """p50/p95/p99/max in milliseconds of an already sorted list of seconds"""
+    if not sorted_values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+    def pick(p):
+        index = min(len(sorted_values) - 1, int(round(p * (len(sorted_values) - 1))))
+        return round(sorted_values[index] * 1000.0, 3)
+
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": pick(1.0)}
@@ -0,0 +1,476 @@
+import os
+import io
+import sys
+import json
+import time
+import socket
+import logging
+import platform
+import statistics
+import subprocess
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+from batching import percentiles
+
+# --- Logging setup ---
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("waste_classifier_benchmark")
+
+# --- Config ---
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(SCRIPT_DIR, "benchmarks")
+SERVERS = {
+    "flask": [sys.executable, "waste_classification_api.py"],
+    "gunicorn": ["gunicorn", "-c", "gunicorn.conf.py", "waste_classification_api:app"],
+    "asgi": [sys.executable, "asgi_app.py"],
+}
+# Photo sizes in the synthetic corpus: small upload, typical resized upload, 12MP phone photo
+SYNTHETIC_SIZES = ((640, 480), (1600, 1200), (4032, 3024))
+
+
+def get_option(args, name, default=None):
+    """Value following `name` in the argument list, or `default`"""
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            return args[index + 1]
+    return default
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# --- Stub backend ---
+class StubBackend:
+    """Local stand-in for BACKEND_URL that accepts every submission after `delay_ms`"""
+
+    def __init__(self, delay_ms=0):
+        self.delay = delay_ms / 1000.0
+        self.submissions = 0
+        self.posts = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                count = len(body["submissions"]) if isinstance(body, dict) and "submissions" in body else 1
+                with stub._lock:
+                    stub.posts += 1
+                    stub.submissions += count
+                if stub.delay:
+                    time.sleep(stub.delay)
+                payload = json.dumps({"success": True}).encode()
+                self.send_response(201)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/wasteSubmission"
+        threading.Thread(target=self.server.serve_forever, name="stub-backend", daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+
+
+# --- API process ---
+def process_memory(pid):
+    """PSS of one process in bytes (shared pages split between the processes sharing them), else RSS"""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def process_tree_memory(pid):
+    """Summed memory of `pid` and its descendants (Linux /proc), or None.
+
+    PSS is used where available, so gunicorn workers sharing the preloaded
+    model copy-on-write are not each counted with the full model.
+    """
+    total = 0
+    pending = [pid]
+    try:
+        while pending:
+            current = pending.pop()
+            total += process_memory(current)
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+    except (OSError, ValueError):
+        return total or None
+    return total
+
+
+class APIProcess:
+    """Run the API in a subprocess pointed at the stub backend, and track its peak RSS"""
+
+    def __init__(self, server, port, backend_url, extra_env=None, startup_timeout=600):
+        if server not in SERVERS:
+            raise ValueError(f"Unknown server '{server}', expected one of {', '.join(SERVERS)}")
+        self.url = f"http://127.0.0.1:{port}"
+        self.peak_rss = 0
+        self._stop = threading.Event()
+
+        env = dict(os.environ)
+        env.update({
+            "PORT": str(port),
+            "BACKEND_URL": backend_url,
+            # Throwaway state, so runs don't affect each other or the real outbox
+            "OUTBOX_PATH": "",
+            "PREDICTION_CACHE_PATH": "",
+            "LOG_LEVEL": env.get("LOG_LEVEL", "WARNING"),
+            # The load comes from one client; measure the server, not the rate limiter
+            "RATE_LIMIT_PER_SEC": env.get("RATE_LIMIT_PER_SEC", "0"),
+        })
+        env.update(extra_env or {})
+        logger.info(f"Starting {server} API on port {port}")
+        self.process = subprocess.Popen(SERVERS[server], cwd=SCRIPT_DIR, env=env)
+        threading.Thread(target=self._sample_rss, name="rss-sampler", daemon=True).start()
+        self._wait_ready(startup_timeout)
+
+    def _wait_ready(self, timeout):
+        import requests
+
+        started = time.perf_counter()
+        while time.perf_counter() - started < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"API exited with code {self.process.returncode} during startup")
+            try:
+                if requests.get(f"{self.url}/health", timeout=2).status_code == 200:
+                    self.startup_seconds = time.perf_counter() - started
+                    logger.info(f"API ready after {self.startup_seconds:.1f}s")
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError(f"API not ready after {timeout}s")
+
+    def _sample_rss(self):
+        while not self._stop.wait(0.2):
+            rss = process_tree_memory(self.process.pid)
+            if rss:
+                self.peak_rss = max(self.peak_rss, rss)
+
+    def health(self):
+        import requests
+        return requests.get(f"{self.url}/health", timeout=10).json()
+
+    def close(self):
+        self._stop.set()
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+# --- Image corpus ---
+def synthetic_jpeg(size, seed):
+    """A noisy gradient JPEG; noise keeps the encoded size close to a real photo's"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    noise = rng.integers(0, 48, size=(height, width, 3)).astype(np.float32)
+    pixels = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def load_corpus(count, image_dir=None):
+    """[(filename, bytes)]: sample images from `image_dir` if given, topped up with synthetic photos"""
+    corpus = []
+    if image_dir:
+        for root, _, files in os.walk(image_dir):
+            for name in sorted(files):
+                if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
+                    with open(os.path.join(root, name), "rb") as f:
+                        corpus.append((name, f.read()))
+                if len(corpus) >= count:
+                    return corpus
+    seed = 0
+    while len(corpus) < count:
+        size = SYNTHETIC_SIZES[seed % len(SYNTHETIC_SIZES)]
+        corpus.append((f"synthetic_{size[0]}x{size[1]}_{seed}.jpg", synthetic_jpeg(size, seed)))
+        seed += 1
+    return corpus
+
+
+# --- Load generator ---
+def run_load(url, corpus, concurrency, total_requests, warmup=0):
+    """POST the corpus round-robin to /predict from `concurrency` threads and time every request"""
+    import requests
+
+    local = threading.local()
+
+    def send(index):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        filename, data = corpus[index % len(corpus)]
+        started = time.perf_counter()
+        try:
+            response = session.post(
+                f"{url}/predict",
+                files={"image": (filename, data, "image/jpeg")},
+                headers={"Authorization": "Bearer benchmark"},
+                timeout=120
+            )
+            status = str(response.status_code)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        return time.perf_counter() - started, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if warmup:
+            logger.info(f"Warming up with {warmup} requests")
+            list(pool.map(send, range(warmup)))
+        logger.info(f"Sending {total_requests} requests with concurrency {concurrency}")
+        started = time.perf_counter()
+        results = list(pool.map(send, range(total_requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(seconds for seconds, status in results if status == "200")
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {
+        "requests": total_requests,
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 3),
+        "requests_per_s": round(total_requests / elapsed, 2) if elapsed else 0.0,
+        "succeeded_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            **percentiles(latencies),
+            "mean": round(statistics.fmean(latencies) * 1000.0, 3) if latencies else 0.0
+        },
+        "statuses": statuses
+    }
+
+
+# --- Micro-benchmarks ---
+def time_call(fn, repeats):
+    """Median and minimum milliseconds of `repeats` calls to fn() (after one untimed call)"""
+    fn()
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000.0)
+    return {"median_ms": round(statistics.median(times), 3), "min_ms": round(min(times), 3)}
+
+
+def micro_benchmarks(corpus, backends, batch_sizes, repeats):
+    """Time decode, preprocess and forward separately, in this process"""
+    import torch
+    from startup import load_pretrained
+    from inference_backends import InferenceBackend, default_onnx_path
+    from image_pipeline import FastPreprocessor, decode_image
+    from model_registry import version_id
+
+    model_name = os.environ.get("MODEL_NAME", "Claudineuwa/waste_classifier_Isaac")
+    local_dir = os.environ.get("MODEL_LOCAL_DIR", os.path.join(SCRIPT_DIR, "models", model_name.replace("/", "__")))
+    revision = os.environ.get("MODEL_REVISION") or None
+    processor, model, source = load_pretrained(model_name, revision, local_dir)
+    # The ONNX export is cached per model version, like the API's
+    version = version_id(model_name, revision, model.config, local_dir if source == "local snapshot" else None)
+    fast = FastPreprocessor(processor)
+    results = {"torch_threads": torch.get_num_threads(), "decode": {}, "preprocess": {}, "forward": {}}
+
+    # Decode: full-size PIL decode vs reduced-scale draft decode, per distinct photo size
+    seen = set()
+    for filename, data in corpus:
+        size = Image.open(io.BytesIO(data)).size
+        if size in seen:
+            continue
+        seen.add(size)
+        key = f"{size[0]}x{size[1]}"
+        results["decode"][key] = {
+            "full": time_call(lambda: Image.open(io.BytesIO(data)).convert("RGB"), repeats),
+            "fast": time_call(lambda: decode_image(data, fast.size), repeats)
+        }
+
+    # Preprocess: image processor vs FastPreprocessor, on already decoded images
+    images = [decode_image(data, fast.size) for _, data in corpus]
+    for batch_size in batch_sizes:
+        batch = [images[i % len(images)] for i in range(batch_size)]
+        results["preprocess"][str(batch_size)] = {
+            "processor": time_call(lambda: processor(images=batch, return_tensors="pt"), repeats),
+            "fast": time_call(lambda: fast(batch), repeats)
+        }
+
+    # Forward: each inference backend at each batch size
+    width, height = fast.size
+    for name in backends:
+        try:
+            backend = InferenceBackend(
+                model, name,
+                onnx_path=default_onnx_path(version, os.path.join(SCRIPT_DIR, "onnx")),
+                inplace=False
+            )
+        except Exception as e:
+            logger.warning(f"Skipping {name} backend: {str(e)}")
+            continue
+        results["forward"][name] = {}
+        for batch_size in batch_sizes:
+            pixel_values = torch.randn(batch_size, 3, height, width)
+            timing = time_call(lambda: backend(pixel_values), repeats)
+            timing["images_per_s"] = round(batch_size * 1000.0 / timing["median_ms"], 2)
+            results["forward"][name][str(batch_size)] = timing
+    return results
+
+
+# --- Results ---
+def run_metadata(args):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SCRIPT_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "argv": args[1:]
+    }
+
+
+def save_results(results, path=None):
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['meta']['commit'] or 'nocommit'}.json"
+        path = os.path.join(RESULTS_DIR, name)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results saved to {path}")
+    return path
+
+
+def compare(path_a, path_b):
+    """Print the main load-test numbers of two result files side by side"""
+    with open(path_a) as f:
+        a = json.load(f)
+    with open(path_b) as f:
+        b = json.load(f)
+    rows = [("requests_per_s", lambda r: r["load"]["requests_per_s"])]
+    rows += [(f"latency_{p}_ms", lambda r, p=p: r["load"]["latency_ms"][p]) for p in ("p50", "p95", "p99")]
+    rows += [("peak_rss_mb", lambda r: r["load"]["peak_rss_mb"])]
+    print(f"{'metric':<20}{a['meta']['commit'] or path_a:>14}{b['meta']['commit'] or path_b:>14}{'change':>10}")
+    for name, pick in rows:
+        try:
+            before, after = pick(a), pick(b)
+        except (KeyError, TypeError):
+            continue
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{name:<20}{before:>14}{after:>14}{change:>10}")
+
+
+def main():
+    """Main function to handle command line arguments"""
+    args = sys.argv
+    if len(args) < 2 or args[1] == "--help":
+        print("Waste Classifier Benchmark")
+        print("Usage:")
+        print("  python benchmark.py --load                 - Load test /predict on a local API against a stub backend")
+        print("  python benchmark.py --micro                - Time decode, preprocess and forward separately")
+        print("  python benchmark.py --load --micro         - Both, in one result file")
+        print("  python benchmark.py --compare A.json B.json")
+        print("\nOptions:")
+        print(f"  --server NAME          API to start for --load ({', '.join(SERVERS)}; default: flask)")
+        print("  --url URL              Load test an already running API instead of starting one")
+        print("  --inference-backend N  INFERENCE_BACKEND for the started API (default: eager)")
+        print("  --concurrency N        Concurrent clients (default: 8)")
+        print("  --requests N           Timed requests (default: 200)")
+        print("  --warmup N             Untimed requests sent first (default: 20)")
+        print("  --corpus N             Number of distinct images (default: 12)")
+        print("  --images DIR           Sample images to include in the corpus")
+        print("  --cache                Keep the prediction cache on (off by default, so every request runs inference)")
+        print("  --backend-delay-ms N   Latency of the stub backend (default: 50)")
+        print("  --backends A,B         Backends for --micro (default: eager,int8)")
+        print("  --batch-sizes A,B      Batch sizes for --micro (default: 1,8)")
+        print("  --repeats N            Timed repeats per micro-benchmark (default: 20)")
+        print("  --output PATH          Result file (default: benchmarks/<time>-<commit>.json)")
+        return
+
+    if args[1] == "--compare":
+        compare(args[2], args[3])
+        return
+
+    corpus = load_corpus(int(get_option(args, "--corpus", 12)), get_option(args, "--images"))
+    results = {"meta": run_metadata(args)}
+
+    if "--load" in args:
+        stub = StubBackend(delay_ms=float(get_option(args, "--backend-delay-ms", 50)))
+        api = None
+        url = get_option(args, "--url")
+        server = get_option(args, "--server", "flask")
+        inference_backend = get_option(args, "--inference-backend", "eager")
+        try:
+            if url is None:
+                api = APIProcess(server, free_port(), stub.url, extra_env={
+                    "INFERENCE_BACKEND": inference_backend,
+                    "PREDICTION_CACHE_SIZE": os.environ.get("PREDICTION_CACHE_SIZE", "10000") if "--cache" in args else "0",
+                })
+                url = api.url
+            load = run_load(
+                url,
+                corpus,
+                concurrency=int(get_option(args, "--concurrency", 8)),
+                total_requests=int(get_option(args, "--requests", 200)),
+                warmup=int(get_option(args, "--warmup", 20))
+            )
+            load.update({
+                "server": server if api is not None else url,
+                "inference_backend": inference_backend if api is not None else None,
+                "startup_s": round(api.startup_seconds, 2) if api is not None else None,
+                "peak_rss_mb": round(api.peak_rss / 1048576, 1) if api is not None and api.peak_rss else None,
+                "backend_submissions": stub.submissions,
+                "backend_posts": stub.posts,
+            })
+            if api is not None:
+                health = api.health()
+                load["server_batching"] = health.get("batching")
+                load["server_memory"] = health.get("memory")
+            results["load"] = load
+            print(json.dumps({k: v for k, v in load.items() if not k.startswith("server_")}, indent=2))
+        finally:
+            if api is not None:
+                api.close()
+            stub.close()
+
+    if "--micro" in args:
+        results["micro"] = micro_benchmarks(
+            corpus,
+            backends=get_option(args, "--backends", "eager,int8").split(","),
+            batch_sizes=[int(b) for b in get_option(args, "--batch-sizes", "1,8").split(",")],
+            repeats=int(get_option(args, "--repeats", 20))
+        )
+        print(json.dumps(results["micro"], indent=2))
+
+    save_results(results, get_option(args, "--output"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import json
+import logging
+import tarfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from image_pipeline import decode_image
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif")
+
+
+def iter_images(source, skip=0):
+    """Yield (name, bytes) for every image in a directory, tar or zip archive, one at a time.
+
+    The order is deterministic (sorted directory walk, archive order), which
+    is what lets a bulk run resume by position: the first `skip` images are
+    passed over without reading their contents.
+    """
+    index = 0
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    index += 1
+                    if index <= skip:
+                        continue
+                    path = os.path.join(root, name)
+                    with open(path, "rb") as f:
+                        yield os.path.relpath(path, source), f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    index += 1
+                    if index <= skip:
+                        continue
+                    yield info.filename, archive.read(info)
+    elif tarfile.is_tarfile(source):
+        # Stream mode: members are read in order without building the member index,
+        # and the data of members that are not extracted is skipped by the next header read
+        with tarfile.open(source, mode="r|*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    index += 1
+                    if index <= skip:
+                        continue
+                    yield member.name, archive.extractfile(member).read()
+    else:
+        raise ValueError(f"{source} is not a directory, zip or tar archive")
+
+
+def decode_stream(items, target_size, workers=4, window=64):
+    """Decode (name, bytes) items in a thread pool, yielding (name, image or None, error) in order.
+
+    At most `window` items are being decoded or waiting at any time, so
+    memory stays bounded however large the source is.
+    """
+    def decode(name, data):
+        try:
+            return name, decode_image(data, target_size), None
+        except Exception as e:
+            return name, None, str(e)
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk-decode") as pool:
+        for name, data in items:
+            pending.append(pool.submit(decode, name, data))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _arrow_type(pyarrow, name):
+    """pyarrow type for a column type name: an alias such as string or int64, or list<...>"""
+    if name.startswith("list<") and name.endswith(">"):
+        return pyarrow.list_(_arrow_type(pyarrow, name[5:-1]))
+    return pyarrow.type_for_alias(name)
+
+
+class JsonlWriter:
+    """Append results to a JSONL file; the checkpoint remembers the byte offset of the last commit"""
+
+    def __init__(self, path, state=None, columns=None):
+        self.path = path
+        self._file = open(path, "a+b")
+        # Start over without a checkpoint, otherwise drop rows written after the last one
+        self._file.truncate(state["offset"] if state else 0)
+        self._file.seek(0, os.SEEK_END)
+
+    def write(self, rows):
+        for row in rows:
+            self._file.write(json.dumps(row).encode() + b"\n")
+
+    def commit(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"offset": self._file.tell()}
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """Write results as numbered Parquet part files in the `path` directory, one per commit.
+
+    `columns` maps each column name to its type name ("string", "int64",
+    "float64", "bool", "list<string>", ...). Every part, in every run, is
+    written with that schema, so the parts read back as one table even when
+    a batch has only nulls in some column.
+    """
+
+    def __init__(self, path, state=None, columns=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise RuntimeError("Parquet output needs the pyarrow package") from e
+        if not columns:
+            raise ValueError("Parquet output needs the column types")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._schema = pyarrow.schema([(name, _arrow_type(pyarrow, kind)) for name, kind in columns.items()])
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.part = state["part"] if state else 0
+        # Parts numbered past the checkpoint are leftovers of an interrupted run
+        for name in os.listdir(path):
+            if name.startswith("part-") and int(name[5:10]) >= self.part:
+                os.remove(os.path.join(path, name))
+        self._rows = []
+
+    def write(self, rows):
+        self._rows.extend(rows)
+
+    def commit(self):
+        if self._rows:
+            table = self._pa.Table.from_pylist(self._rows, schema=self._schema)
+            self._pq.write_table(table, os.path.join(self.path, f"part-{self.part:05d}.parquet"))
+            self.part += 1
+            self._rows = []
+        return {"part": self.part}
+
+    def close(self):
+        pass
+
+
+WRITERS = {"jsonl": JsonlWriter, "parquet": ParquetWriter}
+
+
+class Checkpoint:
+    """Progress of a bulk run: how many source images are done and the writer's state at that point"""
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get("source") != self.source:
+            raise ValueError(f"Checkpoint {self.path} belongs to {state.get('source')}, not {self.source}")
+        return state
+
+    def save(self, processed, writer_state):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"source": self.source, "processed": processed, "writer": writer_state}, f)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,240 @@
+import os
+import time
+import logging
+import threading
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+# Saved next to the model by train.py (EARLY_EXIT_LAYERS)
+EARLY_EXIT_FILE = "early_exit.pt"
+
+
+def _run_layers(layers, hidden_states):
+    for layer in layers:
+        output = layer(hidden_states)
+        # Older transformers versions return a tuple, newer ones the tensor
+        hidden_states = output[0] if isinstance(output, tuple) else output
+    return hidden_states
+
+
+class EarlyExitHead(nn.Module):
+    """Classifier on the [CLS] token after the first `layers` ViT encoder layers"""
+
+    def __init__(self, hidden_size, num_labels, layers, eps=1e-12):
+        super().__init__()
+        self.layers = layers
+        self.layernorm = nn.LayerNorm(hidden_size, eps=eps)
+        self.classifier = nn.Linear(hidden_size, num_labels)
+
+    @classmethod
+    def for_model(cls, model, layers):
+        """A head for `model`, initialized from its final norm and classifier"""
+        config = model.config
+        if not 0 < layers < config.num_hidden_layers:
+            raise ValueError(f"The early exit must come after 1 to {config.num_hidden_layers - 1} layers, not {layers}")
+        head = cls(config.hidden_size, config.num_labels, layers, config.layer_norm_eps)
+        head.layernorm.load_state_dict(model.base_model.layernorm.state_dict())
+        head.classifier.load_state_dict(model.classifier.state_dict())
+        return head
+
+    def forward(self, hidden_states):
+        return self.classifier(self.layernorm(hidden_states[:, 0]))
+
+
+def save_exit_head(head, path):
+    """Write the head and its shape to `path` (atomically)"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    torch.save({
+        "layers": head.layers,
+        "hidden_size": head.classifier.in_features,
+        "num_labels": head.classifier.out_features,
+        "eps": head.layernorm.eps,
+        "state_dict": head.state_dict()
+    }, tmp)
+    os.replace(tmp, path)
+    logger.info(f"Early-exit head ({head.layers} layers) saved to {path}")
+
+
+def load_exit_head(path, device="cpu"):
+    saved = torch.load(path, map_location=device, weights_only=True)
+    head = EarlyExitHead(saved["hidden_size"], saved["num_labels"], saved["layers"], saved["eps"])
+    head.load_state_dict(saved["state_dict"])
+    return head.to(device).eval()
+
+
+class CascadeClassifier:
+    """Two-tier classification with one ViT: a cheap early exit, then the full model.
+
+    Every image runs through the first `head.layers` encoder layers and the
+    early-exit head. Images whose top probability reaches `threshold` are
+    answered there; the rest continue from the same hidden states through the
+    remaining layers and the model's own classifier, so escalation costs no
+    more than a normal forward pass. Works with the eager and int8 backends.
+    Calling it with pixel_values returns the logits, like an InferenceBackend.
+    """
+
+    def __init__(self, model, head, threshold=0.9, device="cpu"):
+        vit = model.base_model
+        self.device = torch.device(device)
+        self.head = head.to(self.device).eval()
+        self.threshold = threshold
+        self.embeddings = vit.embeddings
+        self.early_layers = vit.encoder.layer[:head.layers]
+        self.late_layers = vit.encoder.layer[head.layers:]
+        self.layernorm = vit.layernorm
+        self.classifier = model.classifier
+        self._lock = threading.Lock()
+        self._counters = {"images": 0, "escalated": 0, "exit_seconds": 0.0, "escalation_seconds": 0.0}
+
+    def exit(self, pixel_values):
+        """(hidden states after the early layers, early-exit logits)"""
+        hidden_states = _run_layers(self.early_layers, self.embeddings(pixel_values.to(self.device)))
+        return hidden_states, self.head(hidden_states)
+
+    def escalate(self, hidden_states):
+        """Full-model logits, continuing from the early layers' hidden states"""
+        hidden_states = self.layernorm(_run_layers(self.late_layers, hidden_states))
+        return self.classifier(hidden_states[:, 0])
+
+    def __call__(self, pixel_values):
+        started = time.perf_counter()
+        hidden_states, logits = self.exit(pixel_values)
+        confidence = F.softmax(logits, dim=1).max(dim=1).values
+        escalate = (confidence < self.threshold).nonzero(as_tuple=True)[0]
+        exited = time.perf_counter()
+        if len(escalate):
+            logits[escalate] = self.escalate(hidden_states[escalate]).to(logits.dtype)
+        with self._lock:
+            self._counters["images"] += len(logits)
+            self._counters["escalated"] += len(escalate)
+            self._counters["exit_seconds"] += exited - started
+            self._counters["escalation_seconds"] += time.perf_counter() - exited
+        return logits
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        images, escalated = counters["images"], counters["escalated"]
+        exit_ms = counters["exit_seconds"] * 1000.0 / images if images else 0.0
+        if escalated:
+            escalation_ms = counters["escalation_seconds"] * 1000.0 / escalated
+        else:
+            # Nothing escalated yet: assume the late layers cost as much per layer as the early ones
+            escalation_ms = exit_ms * len(self.late_layers) / len(self.early_layers)
+        # Each image answered early saved the late layers' cost
+        saved_ms = (images - escalated) * escalation_ms
+        return {
+            "threshold": self.threshold,
+            "exit_layer": len(self.early_layers),
+            "images": images,
+            "escalated": escalated,
+            "escalation_rate": round(escalated / images, 4) if images else 0.0,
+            "exit_ms_per_image": round(exit_ms, 3),
+            "escalation_ms_per_image": round(escalation_ms, 3),
+            "estimated_saved_ms": round(saved_ms, 1),
+            "estimated_saved_ms_per_image": round(saved_ms / images, 3) if images else 0.0
+        }
+
+
+def distill_exit_head(model, head, batches, epochs=2, learning_rate=1e-3, temperature=2.0, alpha=0.5, device="cpu"):
+    """Train `head` on the frozen model's hidden states after `head.layers` layers.
+
+    `batches` is re-iterable and yields dicts with pixel_values and labels. The
+    loss mixes KL divergence to the full model's temperature-softened logits
+    (weight `alpha`) with cross-entropy on the labels, so the head learns to
+    agree with the model it stands in for, confidence included.
+    """
+    model = model.to(device).eval()
+    head = head.to(device).train()
+    optimizer = torch.optim.AdamW(head.parameters(), lr=learning_rate)
+
+    for epoch in range(epochs):
+        started = time.perf_counter()
+        seen = correct = 0
+        total_loss = 0.0
+        for batch in batches:
+            pixel_values = batch["pixel_values"].to(device)
+            labels = batch["labels"].to(device)
+            with torch.no_grad():
+                outputs = model(pixel_values=pixel_values, output_hidden_states=True)
+            # hidden_states[0] is the embedding output, [k] the output of layer k
+            logits = head(outputs.hidden_states[head.layers])
+            soft = F.kl_div(
+                F.log_softmax(logits / temperature, dim=1),
+                F.softmax(outputs.logits / temperature, dim=1),
+                reduction="batchmean"
+            ) * temperature ** 2
+            loss = alpha * soft + (1 - alpha) * F.cross_entropy(logits, labels)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            seen += len(labels)
+            correct += (logits.argmax(dim=1) == labels).sum().item()
+            total_loss += loss.item() * len(labels)
+        logger.info(
+            f"Early-exit epoch {epoch + 1}/{epochs}: loss {total_loss / max(1, seen):.4f}, "
+            f"accuracy {correct / max(1, seen):.4f}, {seen / (time.perf_counter() - started):.1f} samples/sec"
+        )
+    return head.eval()
+
+
+def evaluate_cascade(model, head, batches, thresholds=(0.8, 0.9, 0.95, 0.99), device="cpu"):
+    """Accuracy, escalation rate and speed of the cascade at several thresholds, in one pass.
+
+    `batches` yields (pixel_values, labels). Both tiers run on every image and
+    are timed separately, so the cost at each threshold is estimated as the
+    early exit plus the escalation rate times the late layers, and compared
+    with running every image through the full model.
+    """
+    cascade = CascadeClassifier(model, head, device=device)
+    labels, exit_probs, full_preds = [], [], []
+    exit_seconds = escalation_seconds = 0.0
+
+    with torch.inference_mode():
+        for pixel_values, batch_labels in batches:
+            started = time.perf_counter()
+            hidden_states, logits = cascade.exit(pixel_values)
+            exited = time.perf_counter()
+            full_logits = cascade.escalate(hidden_states)
+            escalation_seconds += time.perf_counter() - exited
+            exit_seconds += exited - started
+            labels.extend(batch_labels.tolist())
+            exit_probs.append(F.softmax(logits.float(), dim=1).cpu())
+            full_preds.extend(full_logits.argmax(dim=1).tolist())
+
+    count = len(labels)
+    if not count:
+        raise ValueError("No images to evaluate the cascade on")
+    probs = torch.cat(exit_probs)
+    confidence, exit_preds = probs.max(dim=1)
+    labels_t, full_t = torch.tensor(labels), torch.tensor(full_preds)
+    exit_ms = exit_seconds * 1000.0 / count
+    escalation_ms = escalation_seconds * 1000.0 / count
+    full_ms = exit_ms + escalation_ms
+
+    report = {
+        "images": count,
+        "exit_layer": head.layers,
+        "full_accuracy": round((full_t == labels_t).float().mean().item(), 4),
+        "exit_accuracy": round((exit_preds == labels_t).float().mean().item(), 4),
+        "full_ms_per_image": round(full_ms, 3),
+        "exit_ms_per_image": round(exit_ms, 3),
+        "thresholds": {}
+    }
+    for threshold in thresholds:
+        escalate = confidence < threshold
+        preds = torch.where(escalate, full_t, exit_preds)
+        rate = escalate.float().mean().item()
+        cost_ms = exit_ms + rate * escalation_ms
+        report["thresholds"][str(threshold)] = {
+            "accuracy": round((preds == labels_t).float().mean().item(), 4),
+            "agreement_with_full": round((preds == full_t).float().mean().item(), 4),
+            "escalation_rate": round(rate, 4),
+            "estimated_ms_per_image": round(cost_ms, 3),
+            "estimated_speedup": round(full_ms / cost_ms, 2) if cost_ms else 0.0
+        }
+    return report
@@ -0,0 +1,407 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_INDEX_PATH = os.path.join(SCRIPT_DIR, "dedup", "index.npz")
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    """Cosine-similarity index over L2-normalized embeddings, flat or IVF.
+
+    Flat search compares a query with every stored vector (one matrix
+    product). After `train_ivf(nlist)`, vectors are bucketed by their nearest
+    k-means centroid and a query only scans the `nprobe` closest buckets.
+    Each vector carries an integer label and a key (the image path).
+    """
+
+    def __init__(self, dim=None, model_name=None):
+        self.dim = dim
+        self.model_name = model_name
+        self._vectors = np.zeros((0, dim or 0), dtype=np.float32)
+        self._labels = np.zeros(0, dtype=np.int64)
+        self._assignments = None
+        self.keys = []
+        self.centroids = None
+        self._lists = None
+        # Batches added since the arrays were last built, concatenated once when they are read
+        self._pending = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, embeddings, labels, keys):
+        embeddings = _normalize(embeddings)
+        if self.dim is None or len(self) == 0:
+            self.dim = embeddings.shape[1]
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+        assignments = self._assign(embeddings) if self.centroids is not None else None
+        self._pending.append((embeddings, np.asarray(labels, dtype=np.int64), assignments))
+        self.keys.extend(keys)
+        self._lists = None
+
+    def _flush(self):
+        if not self._pending:
+            return
+        vectors, labels, assignments = zip(*self._pending)
+        self._pending = []
+        self._vectors = np.concatenate([self._vectors, *vectors])
+        self._labels = np.concatenate([self._labels, *labels])
+        if self.centroids is not None:
+            self._assignments = np.concatenate([self._assignments, *assignments])
+
+    @property
+    def vectors(self):
+        self._flush()
+        return self._vectors
+
+    @vectors.setter
+    def vectors(self, value):
+        self._flush()
+        self._vectors = value
+
+    @property
+    def labels(self):
+        self._flush()
+        return self._labels
+
+    @labels.setter
+    def labels(self, value):
+        self._flush()
+        self._labels = value
+
+    @property
+    def assignments(self):
+        self._flush()
+        return self._assignments
+
+    @assignments.setter
+    def assignments(self, value):
+        self._flush()
+        self._assignments = value
+
+    def train_ivf(self, nlist, iterations=20, seed=0):
+        """k-means (spherical) over the stored vectors, then bucket every vector by centroid"""
+        nlist = max(1, min(int(nlist), len(self)))
+        rng = np.random.default_rng(seed)
+        centroids = self.vectors[rng.choice(len(self), nlist, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(self.vectors @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = self.vectors[assignments == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        self.centroids = centroids
+        self.assignments = self._assign(self.vectors)
+        self._lists = None
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            self._lists = [np.flatnonzero(self.assignments == c) for c in range(len(self.centroids))]
+        return self._lists
+
+    def search(self, queries, k=5, nprobe=4):
+        """(similarities, ids) of the `k` most similar stored vectors for each query; ids are -1 when missing"""
+        queries = _normalize(queries)
+        scores = np.full((len(queries), k), -1.0, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        if len(self) == 0:
+            return scores, ids
+
+        if self.centroids is None:
+            candidates = [None] * len(queries)
+        else:
+            lists = self._inverted_lists()
+            nearest = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+            candidates = [np.concatenate([lists[c] for c in row]) for row in nearest]
+
+        for i, query in enumerate(queries):
+            pool = candidates[i]
+            similarities = self.vectors @ query if pool is None else self.vectors[pool] @ query
+            top = np.argsort(-similarities)[:k]
+            scores[i, :len(top)] = similarities[top]
+            ids[i, :len(top)] = top if pool is None else pool[top]
+        return scores, ids
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        arrays = {
+            "vectors": self.vectors,
+            "labels": self.labels,
+            # Fixed-width unicode, so loading never needs pickle
+            "keys": np.array(self.keys, dtype=str),
+            "meta": np.array(json.dumps({"model_name": self.model_name, "dim": self.dim})),
+        }
+        if self.centroids is not None:
+            arrays["centroids"] = self.centroids
+            arrays["assignments"] = self.assignments
+        # Written under a temporary name first so a running API never loads half a file
+        temp_path = path + ".tmp.npz"
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        # No pickled objects: the path can be set at runtime and a pickle would run code
+        data = np.load(path, allow_pickle=False)
+        meta = json.loads(str(data["meta"]))
+        index = cls(meta["dim"], meta["model_name"])
+        index.vectors = data["vectors"]
+        index.labels = data["labels"]
+        try:
+            index.keys = data["keys"].tolist()
+        except ValueError as e:
+            raise ValueError(f"{path} stores its keys as pickled objects; rebuild it with dedup_index.py build") from e
+        if "centroids" in data:
+            index.centroids = data["centroids"]
+            index.assignments = data["assignments"]
+        return index
+
+
+def duplicate_clusters(index, threshold=0.95, k=10, nprobe=8):
+    """Groups (lists of ids) of two or more vectors linked by similarity >= threshold"""
+    parent = list(range(len(index)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for start in range(0, len(index), 1024):
+        scores, ids = index.search(index.vectors[start:start + 1024], k=k, nprobe=nprobe)
+        for row, (row_scores, row_ids) in enumerate(zip(scores, ids)):
+            for score, other in zip(row_scores, row_ids):
+                if other >= 0 and other != start + row and score >= threshold:
+                    parent[find(start + row)] = find(other)
+
+    groups = {}
+    for i in range(len(index)):
+        groups.setdefault(find(i), []).append(i)
+    return [members for members in groups.values() if len(members) > 1]
+
+
+def duplicate_aware_split(index, clusters, test_size=0.2, seed=42):
+    """Split keys into train/val/test (80/10/10 by default) keeping each duplicate cluster in one split"""
+    cluster_of = {}
+    for number, members in enumerate(clusters):
+        for i in members:
+            cluster_of[i] = number
+    groups = {}
+    for i in range(len(index)):
+        groups.setdefault(("cluster", cluster_of[i]) if i in cluster_of else ("single", i), []).append(i)
+
+    group_list = list(groups.values())
+    np.random.default_rng(seed).shuffle(group_list)
+    held_out = int(round(len(index) * test_size))
+    splits = {"train": [], "val": [], "test": []}
+    for members in group_list:
+        if len(splits["test"]) < held_out / 2:
+            target = "test"
+        elif len(splits["val"]) < held_out / 2:
+            target = "val"
+        else:
+            target = "train"
+        splits[target].extend(index.keys[i] for i in members)
+    return splits
+
+
+def apply_split_file(dataset, split_file):
+    """DatasetDict(train/val/test) of an imagefolder dataset, split as listed in `split_file`"""
+    from datasets import DatasetDict, Image as ImageFeature
+
+    with open(split_file) as f:
+        splits = json.load(f)
+    paths = dataset.cast_column("image", ImageFeature(decode=False))["image"]
+    position = {os.path.abspath(item["path"]): i for i, item in enumerate(paths)}
+    result = {}
+    for name in ("train", "val", "test"):
+        indices = [position[os.path.abspath(key)] for key in splits[name] if os.path.abspath(key) in position]
+        result[name] = dataset.select(indices)
+    missing = len(position) - sum(len(split) for split in result.values())
+    if missing:
+        logger.warning(f"{missing} images are not listed in {split_file} and are left out")
+    return DatasetDict(result)
+
+
+class ClassifierInputHook:
+    """Capture the classifier's input (the ViT [CLS] embedding) during normal forward passes.
+
+    Works with the eager and int8 backends, whose model still has a
+    `classifier` module; the embedding comes for free with the prediction.
+    Captures are kept per thread.
+    """
+
+    def __init__(self, model):
+        self._local = threading.local()
+        self.handle = model.classifier.register_forward_hook(self._capture)
+
+    def _capture(self, module, inputs, output):
+        self._local.embeddings = inputs[0].detach()
+
+    def pop(self):
+        embeddings = getattr(self._local, "embeddings", None)
+        self._local.embeddings = None
+        return embeddings
+
+
+class NearDuplicateLookup:
+    """Answer uploads that are near-duplicates of indexed images with the indexed label"""
+
+    def __init__(self, index, threshold=0.97, nprobe=4):
+        self.index = index
+        self.threshold = threshold
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._counters = {"lookups": 0, "matches": 0, "overrides": 0, "lookup_ms": 0.0}
+
+    def match(self, embeddings):
+        """For each embedding, (label, similarity, key) of its near-duplicate, or None"""
+        started = time.perf_counter()
+        scores, ids = self.index.search(embeddings.float().cpu().numpy(), k=1, nprobe=self.nprobe)
+        matches = [
+            (int(self.index.labels[i]), float(score), self.index.keys[i]) if i >= 0 and score >= self.threshold else None
+            for score, i in zip(scores[:, 0], ids[:, 0])
+        ]
+        with self._lock:
+            self._counters["lookups"] += len(matches)
+            self._counters["matches"] += sum(m is not None for m in matches)
+            self._counters["lookup_ms"] += (time.perf_counter() - started) * 1000.0
+        return matches
+
+    def count_override(self):
+        with self._lock:
+            self._counters["overrides"] += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters["lookup_ms"] = round(counters["lookup_ms"], 2)
+        return {
+            "size": len(self.index),
+            "ivf": self.index.centroids is not None,
+            "threshold": self.threshold,
+            **counters
+        }
+
+
+# --- Command line ---
+def get_option(args, name, default=None):
+    """Value following `name` in the argument list, or `default`"""
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            return args[index + 1]
+    return default
+
+
+def build_index(data_dir, model_path, batch_size=32, nlist=0, workers=4):
+    """Embed every image of an imagefolder dataset in batches and index it"""
+    import torch
+    from datasets import load_dataset, Image as ImageFeature
+    from transformers import AutoImageProcessor, AutoModelForImageClassification
+    from bulk_classify import decode_stream, batched
+    from image_pipeline import FastPreprocessor
+
+    processor = AutoImageProcessor.from_pretrained(model_path)
+    model = AutoModelForImageClassification.from_pretrained(model_path).eval()
+    preprocessor = FastPreprocessor(processor)
+    dataset = load_dataset("imagefolder", data_dir=data_dir)["train"]
+    items = dataset.cast_column("image", ImageFeature(decode=False))
+    # Folder labels in the model's label ids, mapping O/R the same way train.py does
+    folders = dataset.features["label"].names
+    folder_ids = {"O": 0, "R": 1}
+    labels = [folder_ids.get(folders[label], label) for label in items["label"]]
+
+    def sources():
+        for item in items["image"]:
+            with open(item["path"], "rb") as f:
+                yield item["path"], f.read()
+
+    index = EmbeddingIndex(model_name=model_path)
+    started = time.perf_counter()
+    position = 0
+    for batch in batched(decode_stream(sources(), preprocessor.size, workers=workers, window=batch_size * 2), batch_size):
+        good = [(position + offset, path, image) for offset, (path, image, _) in enumerate(batch) if image is not None]
+        position += len(batch)
+        if not good:
+            continue
+        with torch.inference_mode():
+            hidden = model.base_model(pixel_values=preprocessor([image for _, _, image in good])).last_hidden_state
+        index.add(hidden[:, 0].numpy(), [labels[i] for i, _, _ in good], [path for _, path, _ in good])
+        logger.info(f"Embedded {position}/{len(labels)} images ({position / (time.perf_counter() - started):.1f}/sec)")
+
+    if nlist:
+        logger.info(f"Training IVF index with {nlist} lists")
+        index.train_ivf(nlist)
+    return index
+
+
+def main():
+    """Main function to handle command line arguments"""
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv
+    if len(args) < 2 or args[1] not in ("build", "clusters", "split"):
+        print("Usage:")
+        print("  python dedup_index.py build [--data DIR] [--model PATH] [--ivf NLIST] [--batch-size N]")
+        print("  python dedup_index.py clusters [--threshold 0.95] [--report clusters.json]")
+        print("  python dedup_index.py split [--threshold 0.95] [--output splits.json]")
+        print("\nAll commands take --index PATH (default: dedup/index.npz).")
+        print("Use the split file with SPLIT_FILE=splits.json python train.py (and python test.py --dataset).")
+        return
+
+    index_path = get_option(args, "--index", DEFAULT_INDEX_PATH)
+    if args[1] == "build":
+        index = build_index(
+            get_option(args, "--data", os.path.join(SCRIPT_DIR, "data")),
+            get_option(args, "--model", os.path.join(SCRIPT_DIR, "waste_classifier")),
+            batch_size=int(get_option(args, "--batch-size", 32)),
+            nlist=int(get_option(args, "--ivf", 0))
+        )
+        index.save(index_path)
+        logger.info(f"Indexed {len(index)} images in {index_path}")
+        return
+
+    index = EmbeddingIndex.load(index_path)
+    threshold = float(get_option(args, "--threshold", 0.95))
+    clusters = duplicate_clusters(index, threshold)
+    duplicates = sum(len(members) - 1 for members in clusters)
+    logger.info(f"{len(clusters)} near-duplicate clusters, {duplicates} redundant images out of {len(index)}")
+
+    if args[1] == "clusters":
+        report = sorted(([index.keys[i] for i in members] for members in clusters), key=len, reverse=True)
+        output = get_option(args, "--report")
+        if output:
+            with open(output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Clusters saved to {output}")
+        else:
+            for members in report[:20]:
+                print(f"{len(members)}: {', '.join(members[:5])}{' ...' if len(members) > 5 else ''}")
+    else:
+        splits = duplicate_aware_split(index, clusters)
+        output = get_option(args, "--output", os.path.join(SCRIPT_DIR, "dedup", "splits.json"))
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump(splits, f, indent=2)
+        logger.info(f"Split {', '.join(f'{k}={len(v)}' for k, v in splits.items())} saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson embeds pre-encoded JSON verbatim from 3.9.15 on
+_FRAGMENTS = orjson is not None and hasattr(orjson, "Fragment")
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+class PreSerialized:
+    """A JSON value encoded once at startup and embedded in responses without re-encoding"""
+
+    __slots__ = ("value", "encoded", "_fragment")
+
+    def __init__(self, value):
+        self.value = value
+        self.encoded = dumps(value)
+        self._fragment = orjson.Fragment(self.encoded) if _FRAGMENTS else None
+
+
+def _default(obj):
+    if isinstance(obj, PreSerialized):
+        return obj._fragment if obj._fragment is not None else obj.value
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """Compact UTF-8 JSON bytes, through orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def backend():
+    return "orjson" if orjson is not None else "json"
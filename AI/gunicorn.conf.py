@@ -0,0 +1,59 @@
+import os
+import gc
+import multiprocessing
+
+# Production serving for the waste classification API:
+#
+#   gunicorn -c gunicorn.conf.py waste_classification_api:app
+#
+# The app (and with it the model) is imported once in the master process and
+# then forked, so workers share the weights copy-on-write instead of each
+# loading their own copy.
+
+cpu_count = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", max(1, cpu_count // 2)))
+# Threads let concurrent requests meet in the micro-batcher inside each worker
+worker_class = "gthread"
+threads = int(os.environ.get("WORKER_THREADS", 8))
+preload_app = True
+timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# Workers share the model registry state, so an admin call that reaches one worker reaches all of them
+os.environ.setdefault(
+    "MODEL_REGISTRY_STATE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_registry.json")
+)
+
+# Split the cores between workers so their torch thread pools don't oversubscribe the machine
+torch_threads_per_worker = int(os.environ.get("TORCH_THREADS_PER_WORKER", max(1, cpu_count // workers)))
+
+_frozen = False
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far (model included) out of the GC's reach. Otherwise
+    # collections in the workers touch those objects and un-share their memory pages.
+    global _frozen
+    if not _frozen:
+        gc.collect()
+        gc.freeze()
+        _frozen = True
+
+
+def post_fork(server, worker):
+    import waste_classification_api as api
+    api.on_worker_start(torch_threads_per_worker)
+    server.log.info(f"Worker {worker.pid} using {torch_threads_per_worker} torch threads")
+
+
+def post_worker_init(worker):
+    import waste_classification_api as api
+    api.on_worker_ready()
+
+
+def worker_exit(server, worker):
+    import waste_classification_api as api
+    api.on_worker_exit()
@@ -0,0 +1,158 @@
+import io
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image, ImageOps
+
+
+class ImageTooLarge(ValueError):
+    """The image header declares more pixels than the service accepts"""
+
+
+def decode_image(data, target_size=None, max_pixels=None):
+    """Decode uploaded bytes into an upright RGB PIL image.
+
+    For JPEGs, `target_size` (width, height) lets libjpeg decode at a reduced
+    scale (1/2, 1/4 or 1/8) that is still at least that large, so a 12MP
+    photo is never fully decoded just to be resized to 224px. EXIF
+    orientation is applied so phone photos are not classified sideways.
+    Images whose header declares more than `max_pixels` pixels raise
+    ImageTooLarge before any pixel data is decoded.
+    """
+    image = Image.open(io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data)
+    if max_pixels and image.width * image.height > max_pixels:
+        raise ImageTooLarge(f"Image is {image.width}x{image.height}, more than {max_pixels} pixels")
+    if target_size and image.format == "JPEG":
+        width, height = target_size
+        # Rotated photos swap width/height after transposing, so request the larger side for both
+        side = max(width, height)
+        image.draft("RGB", (side, side))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+class FastPreprocessor:
+    """Resize + rescale + normalize with the same settings as a ViT image processor.
+
+    Images are resized with PIL using the processor's size and resample
+    filter. The uint8 pixels are then converted and normalized in one pass
+    into a preallocated float32 buffer (one per thread, grown to the largest
+    batch seen), so there are no per-call allocations of the batch tensor.
+    The returned tensor is a view of that buffer and is only valid until the
+    same thread calls the preprocessor again.
+    """
+
+    def __init__(self, processor):
+        size = processor.size
+        if "height" in size:
+            self.size = (size["width"], size["height"])
+        else:
+            edge = size.get("shortest_edge", 224)
+            self.size = (edge, edge)
+        self.do_resize = getattr(processor, "do_resize", True)
+        self.resample = getattr(processor, "resample", Image.BILINEAR)
+        if not isinstance(self.resample, int):
+            # torchvision InterpolationMode on fast processors
+            self.resample = Image.BILINEAR
+
+        rescale = processor.rescale_factor if getattr(processor, "do_rescale", True) else 1.0
+        if getattr(processor, "do_normalize", True):
+            mean = torch.tensor(processor.image_mean, dtype=torch.float32)
+            std = torch.tensor(processor.image_std, dtype=torch.float32)
+        else:
+            mean = torch.zeros(3)
+            std = torch.ones(3)
+        # (x * rescale - mean) / std == x * scale - shift
+        self._scale = (rescale / std).view(1, 3, 1, 1)
+        self._shift = (mean / std).view(1, 3, 1, 1)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Picklable for datasets.map(num_proc=...); buffers are per process anyway
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _buffer(self, batch_size):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or buffer.shape[0] < batch_size:
+            width, height = self.size
+            buffer = torch.empty((batch_size, 3, height, width), dtype=torch.float32)
+            self._local.buffer = buffer
+        return buffer[:batch_size]
+
+    def resize(self, image):
+        """RGB PIL image -> (3, H, W) uint8 array at the model input size"""
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if self.do_resize and image.size != self.size:
+            image = image.resize(self.size, resample=self.resample)
+        return np.array(image).transpose(2, 0, 1)
+
+    def normalize(self, pixels):
+        """(N, 3, H, W) uint8 tensor from resize() -> new float32 pixel_values tensor"""
+        return pixels.to(torch.float32).mul_(self._scale).sub_(self._shift)
+
+    def __call__(self, images):
+        """Preprocess a list of RGB PIL images into a (N, 3, H, W) pixel_values tensor"""
+        out = self._buffer(len(images))
+        for i, image in enumerate(images):
+            out[i].copy_(torch.from_numpy(self.resize(image)))
+        out.mul_(self._scale).sub_(self._shift)
+        return out
+
+
+def check_parity(processor, fast_preprocessor, images):
+    """Largest absolute difference between the processor and the fast path on `images`"""
+    expected = processor(images=images, return_tensors="pt")["pixel_values"]
+    actual = fast_preprocessor(images)
+    return (expected - actual).abs().max().item()
+
+
+def check_decode_parity(processor, preprocess, classify, jpegs, target_size):
+    """Compare the fast image path with the reference one on encoded `jpegs`, end to end.
+
+    The fast path decodes at a reduced scale for `target_size` and runs
+    `preprocess` (the fast preprocessor or the processor); the reference
+    decodes at full size and runs the processor. Both batches go through
+    `classify` (pixel_values -> logits). Returns the largest absolute
+    difference between the two paths' probabilities and the fraction of
+    images with the same top-1 label.
+    """
+    with torch.no_grad():
+        fast = F.softmax(classify(preprocess([decode_image(data, target_size) for data in jpegs])).float(), dim=1).cpu()
+        full_images = [decode_image(data) for data in jpegs]
+        full = processor(images=full_images, return_tensors="pt")["pixel_values"]
+        full = F.softmax(classify(full).float(), dim=1).cpu()
+    agreement = (fast.argmax(dim=1) == full.argmax(dim=1)).float().mean().item()
+    return (fast - full).abs().max().item(), agreement
+
+
+def parity_jpegs(size=(2048, 1536), count=4, seed=0, quality=90):
+    """Synthetic photos encoded as JPEGs, large enough to be decoded at a reduced scale"""
+    jpegs = []
+    for image in parity_images(size, count, seed):
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality)
+        jpegs.append(buffer.getvalue())
+    return jpegs
+
+
+def parity_images(size=(640, 480), count=2, seed=0):
+    """Deterministic synthetic photos for the startup parity check"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    images = []
+    for _ in range(count):
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+        noise = rng.integers(0, 64, size=(height, width, 3)).astype(np.float32)
+        pixels = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+        images.append(Image.fromarray(pixels, "RGB"))
+    return images
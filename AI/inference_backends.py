@@ -0,0 +1,97 @@
+import os
+import time
+import torch
+
+INFERENCE_BACKENDS = ("eager", "int8", "compile", "onnx")
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Expose only the logits so the classifier exports cleanly to ONNX"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).logits
+
+
+class InferenceBackend:
+    """Run the ViT classifier with one of the supported CPU execution modes.
+
+    - eager:   the fp32 model as loaded (default)
+    - int8:    dynamic int8 quantization of every nn.Linear (weights stored as int8)
+    - compile: torch.compile of the fp32 model
+    - onnx:    export to ONNX once and run it with ONNX Runtime
+
+    Calling the backend with a pixel_values tensor returns the logits tensor.
+    """
+
+    def __init__(self, model, name="eager", device="cpu", onnx_path=None, inplace=True, num_threads=None):
+        if name not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unknown inference backend '{name}', expected one of {', '.join(INFERENCE_BACKENDS)}")
+
+        self.name = name
+        self.device = torch.device(device)
+        self.model = model.eval()
+        self.session = None
+        started = time.perf_counter()
+
+        if name == "int8":
+            if self.device.type != "cpu":
+                raise ValueError("The int8 backend only runs on CPU")
+            # inplace=True swaps the fp32 Linear layers out, so their weights are freed
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=inplace
+            )
+        elif name == "compile":
+            self.model = torch.compile(self.model, dynamic=True)
+        elif name == "onnx":
+            self.session = self._load_onnx(onnx_path, num_threads)
+
+        self.setup_seconds = time.perf_counter() - started
+
+    def _load_onnx(self, onnx_path, num_threads):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError("INFERENCE_BACKEND=onnx needs the onnxruntime package") from e
+
+        if not onnx_path:
+            raise ValueError("The onnx backend needs an onnx_path to export to or load from")
+
+        if not os.path.exists(onnx_path):
+            os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+            image_size = getattr(self.model.config, "image_size", 224)
+            dummy = torch.zeros(1, 3, image_size, image_size)
+            torch.onnx.export(
+                _LogitsOnly(self.model).cpu(),
+                (dummy,),
+                onnx_path,
+                input_names=["pixel_values"],
+                output_names=["logits"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+                opset_version=17
+            )
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = int(num_threads)
+        return onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, pixel_values):
+        if self.session is not None:
+            logits = self.session.run(["logits"], {"pixel_values": pixel_values.cpu().numpy()})[0]
+            return torch.from_numpy(logits)
+
+        with torch.inference_mode():
+            return self.model(pixel_values=pixel_values.to(self.device)).logits
+
+    def describe(self):
+        return {"name": self.name, "setup_seconds": round(self.setup_seconds, 3)}
+
+
+def default_onnx_path(model_name, directory):
+    """Where the ONNX export of `model_name` is cached"""
+    return os.path.join(directory, model_name.replace("/", "__") + ".onnx")
@@ -0,0 +1,137 @@
+import os
+import gc
+import sys
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes():
+    """Current resident set size of this process, or None where it can't be read"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """Highest resident set size this process has reached, as reported by the OS"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryManager:
+    """Run garbage collection off the request path and track memory use.
+
+    A background thread samples RSS every `interval` seconds and runs a full
+    collection when RSS has grown by `growth_mb` since the last one, or at
+    least every `max_interval` seconds. Requests never pay for a collection.
+    Objects frozen with gc.freeze() (the preloaded model) are not scanned.
+    """
+
+    def __init__(self, interval=5.0, growth_mb=64, max_interval=300.0, empty_cuda_cache=False):
+        self.interval = max(0.1, float(interval))
+        self.growth_bytes = int(float(growth_mb) * 1024 * 1024)
+        self.max_interval = float(max_interval)
+        self.empty_cuda_cache = empty_cuda_cache
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+        self._baseline = None
+        self._high_water = 0
+        self._last_collection = time.monotonic()
+        self._collections = 0
+        self._collected_objects = 0
+        self._last_collection_ms = 0.0
+        self._total_collection_ms = 0.0
+
+    def start(self):
+        # The sampler thread does not survive a fork, so restart it per process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self._pid is not None and self._pid != os.getpid():
+            # The lock may have been held by the parent's thread at fork time
+            self._lock = threading.Lock()
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stop = threading.Event()
+                self._baseline = rss_bytes()
+                self._high_water = self._baseline or 0
+                self._last_collection = time.monotonic()
+                self._thread = threading.Thread(target=self._run, name="memory-manager", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.warning("Memory check failed: %s", e)
+
+    def check(self):
+        """Sample RSS and collect if it has grown too much or it has been a while"""
+        rss = rss_bytes()
+        if rss is None:
+            return
+        with self._lock:
+            self._high_water = max(self._high_water, rss)
+            grown = self._baseline is not None and rss - self._baseline >= self.growth_bytes
+            due = time.monotonic() - self._last_collection >= self.max_interval
+        if grown or due:
+            self.collect(reason="growth" if grown else "interval")
+
+    def collect(self, reason="manual"):
+        started = time.perf_counter()
+        collected = gc.collect()
+        if self.empty_cuda_cache:
+            import torch
+            torch.cuda.empty_cache()
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        rss = rss_bytes()
+        with self._lock:
+            self._baseline = rss
+            self._last_collection = time.monotonic()
+            self._collections += 1
+            self._collected_objects += collected
+            self._last_collection_ms = elapsed_ms
+            self._total_collection_ms += elapsed_ms
+        logger.debug("GC (%s) collected %d objects in %.1fms, RSS now %s", reason, collected, elapsed_ms, rss)
+        return collected
+
+    def stats(self):
+        rss = rss_bytes()
+        with self._lock:
+            if rss is not None:
+                self._high_water = max(self._high_water, rss)
+            return {
+                "rss_mb": round(rss / 1048576, 1) if rss is not None else None,
+                "rss_high_water_mb": round(self._high_water / 1048576, 1),
+                "peak_rss_mb": round(peak_rss_bytes() / 1048576, 1) if resource is not None else None,
+                "baseline_rss_mb": round(self._baseline / 1048576, 1) if self._baseline is not None else None,
+                "collections": self._collections,
+                "collected_objects": self._collected_objects,
+                "last_collection_ms": round(self._last_collection_ms, 2),
+                "total_collection_ms": round(self._total_collection_ms, 2),
+                "gc_counts": gc.get_count(),
+                "gc_frozen": gc.get_freeze_count(),
+            }
@@ -0,0 +1,206 @@
+import os
+import time
+import random
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, [list(s[0]), s[1], s[2]]) for labels, s in self._series.items())
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = ("le", _format_value(bound) if bound != float("inf") else "+Inf")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Minimal Prometheus text-format registry (counters, histograms and scrape-time gauges)"""
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(f"{self.namespace}_{name}", documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(f"{self.namespace}_{name}", documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_gauges(self, collector):
+        """Register a function returning {name: value} (or {name: (documentation, value)}) read at scrape time"""
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                gauges = collector()
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+                continue
+            for name, value in gauges.items():
+                documentation = name
+                if isinstance(value, tuple):
+                    documentation, value = value
+                if value is None:
+                    continue
+                full_name = f"{self.namespace}_{name}"
+                lines.append(f"# HELP {full_name} {documentation}")
+                lines.append(f"# TYPE {full_name} gauge")
+                lines.append(f"{full_name} {_format_value(float(value))}")
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Per-request stage timings, observed into a histogram as each stage finishes"""
+
+    def __init__(self, histogram=None):
+        self.histogram = histogram
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self.histogram is not None:
+            self.histogram.observe(seconds, name)
+
+    def as_ms(self):
+        return {name: round(seconds * 1000.0, 2) for name, seconds in self.stages.items()}
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+class SlowRequestProfiler:
+    """Profile a random sample of requests with cProfile and keep the profiles of slow ones.
+
+    Profiles cover the request thread only; work done inside the micro-batcher
+    thread shows up as time spent waiting for the batch.
+    """
+
+    def __init__(self, sample_rate=0.0, slow_ms=1000.0, output_dir="profiles"):
+        self.sample_rate = float(sample_rate)
+        self.slow_seconds = float(slow_ms) / 1000.0
+        self.output_dir = output_dir
+        self.saved = 0
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def start(self):
+        """Return a running profiler if this request is sampled, else None"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return None
+        return profiler
+
+    def finish(self, profiler, seconds, label):
+        if profiler is None:
+            return
+        profiler.disable()
+        if seconds < self.slow_seconds:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir,
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{label.strip('/').replace('/', '_') or 'root'}-{int(seconds * 1000)}ms.prof"
+        )
+        profiler.dump_stats(path)
+        self.saved += 1
+        logger.warning("Slow request %s took %.0fms, profile saved to %s", label, seconds * 1000.0, path)
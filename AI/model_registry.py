@@ -0,0 +1,500 @@
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_MODES = ("ab", "shadow")
+# Seconds before a failed load is retried, doubled after each failure up to the maximum
+LOAD_RETRY_SECONDS = 30.0
+LOAD_RETRY_MAX_SECONDS = 1800.0
+# Weight files whose size and modification time identify a local checkpoint
+_WEIGHT_FILES = ("model.safetensors", "pytorch_model.bin", "config.json")
+
+
+def model_key(source, revision=None):
+    """Registry key of a model: its source (hub name or directory), plus the revision if pinned"""
+    return f"{source}@{revision}" if revision else source
+
+
+def version_id(source, revision=None, config=None, local_dir=None):
+    """The exact version of a loaded model, as recorded in submissions.
+
+    A pinned revision or the hub commit hash when known, otherwise a
+    fingerprint of the checkpoint files in `local_dir`.
+    """
+    if revision:
+        return f"{source}@{revision}"
+    commit = getattr(config, "_commit_hash", None)
+    if commit:
+        return f"{source}@{commit[:12]}"
+    if local_dir and os.path.isdir(local_dir):
+        digest = hashlib.sha1()
+        for name in _WEIGHT_FILES:
+            path = os.path.join(local_dir, name)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                digest.update(f"{name}:{stat.st_size}:{int(stat.st_mtime)}".encode())
+        return f"{source}@{digest.hexdigest()[:12]}"
+    return source
+
+
+def model_bytes(model):
+    """Approximate memory held by a model's weights and buffers (int8 packed weights included)"""
+    def size(value):
+        if hasattr(value, "element_size") and hasattr(value, "nelement"):
+            return value.element_size() * value.nelement()
+        if isinstance(value, (tuple, list)):
+            return sum(size(item) for item in value)
+        return 0
+
+    return sum(size(value) for value in model.state_dict().values())
+
+
+class ModelVersion:
+    """A loaded, warmed-up model and everything needed to run it"""
+
+    def __init__(self, key, version, inference, id2label, processor=None, fast_preprocessor=None,
+                 near_duplicates=None, embedding_hook=None, cascade=None, timings=None, fast_decode=True):
+        self.key = key
+        self.version = version
+        self.inference = inference
+        self.id2label = id2label
+        self.processor = processor
+        self.fast_preprocessor = fast_preprocessor
+        # Reduced-scale JPEG decoding, turned off if it changes this model's predictions
+        self.fast_decode = fast_decode
+        self.near_duplicates = near_duplicates
+        self.embedding_hook = embedding_hook
+        self.cascade = cascade
+        self.timings = timings or {}
+        self.memory_bytes = model_bytes(inference.model)
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+
+    def describe(self):
+        return {
+            "version": self.version,
+            "inference_backend": self.inference.describe(),
+            "fast_decode": self.fast_decode,
+            "fast_preprocess": self.fast_preprocessor is not None,
+            "near_duplicates": self.near_duplicates.stats() if self.near_duplicates is not None else None,
+            "cascade": self.cascade.stats() if self.cascade is not None else None,
+            "memory_mb": round(self.memory_bytes / 1048576, 1),
+            "load_seconds": self.timings,
+            "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.loaded_at)),
+        }
+
+
+class ModelRegistry:
+    """The models resident in this process, which one serves, and where test traffic goes.
+
+    Changes are made to a desired state: the resident models, the active
+    one, and a traffic split that sends `percent` of requests to a
+    candidate (`ab`) or also runs them on it for comparison (`shadow`).
+    A background thread brings the process in line with it: new models are
+    loaded and warmed up by `loader(source, revision, options)`, and the
+    active model is swapped in one assignment, so requests never wait for a
+    load and in-flight requests finish on the model they started with.
+
+    At most `max_resident` models are kept, and no more than
+    `memory_budget_mb` of weights; the least recently used idle models
+    make room. With `state_path`, the desired state is also written to a
+    file that every process polls, so all gunicorn workers follow an admin
+    call that reached only one of them, and the state survives restarts.
+
+    The thread is started by `start()` or by the first `route()` in each
+    process, never by `boot()`: a gunicorn master that preloads the model
+    must not hot-load further versions into memory its workers inherit.
+    Each worker therefore holds its own copy of a hot-loaded version.
+
+    A failed load is recorded in this process only and retried with
+    backoff; the desired state is left to the operator, since another
+    worker may have loaded the same model.
+    """
+
+    def __init__(self, loader, max_resident=2, memory_budget_mb=0, state_path=None, poll_interval=10.0,
+                 on_unload=None):
+        self.loader = loader
+        self.max_resident = max(1, int(max_resident))
+        self.memory_budget = int(float(memory_budget_mb) * 1024 * 1024)
+        self.state_path = state_path or None
+        self.poll_interval = max(0.5, float(poll_interval))
+        self.on_unload = on_unload
+
+        self.versions = {}
+        self.active = None
+        self.traffic = {"model": None, "percent": 0.0, "mode": "ab"}
+        self.desired = {"models": {}, "active": None, "traffic": dict(self.traffic)}
+        self.failed = {}
+        # key -> (failed attempts, time.monotonic() of the next attempt)
+        self._retries = {}
+        self.loading = None
+        self.swaps = 0
+        self._counters = {}
+        self._state_mtime = None
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    # --- Desired state ---
+    def boot(self, source, revision=None, options=None):
+        """Load the state file if there is one, else serve `source`; then load the active model here"""
+        key = model_key(source, revision)
+        initial = {
+            "models": {key: {"source": source, "revision": revision, "options": options or {}}},
+            "active": key,
+            "traffic": {"model": None, "percent": 0.0, "mode": "ab"},
+        }
+        state = self._read_state()
+        if state is not None:
+            logger.info("Model registry state from %s: active %s", self.state_path, state["active"])
+        self.desired = state or initial
+        self.reconcile()
+        if self.active is None and state is not None:
+            logger.error("Could not load %s from the registry state, falling back to %s", state["active"], key)
+            self.desired = initial
+            self.reconcile()
+        if self.active is None:
+            raise RuntimeError(f"Could not load {self.desired['active']}: {self.failed.get(self.desired['active'])}")
+
+    def add(self, source, revision=None, activate=False, options=None):
+        """Load a model in the background (and make it the active one once it is warmed up)"""
+        key = model_key(source, revision)
+        with self._lock:
+            desired = self._copy_desired()
+            busy = {desired["active"], desired["traffic"]["model"]} - {None, key}
+            if not activate and len(busy) >= self.max_resident:
+                raise ValueError(f"All {self.max_resident} resident model slots are in use (MODEL_MAX_RESIDENT)")
+            desired["models"][key] = {"source": source, "revision": revision, "options": options or {}}
+            if activate:
+                desired["active"] = key
+            self.failed.pop(key, None)
+            self._retries.pop(key, None)
+            self._set_desired(desired)
+        return key
+
+    def activate(self, key):
+        with self._lock:
+            if key not in self.desired["models"]:
+                raise KeyError(key)
+            desired = self._copy_desired()
+            desired["active"] = key
+            if desired["traffic"]["model"] == key:
+                desired["traffic"] = {"model": None, "percent": 0.0, "mode": "ab"}
+            self._set_desired(desired)
+
+    def remove(self, key):
+        with self._lock:
+            if key not in self.desired["models"]:
+                raise KeyError(key)
+            if key == self.desired["active"]:
+                raise ValueError(f"{key} is the active model; activate another one first")
+            self._set_desired(self._without(self._copy_desired(), key))
+
+    def set_traffic(self, key, percent, mode="ab"):
+        """Send `percent` of requests to `key` (`ab`), or run them on it as well (`shadow`); 0 stops"""
+        percent = float(percent)
+        if mode not in TRAFFIC_MODES:
+            raise ValueError(f"Unknown traffic mode '{mode}', expected one of {', '.join(TRAFFIC_MODES)}")
+        if not 0 <= percent <= 100:
+            raise ValueError("percent must be between 0 and 100")
+        with self._lock:
+            if percent > 0 and key not in self.desired["models"]:
+                raise KeyError(key)
+            if percent > 0 and key == self.desired["active"]:
+                raise ValueError(f"{key} is already the active model")
+            desired = self._copy_desired()
+            desired["traffic"] = {"model": key if percent > 0 else None, "percent": percent, "mode": mode}
+            self._set_desired(desired)
+
+    def _copy_desired(self):
+        return json.loads(json.dumps(self.desired))
+
+    def _without(self, desired, key):
+        """`desired` minus `key`; the active model falls back to the one serving now"""
+        desired["models"].pop(key, None)
+        if desired["traffic"]["model"] == key:
+            desired["traffic"] = {"model": None, "percent": 0.0, "mode": "ab"}
+        if desired["active"] == key and self.active is not None and self.active.key != key:
+            desired["active"] = self.active.key
+        return desired
+
+    def _set_desired(self, desired):
+        # Called with the lock held; the reconcile thread picks the change up
+        self.desired = desired
+        self._write_state(desired)
+        self._wake.set()
+
+    def _read_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            self._state_mtime = os.stat(self.state_path).st_mtime
+            return state
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read registry state %s: %s", self.state_path, e)
+            return None
+
+    def _write_state(self, state):
+        if not self.state_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(temp_path, self.state_path)
+        self._state_mtime = os.stat(self.state_path).st_mtime
+
+    # --- Background reconciliation ---
+    def start(self):
+        # The reconcile thread does not survive a fork, so restart it per process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self._pid is not None and self._pid != os.getpid():
+            # Locks may have been held by the parent's threads at fork time
+            self._lock = threading.Lock()
+            self._reconcile_lock = threading.Lock()
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._wake = threading.Event()
+                self._thread = threading.Thread(target=self._run, name="model-registry", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            woken = self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                if woken or self._state_changed() or self._retry_due():
+                    self.reconcile()
+            except Exception as e:
+                logger.exception("Model registry update failed: %s", e)
+
+    def _state_changed(self):
+        """Pick up a desired state written by another process"""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return False
+        if os.stat(self.state_path).st_mtime == self._state_mtime:
+            return False
+        state = self._read_state()
+        if state is None:
+            return False
+        logger.info("Model registry state changed on disk: active %s", state["active"])
+        with self._lock:
+            self.desired = state
+            # A new admin call is worth another attempt at models that failed here
+            self._retries.clear()
+        return True
+
+    def _retry_due(self):
+        """A model that failed to load here is wanted again and its backoff has passed"""
+        return any(key in self.desired["models"] and not self._backing_off(key) for key in list(self._retries))
+
+    def _backing_off(self, key):
+        retry = self._retries.get(key)
+        return retry is not None and time.monotonic() < retry[1]
+
+    def reconcile(self):
+        """Unload, load and swap until this process matches the desired state"""
+        with self._reconcile_lock:
+            self._unload_unwanted()
+            # The active model first, so a swap doesn't wait for other loads
+            desired = self.desired
+            order = [desired["active"], desired["traffic"]["model"]] + list(desired["models"])
+            for key in dict.fromkeys(order):
+                # Re-checked each time: a load may have evicted or dropped models
+                spec = self.desired["models"].get(key)
+                if spec is not None and key not in self.versions and not self._backing_off(key):
+                    self._load(key, spec)
+                self._swap()
+
+            with self._lock:
+                self.traffic = dict(self.desired["traffic"])
+            # The previous active model can go once it has been swapped out
+            self._unload_unwanted()
+
+    def _swap(self):
+        with self._lock:
+            active = self.versions.get(self.desired["active"])
+            if active is None or active is self.active:
+                return
+            previous = self.active
+            # Requests already routed keep their reference to the previous model
+            self.active = active
+            self.swaps += 1
+        logger.info("Active model is now %s (was %s)", active.version, previous.version if previous else None)
+
+    def _unload_unwanted(self):
+        for key in [key for key in self.versions if key not in self.desired["models"]]:
+            self._unload(key)
+
+    def _load(self, key, spec):
+        self.loading = key
+        logger.info("Loading model %s", key)
+        started = time.perf_counter()
+        try:
+            version = self.loader(spec["source"], spec.get("revision"), spec.get("options") or {})
+        except Exception as e:
+            with self._lock:
+                attempts = self._retries.get(key, (0, 0))[0] + 1
+                delay = min(LOAD_RETRY_SECONDS * 2 ** (attempts - 1), LOAD_RETRY_MAX_SECONDS)
+                self.failed[key] = str(e)
+                self._retries[key] = (attempts, time.monotonic() + delay)
+            logger.exception("Loading %s failed (attempt %d, retrying in %.0fs): %s", key, attempts, delay, e)
+            return
+        finally:
+            self.loading = None
+
+        with self._lock:
+            self.failed.pop(key, None)
+            self._retries.pop(key, None)
+            self.versions[key] = version
+            self._counters.setdefault(key, {"served": 0, "shadowed": 0, "shadow_agreed": 0, "shadow_errors": 0})
+        logger.info(
+            "Loaded %s as %s in %.1fs (%.0f MB)",
+            key, version.version, time.perf_counter() - started, version.memory_bytes / 1048576
+        )
+        self._make_room(key)
+
+    def _make_room(self, new_key):
+        """Evict least recently used idle models until max_resident and the memory budget hold again.
+
+        Eviction waits until `new_key` has loaded, so a failed load never
+        costs a working model; a load needs room for one more model.
+        """
+        with self._lock:
+            desired = self._copy_desired()
+            protected = {desired["active"], desired["traffic"]["model"], new_key}
+            if self.active is not None:
+                protected.add(self.active.key)
+            count = len(self.versions)
+            total = self.resident_bytes()
+
+            def over():
+                return count > self.max_resident or (self.memory_budget and total > self.memory_budget)
+
+            idle = sorted((v for k, v in self.versions.items() if k not in protected), key=lambda v: v.last_used)
+            for version in idle:
+                if not over():
+                    break
+                logger.info("Evicting %s to make room for %s", version.key, new_key)
+                desired["models"].pop(version.key, None)
+                count -= 1
+                total -= version.memory_bytes
+            if over() and new_key != desired["active"]:
+                logger.error("%s does not fit in MODEL_MAX_RESIDENT / MODEL_MEMORY_BUDGET_MB", new_key)
+                self.failed[new_key] = "Does not fit in MODEL_MAX_RESIDENT / MODEL_MEMORY_BUDGET_MB"
+                desired = self._without(desired, new_key)
+            if desired != self.desired:
+                self._set_desired(desired)
+        self._unload_unwanted()
+
+    def _unload(self, key):
+        with self._lock:
+            version = self.versions.get(key)
+            if version is None or version is self.active:
+                return
+            del self.versions[key]
+        logger.info("Unloaded model %s", version.version)
+        if self.on_unload is not None:
+            self.on_unload()
+
+    # --- Request path ---
+    def route(self, routing_key=None):
+        """(version that answers, version to shadow or None) for one request.
+
+        The same `routing_key` (for example a hashed user token) always
+        lands on the same side of the split.
+        """
+        # Serving a request means this is a worker, so the reconcile thread may run here
+        self.start()
+        active = self.active
+        traffic = self.traffic
+        candidate = self.versions.get(traffic["model"]) if traffic["percent"] > 0 else None
+        if candidate is None or candidate is active:
+            return active, None
+        if routing_key:
+            bucket = int(hashlib.sha1(routing_key.encode()).hexdigest()[:8], 16) % 10000 / 100.0
+        else:
+            bucket = random.random() * 100.0
+        if bucket >= traffic["percent"]:
+            return active, None
+        if traffic["mode"] == "shadow":
+            return active, candidate
+        return candidate, None
+
+    def record(self, version, count=1):
+        version.last_used = time.monotonic()
+        with self._lock:
+            counters = self._counters.get(version.key)
+            if counters is not None:
+                counters["served"] += count
+
+    def record_shadow(self, version, primary_label, shadow_label=None, error=False):
+        version.last_used = time.monotonic()
+        with self._lock:
+            counters = self._counters.get(version.key)
+            if counters is None:
+                return
+            counters["shadowed"] += 1
+            if error:
+                counters["shadow_errors"] += 1
+            elif shadow_label == primary_label:
+                counters["shadow_agreed"] += 1
+
+    def resident_bytes(self):
+        return sum(version.memory_bytes for version in list(self.versions.values()))
+
+    def describe(self):
+        with self._lock:
+            versions = dict(self.versions)
+            counters = {key: dict(value) for key, value in self._counters.items()}
+            desired = self.desired
+        models = {}
+        for key, spec in desired["models"].items():
+            if key in versions:
+                entry = {"status": "active" if versions[key] is self.active else "loaded", **versions[key].describe()}
+            elif key == self.loading:
+                entry = {"status": "loading"}
+            elif key in self.failed:
+                entry = {"status": "failed", "error": self.failed[key]}
+                retry = self._retries.get(key)
+                if retry is not None:
+                    entry["attempts"] = retry[0]
+                    entry["retry_in_s"] = round(max(0.0, retry[1] - time.monotonic()), 1)
+            else:
+                entry = {"status": "pending"}
+            entry.update({"source": spec["source"], "revision": spec.get("revision")})
+            stats = counters.get(key)
+            if stats:
+                entry["stats"] = stats
+                if stats["shadowed"]:
+                    entry["stats"]["shadow_agreement"] = round(
+                        stats["shadow_agreed"] / max(1, stats["shadowed"] - stats["shadow_errors"]), 4
+                    )
+            models[key] = entry
+        # Models dropped because they did not fit stay listed here
+        for key, error in list(self.failed.items()):
+            models.setdefault(key, {"status": "failed", "error": error})
+        return {
+            "active": self.active.version if self.active is not None else None,
+            "active_model": desired["active"],
+            "traffic": desired["traffic"],
+            "models": models,
+            "resident": len(versions),
+            "resident_mb": round(self.resident_bytes() / 1048576, 1),
+            "max_resident": self.max_resident,
+            "memory_budget_mb": round(self.memory_budget / 1048576, 1) if self.memory_budget else None,
+            "swaps": self.swaps,
+            "state_path": self.state_path,
+        }
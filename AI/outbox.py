@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import deque
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    submission_id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    auth_ref TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS submissions_due ON submissions (status, next_attempt_at);
+CREATE TABLE IF NOT EXISTS auth_tokens (
+    auth_ref TEXT PRIMARY KEY,
+    auth_header TEXT NOT NULL
+);
+"""
+
+
+def auth_reference(auth_header):
+    """Stable reference for an Authorization header, so submissions don't repeat the token"""
+    return hashlib.sha256(auth_header.encode("utf-8")).hexdigest()
+
+
+class Outbox:
+    """Durable SQLite outbox for backend submissions.
+
+    Every submission is written here before it is queued for delivery and
+    stays `pending` until the backend accepts it. Pending rows survive
+    restarts and are handed out again by `claim_due()` in batches. Claiming
+    pushes `next_attempt_at` forward by `lease` seconds inside a write
+    transaction, so several worker processes sharing the file never replay
+    the same row at once. Submission ids are the primary key, which makes
+    re-submitting the same id a no-op.
+    """
+
+    def __init__(self, path, lease=60.0, retention_hours=24.0, stats_window=600.0):
+        self.path = path
+        self.lease = float(lease)
+        self.retention = float(retention_hours) * 3600.0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats_window = stats_window
+        self._delivered_times = deque()
+        self._counters = {"added": 0, "duplicates": 0, "delivered": 0, "rejected": 0, "replayed": 0}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        # One connection per thread and per process; sqlite3 handles must not cross a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    def add(self, submissions, auth_header):
+        """Store submissions as pending and claimed; returns the ids that were not already known"""
+        now = time.time()
+        auth_ref = auth_reference(auth_header)
+        added = []
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO auth_tokens (auth_ref, auth_header) VALUES (?, ?)",
+                (auth_ref, auth_header)
+            )
+            for submission in submissions:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO submissions "
+                    "(submission_id, payload, auth_ref, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+                    (submission["submission_id"], json.dumps(submission), auth_ref, now, now + self.lease)
+                )
+                if cursor.rowcount:
+                    added.append(submission["submission_id"])
+
+        with self._lock:
+            self._counters["added"] += len(added)
+            self._counters["duplicates"] += len(submissions) - len(added)
+        return added
+
+    def claim_due(self, limit):
+        """Claim up to `limit` pending submissions whose retry time has come.
+
+        Returns a list of (auth_header, submissions) grouped by token.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT s.submission_id, s.payload, t.auth_header FROM submissions s "
+                "JOIN auth_tokens t ON t.auth_ref = s.auth_ref "
+                "WHERE s.status = 'pending' AND s.next_attempt_at <= ? "
+                "ORDER BY s.created_at LIMIT ?",
+                (now, int(limit))
+            ).fetchall()
+            conn.executemany(
+                "UPDATE submissions SET next_attempt_at = ? WHERE submission_id = ?",
+                [(now + self.lease, row[0]) for row in rows]
+            )
+
+        groups = {}
+        for _, payload, auth_header in rows:
+            groups.setdefault(auth_header, []).append(json.loads(payload))
+
+        with self._lock:
+            self._counters["replayed"] += len(rows)
+        return list(groups.items())
+
+    def mark_delivered(self, submission_ids):
+        self._finish(submission_ids, "delivered")
+
+    def mark_rejected(self, submission_ids):
+        self._finish(submission_ids, "rejected")
+
+    def _finish(self, submission_ids, status):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE submissions SET status = ?, finished_at = ?, attempts = attempts + 1 WHERE submission_id = ?",
+                [(status, now, submission_id) for submission_id in submission_ids]
+            )
+        with self._lock:
+            self._counters[status] += len(submission_ids)
+            if status == "delivered":
+                self._delivered_times.extend([time.monotonic()] * len(submission_ids))
+
+    def mark_failed(self, submission_ids, retry_in):
+        """Leave submissions pending and make them due again after `retry_in` seconds"""
+        next_attempt_at = time.time() + retry_in
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE submissions SET next_attempt_at = ?, attempts = attempts + 1 WHERE submission_id = ?",
+                [(next_attempt_at, submission_id) for submission_id in submission_ids]
+            )
+
+    def prune(self):
+        """Drop finished rows past the retention window and tokens nothing pending refers to"""
+        cutoff = time.time() - self.retention
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM submissions WHERE status != 'pending' AND finished_at < ?", (cutoff,))
+            conn.execute(
+                "DELETE FROM auth_tokens WHERE auth_ref NOT IN "
+                "(SELECT auth_ref FROM submissions WHERE status = 'pending')"
+            )
+
+    def stats(self):
+        """Backlog size and age plus delivery throughput for /health"""
+        pending, oldest = self._conn().execute(
+            "SELECT COUNT(*), MIN(created_at) FROM submissions WHERE status = 'pending'"
+        ).fetchone()
+
+        with self._lock:
+            horizon = time.monotonic() - self._stats_window
+            while self._delivered_times and self._delivered_times[0] < horizon:
+                self._delivered_times.popleft()
+            recent = len(self._delivered_times)
+            counters = dict(self._counters)
+
+        return {
+            "path": self.path,
+            "pending": pending,
+            "oldest_pending_age_s": round(time.time() - oldest, 1) if oldest else 0.0,
+            "delivered_per_min": round(recent * 60.0 / self._stats_window, 2),
+            **counters,
+        }
+
+
+class _Transaction:
+    """Run a block of statements in one IMMEDIATE transaction on an autocommit connection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
@@ -0,0 +1,372 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    namespace TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    phash INTEGER,
+    label TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    probabilities TEXT,
+    near_duplicate TEXT,
+    width INTEGER,
+    height INTEGER,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (namespace, digest)
+);
+CREATE INDEX IF NOT EXISTS predictions_phash ON predictions (namespace, phash);
+CREATE INDEX IF NOT EXISTS predictions_created ON predictions (created_at);
+"""
+
+# Columns added after the first release, created on older cache files
+_ADDED_COLUMNS = {"probabilities": "TEXT", "near_duplicate": "TEXT", "width": "INTEGER", "height": "INTEGER"}
+
+# Largest Hamming distance for near perceptual matches; the hash is split into distance + 1 blocks of >= 4 bits
+MAX_PHASH_DISTANCE = 15
+# Candidates compared per near perceptual lookup, so a crowded bucket can't turn it into a scan
+MAX_PHASH_CANDIDATES = 256
+
+logger = logging.getLogger(__name__)
+
+
+def content_digest(data):
+    """SHA-256 of the raw uploaded bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_dhash(image, hash_size=8):
+    """64-bit difference hash of a PIL image; stable across re-encoding and resizing"""
+    small = image.convert("L").resize((hash_size + 1, hash_size))
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _encode_probabilities(probabilities):
+    return json.dumps(list(probabilities)) if probabilities is not None else None
+
+
+def _decode_probabilities(text):
+    return tuple(json.loads(text)) if text else None
+
+
+def _encode_near_duplicate(near_duplicate):
+    return json.dumps(near_duplicate) if near_duplicate is not None else None
+
+
+def _decode_near_duplicate(text):
+    return json.loads(text) if text else None
+
+
+def _phash_blocks(phash, count):
+    """(block number, bits) for `count` slices of a 64-bit hash.
+
+    Two hashes within count - 1 bits of each other agree on at least one
+    block, so near matches are found by looking up each block.
+    """
+    width = -(-64 // count)
+    mask = (1 << width) - 1
+    return [(block, (phash >> (block * width)) & mask) for block in range(count)]
+
+
+def _signed64(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value is not None and value >= (1 << 63) else value
+
+
+def _unsigned64(value):
+    return value + (1 << 64) if value is not None and value < 0 else value
+
+
+class PredictionCache:
+    """LRU cache of predictions keyed by upload content.
+
+    Entries are keyed by (namespace, SHA-256 of the raw bytes); the namespace
+    is the model version so a new model never serves old predictions. When a
+    perceptual hash and the image size are supplied, re-encoded copies of the
+    same photo match too: with the same size and hash when `phash_distance`
+    is 0, otherwise the nearest hash within that Hamming distance, among the
+    entries that share one block of the hash with it (at most
+    MAX_PHASH_CANDIDATES are compared). With `path`, entries
+    are also written to SQLite and looked up there on a memory miss, so the
+    cache survives restarts. Each entry holds the label, the confidence, the
+    per-label probabilities (None when they are not known) and the
+    near-duplicate match the prediction came with (None when there was none).
+
+    The SQLite tier keeps at most `max_rows` rows (0 = no limit): every
+    `trim_every` puts, the oldest rows beyond it are deleted. After `start()`,
+    a background thread deletes expired rows every `prune_interval` seconds.
+    """
+
+    def __init__(self, max_entries=10000, ttl=86400.0, path=None, phash_distance=0, max_rows=100000, trim_every=64,
+                 prune_interval=600.0):
+        if not 0 <= int(phash_distance) <= MAX_PHASH_DISTANCE:
+            raise ValueError(f"The perceptual hash distance must be between 0 and {MAX_PHASH_DISTANCE}")
+        self.max_entries = max(1, int(max_entries))
+        self.max_rows = max(0, int(max_rows))
+        self.trim_every = max(1, int(trim_every))
+        self._puts = 0
+        self.ttl = float(ttl)
+        self.path = path
+        self.phash_distance = int(phash_distance)
+        self.prune_interval = float(prune_interval)
+        self._entries = OrderedDict()
+        self._phash_index = {}
+        self._phash_buckets = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+        self._pid = None
+        self._counters = {
+            "hits": 0,
+            "perceptual_hits": 0,
+            "persistent_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "pruned_rows": 0,
+            "trimmed_rows": 0,
+        }
+
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = self._conn()
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(predictions)")}
+            for column, column_type in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE predictions ADD COLUMN {column} {column_type}")
+
+    def _conn(self):
+        # One connection per thread and per process; sqlite3 handles must not cross a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace, digest):
+        """Look up an exact upload; returns (label, confidence, probabilities, near_duplicate) or None"""
+        key = (namespace, digest)
+        with self._lock:
+            entry = self._fresh(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return entry[0], entry[1], entry[4], entry[5]
+
+        if self.path:
+            row = self._conn().execute(
+                "SELECT phash, label, confidence, created_at, probabilities, near_duplicate, width, height "
+                "FROM predictions WHERE namespace = ? AND digest = ?",
+                key
+            ).fetchone()
+            if row is not None and time.time() - row[3] < self.ttl:
+                probabilities, near_duplicate = _decode_probabilities(row[4]), _decode_near_duplicate(row[5])
+                size = (row[6], row[7]) if row[6] is not None else None
+                self._remember(key, _unsigned64(row[0]), size, row[1], row[2], probabilities, near_duplicate, row[3])
+                with self._lock:
+                    self._counters["hits"] += 1
+                    self._counters["persistent_hits"] += 1
+                return row[1], row[2], probabilities, near_duplicate
+        return None
+
+    def get_similar(self, namespace, phash, size):
+        """Look up a perceptually identical (or near) image of the same (width, height).
+
+        Returns (label, confidence, probabilities, near_duplicate) or None.
+        """
+        size = tuple(size)
+        match = None
+        with self._lock:
+            key = self._phash_index.get((namespace, phash, size))
+            if key is None and self.phash_distance:
+                key = self._nearest(namespace, phash, size)
+            entry = self._fresh(key) if key is not None else None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._counters["perceptual_hits"] += 1
+                match = (entry[0], entry[1], entry[4], entry[5])
+
+        if match is None and self.path and not self.phash_distance:
+            row = self._conn().execute(
+                "SELECT digest, label, confidence, created_at, probabilities, near_duplicate FROM predictions "
+                "WHERE namespace = ? AND phash = ? AND width = ? AND height = ? ORDER BY created_at DESC LIMIT 1",
+                (namespace, _signed64(phash), size[0], size[1])
+            ).fetchone()
+            if row is not None and time.time() - row[3] < self.ttl:
+                probabilities, near_duplicate = _decode_probabilities(row[4]), _decode_near_duplicate(row[5])
+                self._remember((namespace, row[0]), phash, size, row[1], row[2], probabilities, near_duplicate, row[3])
+                with self._lock:
+                    self._counters["perceptual_hits"] += 1
+                    self._counters["persistent_hits"] += 1
+                match = (row[1], row[2], probabilities, near_duplicate)
+
+        if match is None:
+            with self._lock:
+                self._counters["misses"] += 1
+        return match
+
+    def _nearest(self, namespace, phash, size):
+        # Caller holds the lock
+        best, key, compared = self.phash_distance + 1, None, 0
+        for block in _phash_blocks(phash, self.phash_distance + 1):
+            for candidate in self._phash_buckets.get((namespace, size) + block, ()):
+                distance = bin(phash ^ self._entries[candidate][3]).count("1")
+                if distance < best:
+                    best, key = distance, candidate
+                compared += 1
+                if compared >= MAX_PHASH_CANDIDATES:
+                    return key
+        return key
+
+    def miss(self):
+        """Record a miss for an upload that was not checked perceptually"""
+        with self._lock:
+            self._counters["misses"] += 1
+
+    def put(self, namespace, digest, phash, label, confidence, probabilities=None, near_duplicate=None, size=None):
+        """Store a prediction; `phash` and `size` ((width, height) of the image) make it a perceptual match target"""
+        created_at = time.time()
+        if probabilities is not None:
+            probabilities = tuple(probabilities)
+        size = tuple(size) if size is not None else None
+        self._remember((namespace, digest), phash, size, label, confidence, probabilities, near_duplicate, created_at)
+        if self.path:
+            width, height = size if size is not None else (None, None)
+            self._conn().execute(
+                "INSERT OR REPLACE INTO predictions "
+                "(namespace, digest, phash, label, confidence, probabilities, near_duplicate, width, height, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    namespace, digest, _signed64(phash), label, confidence,
+                    _encode_probabilities(probabilities), _encode_near_duplicate(near_duplicate),
+                    width, height, created_at
+                )
+            )
+            with self._lock:
+                self._puts += 1
+                trim = self.max_rows and self._puts % self.trim_every == 0
+            if trim:
+                self.trim()
+
+    def _remember(self, key, phash, size, label, confidence, probabilities, near_duplicate, created_at):
+        with self._lock:
+            self._drop(key)
+            if size is None:
+                # Without the dimensions an entry is only found by its exact content
+                phash = None
+            self._entries[key] = (label, confidence, created_at, phash, probabilities, near_duplicate, size)
+            if phash is not None:
+                self._phash_index[(key[0], phash, size)] = key
+                if self.phash_distance:
+                    for block in _phash_blocks(phash, self.phash_distance + 1):
+                        self._phash_buckets.setdefault((key[0], size) + block, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self._counters["evictions"] += 1
+
+    def _fresh(self, key):
+        # Caller holds the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[2] >= self.ttl:
+            self._drop(key)
+            self._counters["expirations"] += 1
+            return None
+        return entry
+
+    def _drop(self, key):
+        # Caller holds the lock
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[3] is None:
+            return
+        phash, size = entry[3], entry[6]
+        index_key = (key[0], phash, size)
+        if self._phash_index.get(index_key) == key:
+            del self._phash_index[index_key]
+        if self.phash_distance:
+            for block in _phash_blocks(phash, self.phash_distance + 1):
+                bucket_key = (key[0], size) + block
+                bucket = self._phash_buckets.get(bucket_key)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._phash_buckets[bucket_key]
+
+    def start(self):
+        """Delete expired rows in a background thread every `prune_interval` seconds"""
+        if not self.path or self.prune_interval <= 0:
+            return
+        # The thread does not survive a fork, so restart it per process
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        if self._pid is not None and self._pid != os.getpid():
+            # The lock may have been held by the parent's threads at fork time
+            self._lock = threading.Lock()
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="prediction-cache-prune", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.prune_interval)
+            try:
+                self.prune()
+            except sqlite3.Error as e:
+                logger.warning("Prediction cache prune failed: %s", e)
+
+    def prune(self):
+        """Delete expired rows from the persistent tier"""
+        if self.path:
+            deleted = self._conn().execute(
+                "DELETE FROM predictions WHERE created_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+            with self._lock:
+                self._counters["pruned_rows"] += deleted
+
+    def trim(self):
+        """Delete the oldest rows of the persistent tier beyond `max_rows`"""
+        if self.path and self.max_rows:
+            deleted = self._conn().execute(
+                "DELETE FROM predictions WHERE rowid IN "
+                "(SELECT rowid FROM predictions ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,)
+            ).rowcount
+            with self._lock:
+                self._counters["trimmed_rows"] += deleted
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._entries)
+        lookups = counters["hits"] + counters["perceptual_hits"] + counters["misses"]
+        hits = counters["hits"] + counters["perceptual_hits"]
+        return {
+            "size": size,
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl,
+            "persistent": bool(self.path),
+            "max_rows": self.max_rows,
+            **counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "inferences_saved": hits,
+        }
@@ -0,0 +1,213 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def client_key(remote_addr=None, forwarded_for=None):
+    """Rate limit key for a request: the client IP.
+
+    The Authorization header is not part of the key: it is not validated
+    here, so a client could get a fresh bucket by sending a new one.
+    `forwarded_for` (the X-Forwarded-For header) is only passed when the
+    service runs behind a proxy that sets it; its first address is the client.
+    """
+    if forwarded_for:
+        remote_addr = forwarded_for.split(",")[0].strip() or remote_addr
+    return f"ip:{remote_addr or 'unknown'}"
+
+
+def _refill(tokens, updated_at, now, rate, burst, cost, consume=True):
+    """Token bucket step: (tokens left, seconds to wait); the wait is 0 when `cost` is available.
+
+    With `consume=False` the bucket is only checked and nothing is taken.
+    """
+    tokens = min(burst, tokens + max(0.0, now - updated_at) * rate)
+    if tokens >= cost:
+        return tokens - cost if consume else tokens, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryBucketStore:
+    """Token buckets held in this process, at most `max_keys` of them (least recently used dropped)"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max(1, int(max_keys))
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost, consume=True):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens, wait = _refill(tokens, updated_at, now, rate, burst, cost, consume)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                # A dropped client comes back to a full bucket
+                self._buckets.popitem(last=False)
+        return wait
+
+    def size(self):
+        with self._lock:
+            return len(self._buckets)
+
+
+class SQLiteBucketStore:
+    """Token buckets in a SQLite file, shared by every process that opens it.
+
+    Each take is one short write transaction, so buckets stay exact across
+    gunicorn workers. Buckets idle long enough to be full again are deleted
+    every `prune_every` takes.
+    """
+
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._takes = 0
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        # One connection per thread and per process; sqlite3 handles must not cross a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Losing the last few updates in a crash only refills some buckets early
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, rate, burst, cost, consume=True):
+        # Wall-clock time, because the buckets are shared between processes
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, wait = _refill(row[0] if row else burst, row[1] if row else now, now, rate, burst, cost, consume)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)", (key, tokens, now))
+            self._takes += 1
+            if self._takes % self.prune_every == 0:
+                conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - burst / rate,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def size(self):
+        return self._conn().execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+class RateLimiter:
+    """Per-client token buckets: `rate` requests per second with bursts of up to `burst`.
+
+    `check(key)` takes a token from the key's bucket and returns 0, or the
+    seconds until one is available if the bucket is empty; with
+    `consume=False` it only checks, so a request can be refused before its
+    body is read and charged once its real cost is known. If the shared
+    store can't be reached, requests are let through (and counted), so the
+    limiter never takes the service down. A cost above `burst` could never
+    be paid and raises ValueError; callers refuse such requests outright.
+    """
+
+    def __init__(self, rate, burst, store=None):
+        if rate <= 0:
+            raise ValueError("The rate limit must be positive")
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.store = store if store is not None else MemoryBucketStore()
+        self._lock = threading.Lock()
+        self._counters = {"admitted": 0, "rejected": 0, "store_errors": 0}
+
+    def check(self, key, cost=1, consume=True):
+        if cost > self.burst:
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise ValueError(f"A cost of {cost} is more than the burst of {self.burst:g}")
+        try:
+            wait = self.store.take(key, self.rate, self.burst, float(cost), consume)
+        except sqlite3.Error as e:
+            logger.warning("Rate limit store unavailable, admitting request: %s", e)
+            wait = 0.0
+            with self._lock:
+                self._counters["store_errors"] += 1
+        # A passed check is counted when the request is charged
+        if wait or consume:
+            with self._lock:
+                self._counters["rejected" if wait else "admitted"] += 1
+        return wait
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return {
+            "rate_per_sec": self.rate,
+            "burst": self.burst,
+            "store": "sqlite" if isinstance(self.store, SQLiteBucketStore) else "memory",
+            "clients": self.store.size(),
+            **counters
+        }
+
+
+class ConcurrencyLimiter:
+    """Caps the images being decoded and classified at once in this process.
+
+    `try_acquire(cost)` never waits: it takes `cost` slots, or refuses when
+    they are not free, so overload is answered at once instead of queueing.
+    A cost above the limit is capped, so the largest request can still run
+    on an idle server.
+    """
+
+    def __init__(self, limit):
+        self.limit = int(limit)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._peak = 0
+        self._counters = {"admitted": 0, "rejected": 0}
+
+    def _cost(self, cost):
+        return min(max(1, int(cost)), self.limit)
+
+    def try_acquire(self, cost=1):
+        if self.limit <= 0:
+            return True
+        cost = self._cost(cost)
+        with self._lock:
+            if self._in_flight + cost > self.limit:
+                self._counters["rejected"] += 1
+                return False
+            self._in_flight += cost
+            self._peak = max(self._peak, self._in_flight)
+            self._counters["admitted"] += 1
+            return True
+
+    def release(self, cost=1):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - self._cost(cost))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "peak_in_flight": self._peak,
+                **self._counters
+            }
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+STARTUP_STATUSES = ("starting", "warming", "ready", "failed")
+
+
+class StartupState:
+    """Tracks the service's startup status and how long each startup phase took"""
+
+    def __init__(self):
+        self.status = "starting"
+        self.error = None
+        self.timings = {}
+        self._started = time.perf_counter()
+        self._ready_event = threading.Event()
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def set_status(self, status, error=None):
+        if status not in STARTUP_STATUSES:
+            raise ValueError(f"Unknown startup status '{status}'")
+        self.status = status
+        self.error = error
+        if status in ("ready", "failed"):
+            self.timings["total"] = round(time.perf_counter() - self._started, 3)
+            logger.info("Startup %s after %.2fs: %s", status, self.timings["total"], self.timings)
+            self._ready_event.set()
+
+    def wait(self, timeout=None):
+        """Block until startup has finished (ready or failed)"""
+        return self._ready_event.wait(timeout)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - started, 3)
+            logger.info("Startup phase '%s' took %.2fs", name, self.timings[name])
+
+    def describe(self):
+        return {
+            "status": self.status,
+            "error": self.error,
+            "phase_seconds": dict(self.timings),
+            "uptime_seconds": round(time.perf_counter() - self._started, 1)
+        }
+
+
+def load_pretrained(model_name, revision=None, local_dir=None):
+    """Load the image processor and classifier without touching the network when possible.
+
+    Tries, in order: a pinned snapshot saved in `local_dir`, the Hugging Face
+    cache (`local_files_only=True`), and finally a download from the hub.
+    Returns (processor, model, source).
+    """
+    # transformers is slow to import, so only pay for it when the model is actually loaded
+    from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+    attempts = []
+    if local_dir and os.path.isfile(os.path.join(local_dir, "config.json")):
+        attempts.append(("local snapshot", local_dir, {"local_files_only": True}))
+    attempts.append(("hub cache", model_name, {"revision": revision, "local_files_only": True}))
+    attempts.append(("hub download", model_name, {"revision": revision}))
+
+    errors = []
+    for source, location, kwargs in attempts:
+        try:
+            processor = AutoImageProcessor.from_pretrained(location, **kwargs)
+            model = AutoModelForImageClassification.from_pretrained(location, **kwargs)
+            logger.info("Loaded %s from %s (%s)", model_name, source, location)
+            return processor, model.eval(), source
+        except (OSError, ValueError) as e:
+            errors.append(f"{source}: {e}")
+
+    raise RuntimeError(f"Could not load {model_name}: " + "; ".join(errors))
+
+
+def find_model_file(model_name, filename, revision=None, local_dir=None, source=None):
+    """Path of an extra file stored with the model (e.g. an early-exit head), or None.
+
+    Looks where `load_pretrained` found the model: the local snapshot, or the
+    hub (only its cache if the model itself came from the cache).
+    """
+    if source == "local snapshot":
+        path = os.path.join(local_dir, filename)
+        return path if os.path.isfile(path) else None
+    try:
+        from huggingface_hub import hf_hub_download
+        return hf_hub_download(model_name, filename, revision=revision, local_files_only=source == "hub cache")
+    except (OSError, ValueError):
+        return None
+
+
+def save_snapshot(model_name, local_dir, revision=None):
+    """Download `model_name` at `revision` and save it to `local_dir` for offline starts"""
+    from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+    processor = AutoImageProcessor.from_pretrained(model_name, revision=revision)
+    model = AutoModelForImageClassification.from_pretrained(model_name, revision=revision)
+    os.makedirs(local_dir, exist_ok=True)
+    processor.save_pretrained(local_dir)
+    model.save_pretrained(local_dir, safe_serialization=True)
+    logger.info("Saved %s@%s to %s", model_name, revision or "main", local_dir)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    # python startup.py <model_name> <local_dir> [revision]
+    if len(sys.argv) < 3:
+        print("Usage: python startup.py <model_name> <local_dir> [revision]")
+        sys.exit(1)
+    save_snapshot(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
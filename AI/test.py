@@ -1,4 +1,5 @@
 import os
+import copy
 import logging
 from datasets import load_dataset
 from transformers import AutoImageProcessor, AutoModelForImageClassification
@@ -8,6 +9,14 @@ from PIL import Image
 import numpy as np
 import json
 import sys
+import time
+from sklearn.metrics import classification_report, confusion_matrix
+from inference_backends import INFERENCE_BACKENDS, InferenceBackend, default_onnx_path
+from bulk_classify import WRITERS, Checkpoint, iter_images, decode_stream, batched
+from dedup_index import apply_split_file
+from model_registry import version_id
+from labels import LABEL2INFO
+from cascade import EARLY_EXIT_FILE, evaluate_cascade, load_exit_head
 
 # --- Logging setup ---
 logging.basicConfig(level=logging.INFO)
@@ -16,34 +25,15 @@ logger = logging.getLogger("waste_classifier_test")
 # --- Config ---
 MODEL_PATH = os.path.join(os.path.dirname(__file__), "waste_classifier")
 DATASET_PATH = os.path.join(os.path.dirname(__file__), "data")
-LABEL2INFO = {
-    0: {
-        "label": "biodegradable",
-        "description": "Easily breaks down naturally. Good for composting.",
-        "recyclable": False,
-        "disposal": "Use compost or organic bin",
-        "example_items": ["banana peel", "food waste", "paper"],
-        "environmental_benefit": "Composting biodegradable waste returns nutrients to the soil, reduces landfill use, and lowers greenhouse gas emissions.",
-        "protection_tip": "Compost at home or use municipal organic waste bins. Avoid mixing with plastics or hazardous waste.",
-        "poor_disposal_effects": "If disposed of improperly, biodegradable waste can cause methane emissions in landfills and contribute to water pollution and eutrophication."
-    },
-    1: {
-        "label": "non_biodegradable",
-        "description": "Does not break down easily. Should be disposed of carefully.",
-        "recyclable": False,
-        "disposal": "Use general waste bin or recycling if possible",
-        "example_items": ["plastic bag", "styrofoam", "metal can"],
-        "environmental_benefit": "Proper disposal and recycling of non-biodegradable waste reduces pollution, conserves resources, and protects wildlife.",
-        "protection_tip": "Reduce use, reuse items, and recycle whenever possible. Never burn or dump in nature.",
-        "poor_disposal_effects": "Improper disposal leads to soil and water pollution, harms wildlife, and causes long-term environmental damage. Plastics can persist for hundreds of years."
-    }
-}
+# Same split file as train.py, if training used one
+SPLIT_FILE = os.environ.get("SPLIT_FILE", "")
 
 # --- Load model and processor ---
 logger.info(f"Loading model from {MODEL_PATH}")
 model = AutoModelForImageClassification.from_pretrained(MODEL_PATH)
 image_processor = AutoImageProcessor.from_pretrained(MODEL_PATH)
 model.eval()
+device = "cuda" if torch.cuda.is_available() else "cpu"
 
 def predict_image(image_path, model, image_processor, device="cpu"):
     """Predict waste classification for a single image"""
@@ -68,49 +58,261 @@ def predict_image(image_path, model, image_processor, device="cpu"):
         logger.error(f"Error processing image {image_path}: {str(e)}")
         return {"error": str(e)}
 
-def evaluate_on_test():
-    """Evaluate model on test dataset - FIXED VERSION"""
+def get_option(args, name, default=None):
+    """Value following `name` in the argument list, or `default`"""
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            return args[index + 1]
+    return default
+
+def build_backend(name, inplace=False):
+    """Wrap the loaded model in an inference backend; the fp32 model is left untouched"""
+    return InferenceBackend(
+        model,
+        name,
+        # Keyed by the checkpoint fingerprint, so a retrained model is exported again
+        onnx_path=default_onnx_path(
+            version_id("waste_classifier", None, model.config, MODEL_PATH),
+            os.path.join(os.path.dirname(__file__), "onnx")
+        ),
+        inplace=inplace
+    )
+
+def load_test_set(num_proc=None, map_batch_size=64):
+    """The test split, preprocessed in batches (across `num_proc` processes) into torch tensors"""
     logger.info(f"Loading test set from {DATASET_PATH}")
     dataset = load_dataset("imagefolder", data_dir=DATASET_PATH)
     
     # Use the same split logic as train.py
-    split = dataset["train"].train_test_split(test_size=0.2, seed=42)
-    val_test = split["test"].train_test_split(test_size=0.5, seed=42)
-    test_set = val_test["test"]
-    
-    # Preprocessing function - FIXED
-    def preprocess(example):
-        img = example["image"]
-        if img.mode != "RGB":
-            img = img.convert("RGB")
-        
-        # Use the image_processor instead of manual transforms
-        # This ensures consistency with the training preprocessing
-        processed = image_processor(images=img, return_tensors="pt")
-        example["pixel_values"] = processed["pixel_values"].squeeze(0)  # Remove batch dimension
-        return example
-    
-    test_set = test_set.map(preprocess, batched=False)
-    
-    # Evaluation
-    correct = 0
-    total = 0
+    if SPLIT_FILE:
+        test_set = apply_split_file(dataset["train"], SPLIT_FILE)["test"]
+    else:
+        split = dataset["train"].train_test_split(test_size=0.2, seed=42)
+        val_test = split["test"].train_test_split(test_size=0.5, seed=42)
+        test_set = val_test["test"]
     
-    for ex in test_set:
-        # Add batch dimension back
-        pixel_values = ex["pixel_values"].unsqueeze(0)
-        
-        with torch.no_grad():
-            outputs = model(pixel_values=pixel_values)
-            pred = torch.argmax(outputs.logits, dim=1).item()
-        
-        if pred == ex["label"]:
-            correct += 1
-        total += 1
+    # Use the image_processor so preprocessing matches training
+    def preprocess(batch):
+        images = [img if img.mode == "RGB" else img.convert("RGB") for img in batch["image"]]
+        batch["pixel_values"] = image_processor(images=images, return_tensors="np")["pixel_values"]
+        return batch
     
-    acc = correct / total if total > 0 else 0
-    logger.info(f"Test set accuracy: {acc:.4f} ({correct}/{total})")
-    return acc
+    test_set = test_set.map(
+        preprocess, batched=True, batch_size=map_batch_size, num_proc=num_proc, remove_columns=["image"]
+    )
+    test_set.set_format("torch", columns=["pixel_values", "label"])
+    return test_set
+
+def eager_forward(eval_model, device):
+    """Forward function for a transformers model, moved to `device` once"""
+    eval_model = eval_model.to(device).eval()
+    return lambda pixel_values: eval_model(pixel_values=pixel_values.to(device)).logits
+
+def evaluate_variants(variants, batch_size=32, num_proc=None, num_workers=0, test_set=None):
+    """Evaluate several models/backends on the test split in a single pass over the data.
+
+    `variants` maps a name to a forward function (pixel_values -> logits).
+    Returns {name: report} with accuracy, per-class precision/recall/F1, the
+    confusion matrix, images/sec and the predictions, in test set order.
+    """
+    if test_set is None:
+        test_set = load_test_set(num_proc)
+    loader = torch.utils.data.DataLoader(test_set, batch_size=batch_size, num_workers=num_workers)
+
+    labels = []
+    predictions = {name: [] for name in variants}
+    forward_seconds = {name: 0.0 for name in variants}
+    started = time.perf_counter()
+
+    with torch.inference_mode():
+        for batch in loader:
+            labels.extend(batch["label"].tolist())
+            for name, forward in variants.items():
+                batch_started = time.perf_counter()
+                preds = torch.argmax(forward(batch["pixel_values"]), dim=1).cpu()
+                forward_seconds[name] += time.perf_counter() - batch_started
+                predictions[name].extend(preds.tolist())
+
+    elapsed = time.perf_counter() - started
+    label_ids = sorted(model.config.id2label)
+    label_names = [model.config.id2label[i] for i in label_ids]
+    reports = {}
+    for name, preds in predictions.items():
+        per_class = classification_report(
+            labels, preds, labels=label_ids, target_names=label_names, output_dict=True, zero_division=0
+        )
+        acc = sum(a == b for a, b in zip(labels, preds)) / max(1, len(labels))
+        reports[name] = {
+            "accuracy": round(acc, 4),
+            "per_class": {
+                label: {metric: round(per_class[label][metric], 4) for metric in ("precision", "recall", "f1-score", "support")}
+                for label in label_names
+            },
+            "confusion_matrix": confusion_matrix(labels, preds, labels=label_ids).tolist(),
+            "images_per_sec": round(len(preds) / forward_seconds[name], 2) if forward_seconds[name] else 0.0,
+            "predictions": preds
+        }
+        logger.info(f"{name}: accuracy {acc:.4f} ({len(preds)} images, {reports[name]['images_per_sec']} images/sec)")
+    logger.info(f"Evaluated {len(variants)} variant(s) on {len(labels)} images in {elapsed:.1f}s")
+    return reports
+
+def build_variants(names, device):
+    """Forward functions for backend names (eager, int8, ...) and checkpoint directories"""
+    variants = {}
+    # CPU backends are built from the model first. torch.compile wraps the
+    # model object itself, so eager gets its own copy to move to `device`.
+    for name in names:
+        if name in INFERENCE_BACKENDS and name != "eager":
+            variants[name] = build_backend(name)
+    for name in names:
+        if name in variants:
+            continue
+        if name == "eager":
+            variants[name] = eager_forward(copy.deepcopy(model) if variants else model, device)
+        elif os.path.isdir(name):
+            logger.info(f"Loading checkpoint {name}")
+            variants[name] = eager_forward(AutoModelForImageClassification.from_pretrained(name), device)
+        else:
+            raise ValueError(f"'{name}' is neither an inference backend ({', '.join(INFERENCE_BACKENDS)}) nor a checkpoint directory")
+    return {name: variants[name] for name in names}
+
+def evaluate_on_test(forward=None, batch_size=32, num_proc=None, num_workers=0):
+    """Evaluate model on test dataset
+
+    `forward` maps pixel_values to logits (an InferenceBackend); defaults to the eager model.
+    Returns (accuracy, predictions).
+    """
+    if forward is None:
+        forward = eager_forward(model, device)
+    report = evaluate_variants({"model": forward}, batch_size, num_proc, num_workers)["model"]
+    logger.info(f"Test set accuracy: {report['accuracy']:.4f}")
+    return report["accuracy"], report["predictions"]
+
+def check_backend_parity(backends, tolerance=0.01, batch_size=32, num_proc=None):
+    """Evaluate each backend against eager fp32 on the test split.
+
+    All backends are evaluated in one pass over the data. A backend passes if
+    its accuracy is at most `tolerance` below eager. Returns True if every
+    backend passes.
+    """
+    names = ["eager"] + [name for name in backends if name != "eager"]
+    logger.info(f"Evaluating {', '.join(names)}...")
+    # Backends run on CPU, so the eager baseline does too
+    reports = evaluate_variants(build_variants(names, "cpu"), batch_size, num_proc)
+    baseline = reports["eager"]
+    report = {"eager": {"accuracy": baseline["accuracy"]}}
+    passed = True
+
+    for name in names[1:]:
+        acc = reports[name]["accuracy"]
+        preds = reports[name]["predictions"]
+        agreement = sum(a == b for a, b in zip(preds, baseline["predictions"])) / max(1, len(preds))
+        ok = acc >= baseline["accuracy"] - tolerance
+        passed = passed and ok
+        report[name] = {
+            "accuracy": acc,
+            "accuracy_delta": round(acc - baseline["accuracy"], 4),
+            "agreement_with_eager": round(agreement, 4),
+            "passed": ok
+        }
+
+    print(json.dumps(report, indent=2))
+    return passed
+
+def check_cascade(head_path, thresholds, batch_size=32, num_proc=None):
+    """Evaluate the early-exit cascade against the full model on the test split.
+
+    Reports accuracy, agreement with the full model, escalation rate and
+    estimated speedup for each confidence threshold.
+    """
+    head = load_exit_head(head_path, device)
+    logger.info(f"Evaluating the cascade ({head.layers}-layer early exit) at thresholds {thresholds}")
+    loader = torch.utils.data.DataLoader(load_test_set(num_proc), batch_size=batch_size)
+    report = evaluate_cascade(
+        model.to(device), head, ((batch["pixel_values"], batch["label"]) for batch in loader), thresholds, device
+    )
+    print(json.dumps(report, indent=2))
+    return report
+
+# Columns of a bulk run's output, with their Parquet types
+BULK_COLUMNS = {
+    "image_path": "string",
+    "label_id": "int64",
+    "label": "string",
+    "description": "string",
+    "recyclable": "bool",
+    "disposal": "string",
+    "example_items": "list<string>",
+    "environmental_benefit": "string",
+    "protection_tip": "string",
+    "poor_disposal_effects": "string",
+    "confidence": "float64",
+    "error": "string",
+}
+
+def classify_bulk(source, output, output_format="jsonl", backend_name="eager", batch_size=32,
+                  workers=4, resume=False, checkpoint_every=20):
+    """Classify every image in a directory or tar/zip archive, streaming results to `output`.
+
+    Images are decoded by a thread pool and classified in batches. Results are
+    committed every `checkpoint_every` batches together with a checkpoint, so
+    `resume=True` continues an interrupted run instead of starting over.
+    """
+    forward = eager_forward(model, device) if backend_name == "eager" else build_backend(backend_name)
+    checkpoint = Checkpoint(output + ".checkpoint.json", source)
+    state = checkpoint.load() if resume else None
+    skip = state["processed"] if state else 0
+    writer = WRITERS[output_format](output, state["writer"] if state else None, columns=BULK_COLUMNS)
+    if skip:
+        logger.info(f"Resuming after {skip} images")
+
+    size = image_processor.size
+    target_size = (size["width"], size["height"]) if "height" in size else (size["shortest_edge"],) * 2
+    empty_info = {key: None for key in LABEL2INFO[0]}
+    processed = skip
+    failed = 0
+    started = time.perf_counter()
+    decoded = decode_stream(iter_images(source, skip), target_size, workers=workers, window=batch_size * 2)
+
+    try:
+        for batch_number, batch in enumerate(batched(decoded, batch_size), start=1):
+            rows = []
+            good = [(index, image) for index, (_, image, _) in enumerate(batch) if image is not None]
+            predictions = {}
+            if good:
+                pixel_values = image_processor(images=[image for _, image in good], return_tensors="pt")["pixel_values"]
+                with torch.inference_mode():
+                    probs = torch.softmax(forward(pixel_values), dim=1).cpu()
+                conf, pred = torch.max(probs, dim=1)
+                predictions = {index: (p, c) for (index, _), p, c in zip(good, pred.tolist(), conf.tolist())}
+
+            for index, (name, _, error) in enumerate(batch):
+                row = {"image_path": name, "label_id": None, **empty_info, "confidence": None, "error": error}
+                if index in predictions:
+                    label_id, confidence = predictions[index]
+                    row.update(LABEL2INFO[label_id], label_id=label_id, confidence=round(confidence, 4))
+                else:
+                    failed += 1
+                rows.append(row)
+
+            writer.write(rows)
+            processed += len(batch)
+            if batch_number % checkpoint_every == 0:
+                checkpoint.save(processed, writer.commit())
+                rate = (processed - skip) / (time.perf_counter() - started)
+                logger.info(f"{processed} images classified ({rate:.1f} images/sec, {failed} unreadable)")
+
+        checkpoint.save(processed, writer.commit())
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Done: {processed} images ({failed} unreadable) in {elapsed:.1f}s, "
+        f"{(processed - skip) / elapsed if elapsed else 0:.1f} images/sec; results in {output}"
+    )
+    return processed
 
 def main():
     """Main function to handle command line arguments"""
@@ -118,6 +320,9 @@ def main():
         print("Usage:")
         print("  python test.py <image_path>           - Predict single image")
         print("  python test.py --dataset              - Evaluate on test dataset")
+        print("  python test.py --parity               - Check inference backends against eager fp32")
+        print("  python test.py --bulk <dir|archive>   - Classify every image in a directory, tar or zip")
+        print("  python test.py --cascade              - Evaluate the early-exit cascade against the full model")
         print("  python test.py --help                 - Show this help")
         return
     
@@ -126,13 +331,90 @@ def main():
         print("Usage:")
         print("  python test.py <image_path>           - Predict single image")
         print("  python test.py --dataset              - Evaluate on test dataset")
+        print("  python test.py --parity               - Check inference backends against eager fp32")
+        print("  python test.py --bulk <dir|archive>   - Classify every image in a directory, tar or zip")
+        print("  python test.py --cascade              - Evaluate the early-exit cascade against the full model")
+        print("\nOptions:")
+        print(f"  --backend NAME         Backend for --dataset ({', '.join(INFERENCE_BACKENDS)})")
+        print("  --backends A,B         Backends compared by --parity (default: int8,compile,onnx)")
+        print("  --tolerance X          Maximum accuracy drop allowed by --parity (default: 0.01)")
+        print("  --variants A,B         Backends and/or checkpoint directories evaluated together by --dataset")
+        print("  --batch-size N         Evaluation batch size (default: 32)")
+        print("  --num-proc N           Processes used to preprocess the test set")
+        print("  --workers N            DataLoader workers for --dataset (default: 0), decode threads for --bulk (default: 4)")
+        print("  --output PATH          Save the --dataset/--cascade report as JSON, or where --bulk writes results")
+        print("  --format jsonl|parquet Output format for --bulk (default: jsonl; parquet needs pyarrow)")
+        print("  --resume               Continue an interrupted --bulk run from its checkpoint")
+        print(f"  --exit-head PATH       Early-exit head for --cascade (default: <model>/{EARLY_EXIT_FILE})")
+        print("  --thresholds A,B       Confidence thresholds compared by --cascade (default: 0.8,0.9,0.95,0.99)")
         print("\nExample:")
         print("  python test.py my_waste_image.jpg")
+        print("  python test.py --parity --backends int8")
+        print("  python test.py --dataset --variants eager,int8,./checkpoint-500 --num-proc 4")
+        print("  python test.py --bulk field_photos.tar --output field_photos.jsonl --backend int8 --resume")
+        print("  python test.py --cascade --thresholds 0.9,0.95")
         return
     
     elif sys.argv[1] == "--dataset":
         logger.info("Evaluating on test dataset...")
-        evaluate_on_test()
+        # --backend NAME is kept for a single variant; --variants takes several
+        names = get_option(sys.argv, "--variants", get_option(sys.argv, "--backend", "eager")).split(",")
+        num_proc = get_option(sys.argv, "--num-proc")
+        reports = evaluate_variants(
+            build_variants(names, device),
+            batch_size=int(get_option(sys.argv, "--batch-size", 32)),
+            num_proc=int(num_proc) if num_proc else None,
+            num_workers=int(get_option(sys.argv, "--workers", 0))
+        )
+        summary = {name: {k: v for k, v in report.items() if k != "predictions"} for name, report in reports.items()}
+        print(json.dumps(summary, indent=2))
+        output = get_option(sys.argv, "--output")
+        if output:
+            with open(output, "w") as f:
+                json.dump(summary, f, indent=2)
+            logger.info(f"Report saved to {output}")
+
+    elif sys.argv[1] == "--bulk":
+        if len(sys.argv) < 3:
+            logger.error("Usage: python test.py --bulk <directory|archive> --output results.jsonl")
+            sys.exit(1)
+        output_format = get_option(sys.argv, "--format", "jsonl")
+        classify_bulk(
+            sys.argv[2],
+            get_option(sys.argv, "--output", "results.parquet" if output_format == "parquet" else "results.jsonl"),
+            output_format=output_format,
+            backend_name=get_option(sys.argv, "--backend", "eager"),
+            batch_size=int(get_option(sys.argv, "--batch-size", 32)),
+            workers=int(get_option(sys.argv, "--workers", 4)),
+            resume="--resume" in sys.argv
+        )
+
+    elif sys.argv[1] == "--cascade":
+        num_proc = get_option(sys.argv, "--num-proc")
+        report = check_cascade(
+            get_option(sys.argv, "--exit-head", os.path.join(MODEL_PATH, EARLY_EXIT_FILE)),
+            [float(t) for t in get_option(sys.argv, "--thresholds", "0.8,0.9,0.95,0.99").split(",")],
+            batch_size=int(get_option(sys.argv, "--batch-size", 32)),
+            num_proc=int(num_proc) if num_proc else None
+        )
+        output = get_option(sys.argv, "--output")
+        if output:
+            with open(output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Report saved to {output}")
+
+    elif sys.argv[1] == "--parity":
+        backends = get_option(sys.argv, "--backends", "int8,compile,onnx").split(",")
+        tolerance = float(get_option(sys.argv, "--tolerance", 0.01))
+        num_proc = get_option(sys.argv, "--num-proc")
+        passed = check_backend_parity(
+            backends, tolerance,
+            batch_size=int(get_option(sys.argv, "--batch-size", 32)),
+            num_proc=int(num_proc) if num_proc else None
+        )
+        if not passed:
+            logger.error("Accuracy regressed beyond tolerance for at least one backend")
+            sys.exit(1)
     
     else:
         # Single image prediction
@@ -0,0 +1,75 @@
+import types
+
+import pytest
+
+from backend_delivery import BackendDelivery, Delivery
+from outbox import Outbox
+
+
+class Session:
+    """Answers each POST with the next status for its URL (the last one repeats)"""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.posts = []
+
+    def post(self, url, json, headers, timeout):
+        self.posts.append((url, json))
+        answers = self.statuses[url]
+        status = answers.pop(0) if len(answers) > 1 else answers[0]
+        return types.SimpleNamespace(status_code=status, content=b"")
+
+
+@pytest.fixture
+def box(tmp_path):
+    return Outbox(str(tmp_path / "outbox.db"))
+
+
+def sender(box, statuses, bulk_url=None):
+    # _deliver is driven directly, without the worker threads
+    delivery = BackendDelivery("http://backend/one", bulk_url=bulk_url, max_retries=2, backoff_base=0, outbox=box)
+    delivery.session = Session(statuses)
+    delivery._request_error = OSError
+    return delivery
+
+
+def queued(box, *ids, bulk=False):
+    submissions = [{"submission_id": submission_id} for submission_id in ids]
+    box.add(submissions, "Bearer one")
+    return Delivery(submissions, "Bearer one", bulk=bulk)
+
+
+def statuses(box):
+    return dict(box._conn().execute("SELECT submission_id, status FROM submissions"))
+
+
+@pytest.mark.parametrize("status", [400, 422])
+def test_invalid_submissions_are_dropped(box, status):
+    delivery = sender(box, {"http://backend/one": [status]})
+    assert not delivery._deliver(queued(box, "a"))
+    assert statuses(box) == {"a": "rejected"}
+    assert len(delivery.session.posts) == 1
+
+
+@pytest.mark.parametrize("status", [401, 403, 404, 405, 500])
+def test_other_refusals_are_retried_and_kept(box, status):
+    delivery = sender(box, {"http://backend/one": [status]})
+    assert not delivery._deliver(queued(box, "a"))
+    assert statuses(box) == {"a": "pending"}
+    assert len(delivery.session.posts) == 3
+    assert delivery.stats()["failed"] == 1
+
+
+def test_retry_succeeds_after_a_server_error(box):
+    delivery = sender(box, {"http://backend/one": [503, 201]})
+    assert delivery._deliver(queued(box, "a"))
+    assert statuses(box) == {"a": "delivered"}
+
+
+def test_refused_bulk_is_posted_one_by_one(box):
+    delivery = sender(box, {"http://backend/bulk": [404], "http://backend/one": [201]}, bulk_url="http://backend/bulk")
+    assert delivery._deliver(queued(box, "a", "b", bulk=True))
+    assert statuses(box) == {"a": "delivered", "b": "delivered"}
+    assert [url for url, _ in delivery.session.posts] == [
+        "http://backend/bulk", "http://backend/one", "http://backend/one"
+    ]
@@ -0,0 +1,64 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from dedup_index import EmbeddingIndex, duplicate_clusters
+
+
+def random_vectors(count, dim=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+
+def build_index(vectors, batch=100):
+    index = EmbeddingIndex()
+    for start in range(0, len(vectors), batch):
+        rows = vectors[start:start + batch]
+        index.add(rows, [0] * len(rows), [f"img{i}.jpg" for i in range(start, start + len(rows))])
+    return index
+
+
+def test_flat_search_finds_each_vector_first():
+    vectors = random_vectors(500)
+    index = build_index(vectors)
+    assert len(index) == 500
+    assert index.vectors.shape == (500, 16)
+    scores, ids = index.search(vectors[:20], k=3)
+    assert ids[:, 0].tolist() == list(range(20))
+    assert np.allclose(scores[:, 0], 1.0, atol=1e-5)
+
+
+def test_missing_neighbours_are_minus_one():
+    index = build_index(random_vectors(2))
+    scores, ids = index.search(random_vectors(1, seed=1), k=5)
+    assert ids[0, 2:].tolist() == [-1, -1, -1]
+
+
+def test_ivf_search_with_all_lists_matches_flat():
+    vectors = random_vectors(400)
+    index = build_index(vectors)
+    index.train_ivf(8)
+    # Vectors added after training are assigned to the existing centroids
+    index.add(vectors[:10], [1] * 10, [f"copy{i}.jpg" for i in range(10)])
+    assert index.assignments.shape == (410,)
+    _, ids = index.search(vectors[:10], k=2, nprobe=8)
+    for row, pair in enumerate(ids.tolist()):
+        assert sorted(pair) == [row, 400 + row]
+
+
+def test_duplicate_clusters_groups_copies():
+    vectors = random_vectors(50)
+    index = build_index(np.concatenate([vectors, vectors[:3] * 2]))
+    clusters = sorted(sorted(members) for members in duplicate_clusters(index, threshold=0.999))
+    assert clusters == [[0, 50], [1, 51], [2, 52]]
+
+
+def test_save_and_load_round_trip(tmp_path):
+    index = build_index(random_vectors(120))
+    index.train_ivf(4)
+    path = str(tmp_path / "index.npz")
+    index.save(path)
+    loaded = EmbeddingIndex.load(path)
+    assert len(loaded) == 120
+    assert loaded.keys == index.keys
+    assert np.array_equal(loaded.vectors, index.vectors)
+    assert np.array_equal(loaded.assignments, index.assignments)
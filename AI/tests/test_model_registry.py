@@ -0,0 +1,92 @@
+import json
+import types
+
+import pytest
+
+from model_registry import ModelRegistry, ModelVersion, model_key
+
+
+class Loader:
+    """Stands in for the API's model loader; sources listed in `broken` fail to load"""
+
+    def __init__(self, broken=()):
+        self.broken = set(broken)
+        self.calls = []
+
+    def __call__(self, source, revision, options):
+        self.calls.append(source)
+        if source in self.broken:
+            raise OSError(f"{source} not found")
+        inference = types.SimpleNamespace(model=types.SimpleNamespace(state_dict=dict), describe=dict)
+        return ModelVersion(model_key(source, revision), source, inference, {0: "plastic"})
+
+
+def booted(loader=None, **kwargs):
+    registry = ModelRegistry(loader or Loader(), poll_interval=3600, **kwargs)
+    registry.boot("base")
+    return registry
+
+
+def with_candidate(percent, mode="ab"):
+    registry = booted()
+    registry.add("candidate")
+    registry.reconcile()
+    registry.set_traffic("candidate", percent, mode)
+    registry.reconcile()
+    return registry
+
+
+def test_route_without_traffic_uses_the_active_model():
+    registry = booted()
+    assert registry.route("token") == (registry.versions["base"], None)
+
+
+def test_ab_split_is_deterministic_per_key():
+    registry = with_candidate(30)
+    candidate = registry.versions["candidate"]
+    routed = [registry.route(f"user-{i}")[0] for i in range(4000)]
+    share = sum(version is candidate for version in routed) / len(routed)
+    assert 0.27 < share < 0.33
+    assert all(registry.route(f"user-{i}")[0] is routed[i] for i in range(200))
+
+
+def test_shadow_answers_with_the_active_model():
+    registry = with_candidate(100, "shadow")
+    assert registry.route("token") == (registry.versions["base"], registry.versions["candidate"])
+
+
+def test_failed_load_backs_off_without_touching_the_shared_state(tmp_path):
+    state_path = str(tmp_path / "registry.json")
+    loader = Loader(broken={"candidate"})
+    registry = booted(loader, state_path=state_path)
+    registry.add("candidate")
+    with open(state_path) as f:
+        written = json.load(f)
+
+    registry.reconcile()
+    registry.reconcile()
+    assert loader.calls.count("candidate") == 1
+    assert "candidate" in registry.failed
+    assert registry.describe()["models"]["candidate"]["status"] == "failed"
+    with open(state_path) as f:
+        assert json.load(f) == written
+    assert registry.route("token")[0] is registry.versions["base"]
+
+    # Once the backoff has passed the load is tried again, and waits twice as long after failing
+    attempts, _ = registry._retries["candidate"]
+    registry._retries["candidate"] = (attempts, 0)
+    assert registry._retry_due()
+    registry.reconcile()
+    assert loader.calls.count("candidate") == 2
+    assert registry._retries["candidate"][0] == 2
+
+    loader.broken.clear()
+    registry._retries["candidate"] = (2, 0)
+    registry.reconcile()
+    assert "candidate" in registry.versions
+    assert "candidate" not in registry.failed
+
+
+def test_boot_fails_when_the_model_cannot_load():
+    with pytest.raises(RuntimeError, match="not found"):
+        booted(Loader(broken={"base"}))
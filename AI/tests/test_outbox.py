@@ -0,0 +1,95 @@
+import pytest
+
+import outbox
+from outbox import Outbox
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(outbox.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def box(tmp_path, clock):
+    return Outbox(str(tmp_path / "outbox.db"), lease=60.0, retention_hours=1.0)
+
+
+def submission(submission_id):
+    return {"submission_id": submission_id, "label": "plastic"}
+
+
+def claimed_ids(groups):
+    return sorted(item["submission_id"] for _, items in groups for item in items)
+
+
+def test_added_rows_are_leased_then_due(box, clock):
+    assert box.add([submission("a"), submission("b")], "Bearer one") == ["a", "b"]
+    # Added rows are claimed by the caller that queued them
+    assert box.claim_due(10) == []
+
+    clock.now += 61
+    groups = box.claim_due(10)
+    assert claimed_ids(groups) == ["a", "b"]
+    assert [auth for auth, _ in groups] == ["Bearer one"]
+    # Claiming leases them again, so a second worker does not replay them too
+    assert box.claim_due(10) == []
+
+
+def test_duplicate_ids_are_ignored(box):
+    box.add([submission("a")], "Bearer one")
+    assert box.add([submission("a"), submission("b")], "Bearer one") == ["b"]
+    assert box.stats()["duplicates"] == 1
+    assert box.stats()["pending"] == 2
+
+
+def test_claim_groups_by_token_and_respects_limit(box, clock):
+    box.add([submission("a"), submission("b")], "Bearer one")
+    box.add([submission("c")], "Bearer two")
+    clock.now += 61
+    assert len(claimed_ids(box.claim_due(2))) == 2
+    groups = dict(box.claim_due(10))
+    assert claimed_ids(groups.items()) == ["c"]
+    assert list(groups) == ["Bearer two"]
+
+
+def test_failed_rows_come_back_after_their_retry(box, clock):
+    box.add([submission("a")], "Bearer one")
+    box.mark_failed(["a"], retry_in=5)
+    clock.now += 4
+    assert box.claim_due(10) == []
+    clock.now += 2
+    assert claimed_ids(box.claim_due(10)) == ["a"]
+
+
+def test_finished_rows_are_never_replayed_and_are_pruned(box, clock):
+    box.add([submission("a"), submission("b")], "Bearer one")
+    box.add([submission("c")], "Bearer two")
+    box.mark_delivered(["a"])
+    box.mark_rejected(["b", "c"])
+    clock.now += 61
+    assert box.claim_due(10) == []
+    assert box.stats()["pending"] == 0
+
+    clock.now += 3600
+    box.prune()
+    conn = box._conn()
+    assert conn.execute("SELECT COUNT(*) FROM submissions").fetchone()[0] == 0
+    # Tokens are only kept while a pending submission needs them
+    assert conn.execute("SELECT COUNT(*) FROM auth_tokens").fetchone()[0] == 0
+
+
+def test_pending_rows_survive_reopening(tmp_path, clock):
+    path = str(tmp_path / "outbox.db")
+    Outbox(path).add([submission("a")], "Bearer one")
+    clock.now += 61
+    assert claimed_ids(Outbox(path).claim_due(10)) == ["a"]
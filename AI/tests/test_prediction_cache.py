@@ -0,0 +1,121 @@
+import io
+
+import pytest
+
+import prediction_cache
+from prediction_cache import PredictionCache, image_dhash
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prediction_cache.time, "time", clock)
+    return clock
+
+
+class Grey:
+    """Duck-typed greyscale image: convert/resize/getdata over a function of (x, y)"""
+
+    def __init__(self, pixel, size=(9, 8)):
+        self.pixel = pixel
+        self.size = size
+
+    def convert(self, mode):
+        return self
+
+    def resize(self, size):
+        return Grey(self.pixel, size)
+
+    def getdata(self):
+        return [self.pixel(x, y) for y in range(self.size[1]) for x in range(self.size[0])]
+
+
+def test_dhash_bits_follow_horizontal_gradients():
+    assert image_dhash(Grey(lambda x, y: x)) == 0
+    assert image_dhash(Grey(lambda x, y: -x)) == (1 << 64) - 1
+    # Only the first row falls to the right
+    assert image_dhash(Grey(lambda x, y: -x if y == 0 else x)) == 0xFF << 56
+
+
+def test_dhash_survives_reencoding():
+    Image = pytest.importorskip("PIL.Image")
+    image = Image.radial_gradient("L").resize((320, 240)).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=60)
+    reencoded = Image.open(io.BytesIO(buffer.getvalue()))
+    assert bin(image_dhash(image) ^ image_dhash(reencoded)).count("1") <= 2
+
+
+def test_exact_hits_and_lru_eviction(clock):
+    cache = PredictionCache(max_entries=2)
+    cache.put("v1", "a", None, "plastic", 0.9)
+    cache.put("v1", "b", None, "glass", 0.8)
+    assert cache.get("v1", "a")[:2] == ("plastic", 0.9)
+    cache.put("v1", "c", None, "paper", 0.7)
+    # "b" was the least recently used
+    assert cache.get("v1", "b") is None
+    assert cache.get("v1", "a") is not None
+    assert cache.get("v2", "a") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_expire(clock):
+    cache = PredictionCache(ttl=60)
+    cache.put("v1", "a", None, "plastic", 0.9)
+    clock.now += 61
+    assert cache.get("v1", "a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_perceptual_match_needs_the_same_size(clock):
+    cache = PredictionCache()
+    cache.put("v1", "a", 0x1234, "plastic", 0.9, size=(640, 480))
+    assert cache.get_similar("v1", 0x1234, (640, 480))[0] == "plastic"
+    assert cache.get_similar("v1", 0x1234, (480, 640)) is None
+    # Exact-only entries are never perceptual targets
+    cache.put("v1", "b", 0x9999, "glass", 0.8)
+    assert cache.get_similar("v1", 0x9999, (640, 480)) is None
+
+
+def test_near_matches_within_the_distance(clock):
+    cache = PredictionCache(max_entries=1, phash_distance=4)
+    base = 0x0F0F_0F0F_0F0F_0F0F
+    cache.put("v1", "a", base, "plastic", 0.9, size=(100, 100))
+    assert cache.get_similar("v1", base ^ 0b1011, (100, 100))[0] == "plastic"
+    assert cache.get_similar("v1", base ^ 0b11111, (100, 100)) is None
+    # Evicted entries leave the buckets too
+    cache.put("v1", "b", None, "glass", 0.8)
+    assert cache.get_similar("v1", base ^ 0b1011, (100, 100)) is None
+    assert cache._phash_buckets == {}
+
+
+def test_persistent_tier_survives_reopening_and_is_pruned(tmp_path, clock):
+    path = str(tmp_path / "cache.db")
+    PredictionCache(path=path, ttl=60).put(
+        "v1", "a", 0x42, "plastic", 0.9, probabilities=[0.9, 0.1], size=(64, 48)
+    )
+    reopened = PredictionCache(path=path, ttl=60)
+    assert reopened.get("v1", "a") == ("plastic", 0.9, (0.9, 0.1), None)
+    assert PredictionCache(path=path, ttl=60).get_similar("v1", 0x42, (64, 48))[0] == "plastic"
+
+    clock.now += 61
+    reopened.prune()
+    assert reopened.stats()["pruned_rows"] == 1
+    assert PredictionCache(path=path, ttl=60).get("v1", "a") is None
+
+
+def test_persistent_tier_is_trimmed_to_max_rows(tmp_path, clock):
+    cache = PredictionCache(path=str(tmp_path / "cache.db"), max_rows=3, trim_every=1)
+    for i in range(5):
+        clock.now += 1
+        cache.put("v1", f"d{i}", None, "plastic", 0.9)
+    rows = cache._conn().execute("SELECT digest FROM predictions ORDER BY created_at").fetchall()
+    assert [row[0] for row in rows] == ["d2", "d3", "d4"]
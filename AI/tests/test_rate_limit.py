@@ -0,0 +1,85 @@
+import pytest
+
+import rate_limit
+from rate_limit import RateLimiter, MemoryBucketStore, SQLiteBucketStore, ConcurrencyLimiter, client_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    monkeypatch.setattr(rate_limit.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBucketStore()
+    return SQLiteBucketStore(str(tmp_path / "buckets.db"))
+
+
+def test_burst_then_refill(clock, store):
+    limiter = RateLimiter(rate=2, burst=4, store=store)
+    assert [limiter.check("ip:a") for _ in range(4)] == [0, 0, 0, 0]
+    assert limiter.check("ip:a") == pytest.approx(0.5)
+    # Other clients have their own bucket
+    assert limiter.check("ip:b") == 0
+
+    clock.now += 1.0
+    assert limiter.check("ip:a", cost=2) == 0
+    assert limiter.check("ip:a") > 0
+
+    # A bucket never holds more than the burst
+    clock.now += 60
+    assert limiter.check("ip:a", cost=4) == 0
+    assert limiter.check("ip:a") > 0
+    assert limiter.stats()["admitted"] == 7
+
+
+def test_check_without_consuming(clock, store):
+    limiter = RateLimiter(rate=1, burst=2, store=store)
+    assert limiter.check("ip:a", consume=False) == 0
+    assert limiter.check("ip:a", cost=2) == 0
+    assert limiter.check("ip:a", consume=False) == pytest.approx(1.0)
+    assert limiter.stats()["admitted"] == 1
+    assert limiter.stats()["rejected"] == 1
+
+
+def test_cost_above_burst_is_refused(clock):
+    limiter = RateLimiter(rate=1, burst=3)
+    with pytest.raises(ValueError):
+        limiter.check("ip:a", cost=4)
+
+
+def test_memory_store_drops_least_recently_used_buckets(clock):
+    limiter = RateLimiter(rate=1, burst=1, store=MemoryBucketStore(max_keys=2))
+    for key in ("ip:a", "ip:b", "ip:c"):
+        limiter.check(key)
+    assert limiter.stats()["clients"] == 2
+    # The dropped client comes back to a full bucket
+    assert limiter.check("ip:a") == 0
+
+
+def test_client_key_ignores_the_authorization_header():
+    assert client_key("10.0.0.1") == "ip:10.0.0.1"
+    assert client_key("10.0.0.1", "203.0.113.7, 10.0.0.1") == "ip:203.0.113.7"
+    assert client_key(None) == "ip:unknown"
+
+
+def test_concurrency_limiter_caps_in_flight():
+    limiter = ConcurrencyLimiter(4)
+    assert limiter.try_acquire(3)
+    assert not limiter.try_acquire(2)
+    limiter.release(3)
+    # A cost above the limit is capped, so it still runs on an idle server
+    assert limiter.try_acquire(10)
+    assert limiter.stats()["peak_in_flight"] == 4
@@ -1,12 +1,20 @@
 import os
+import time
+import json
+import shutil
+import hashlib
 import logging
-from datasets import load_dataset, DatasetDict
-from transformers import AutoImageProcessor, AutoModelForImageClassification, TrainingArguments, Trainer
+from datasets import load_dataset, load_from_disk, DatasetDict, Features, Array3D
+from transformers import AutoImageProcessor, AutoModelForImageClassification, TrainingArguments, Trainer, TrainerCallback
 from torchvision import transforms
 import torch
 from PIL import Image
 import numpy as np
 import sys
+from image_pipeline import FastPreprocessor
+from dedup_index import apply_split_file
+from labels import ID2LABEL, LABEL2ID
+from cascade import EARLY_EXIT_FILE, EarlyExitHead, distill_exit_head, evaluate_cascade, save_exit_head
 
 # --- Logging setup ---
 logging.basicConfig(level=logging.INFO)
@@ -16,11 +24,58 @@ logger = logging.getLogger("waste_classifier_train")
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DATASET_PATH = os.path.join(SCRIPT_DIR, "data")
 MODEL_SAVE_PATH = os.path.join(SCRIPT_DIR, "waste_classifier")
+# Duplicate-aware split written by `python dedup_index.py split`; empty uses the seeded random split
+SPLIT_FILE = os.environ.get("SPLIT_FILE", "")
+
+# Data pipeline: "cache" stores resized uint8 images once and reuses them across runs,
+# "lazy" decodes and preprocesses on the fly in DataLoader workers (nothing stored)
+DATA_MODE = os.environ.get("DATA_MODE", "cache")
+DATA_CACHE_DIR = os.environ.get("DATA_CACHE_DIR", os.path.join(SCRIPT_DIR, "data_cache"))
+PREPROCESS_NUM_PROC = int(os.environ.get("PREPROCESS_NUM_PROC", max(1, (os.cpu_count() or 1) // 2)))
+DATALOADER_WORKERS = int(os.environ.get("DATALOADER_WORKERS", min(4, os.cpu_count() or 1)))
+if DATA_MODE not in ("cache", "lazy"):
+    logger.error(f"Unknown DATA_MODE '{DATA_MODE}', expected 'cache' or 'lazy'")
+    sys.exit(1)
+
+# Training performance options
+TRAIN_BATCH_SIZE = int(os.environ.get("TRAIN_BATCH_SIZE", 8))
+EVAL_BATCH_SIZE = int(os.environ.get("EVAL_BATCH_SIZE", TRAIN_BATCH_SIZE))
+# Effective batch size = TRAIN_BATCH_SIZE * GRAD_ACCUM_STEPS
+GRAD_ACCUM_STEPS = int(os.environ.get("GRAD_ACCUM_STEPS", 1))
+NUM_EPOCHS = float(os.environ.get("NUM_EPOCHS", 3))
+LEARNING_RATE = float(os.environ.get("LEARNING_RATE", 2e-5))
+# bf16 autocast; on CPU it needs AVX512-BF16/AMX to be faster than fp32
+BF16 = os.environ.get("BF16", "0") == "1"
+DATALOADER_PREFETCH = int(os.environ.get("DATALOADER_PREFETCH", 2))
+# Train only the classifier head on top of the frozen ViT
+FREEZE_BACKBONE = os.environ.get("FREEZE_BACKBONE", "0") == "1"
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0))
+# Early-exit head for the API's cascade mode: a classifier after the first EARLY_EXIT_LAYERS
+# encoder layers, distilled from the trained model (0 disables). EARLY_EXIT_ONLY=1 fits it to
+# the model already saved in MODEL_SAVE_PATH instead of training a new one.
+EARLY_EXIT_LAYERS = int(os.environ.get("EARLY_EXIT_LAYERS", 0))
+EARLY_EXIT_ONLY = os.environ.get("EARLY_EXIT_ONLY", "0") == "1"
+EARLY_EXIT_EPOCHS = int(os.environ.get("EARLY_EXIT_EPOCHS", 2))
+EARLY_EXIT_LR = float(os.environ.get("EARLY_EXIT_LR", 1e-3))
+# Softmax temperature and weight of the teacher's soft targets against the hard labels
+DISTILL_TEMPERATURE = float(os.environ.get("DISTILL_TEMPERATURE", 2.0))
+DISTILL_ALPHA = float(os.environ.get("DISTILL_ALPHA", 0.5))
+if EARLY_EXIT_ONLY and not EARLY_EXIT_LAYERS:
+    logger.error("EARLY_EXIT_ONLY=1 needs EARLY_EXIT_LAYERS")
+    sys.exit(1)
+if TORCH_THREADS > 0:
+    torch.set_num_threads(TORCH_THREADS)
 
 # Print paths for debugging
 logger.info(f"Script directory: {SCRIPT_DIR}")
 logger.info(f"Dataset path: {DATASET_PATH}")
 logger.info(f"Model save path: {MODEL_SAVE_PATH}")
+logger.info(f"Data mode: {DATA_MODE}")
+logger.info(
+    f"Batch size {TRAIN_BATCH_SIZE} x {GRAD_ACCUM_STEPS} accumulation steps, bf16={BF16}, "
+    f"freeze_backbone={FREEZE_BACKBONE}, torch threads={torch.get_num_threads()}, "
+    f"dataloader workers={DATALOADER_WORKERS}"
+)
 
 # Check if dataset path exists
 if not os.path.exists(DATASET_PATH):
@@ -35,29 +90,6 @@ if not os.path.exists(DATASET_PATH):
     logger.info("      image4.jpg")
     sys.exit(1)
 
-LABEL2INFO = {
-    0: {
-        "label": "biodegradable",
-        "description": "Easily breaks down naturally. Good for composting.",
-        "recyclable": False,
-        "disposal": "Use compost or organic bin",
-        "example_items": ["banana peel", "food waste", "paper"],
-        "environmental_benefit": "Composting biodegradable waste returns nutrients to the soil, reduces landfill use, and lowers greenhouse gas emissions.",
-        "protection_tip": "Compost at home or use municipal organic waste bins. Avoid mixing with plastics or hazardous waste.",
-        "poor_disposal_effects": "If disposed of improperly, biodegradable waste can cause methane emissions in landfills and contribute to water pollution and eutrophication."
-    },
-    1: {
-        "label": "non_biodegradable",
-        "description": "Does not break down easily. Should be disposed of carefully.",
-        "recyclable": False,
-        "disposal": "Use general waste bin or recycling if possible",
-        "example_items": ["plastic bag", "styrofoam", "metal can"],
-        "environmental_benefit": "Proper disposal and recycling of non-biodegradable waste reduces pollution, conserves resources, and protects wildlife.",
-        "protection_tip": "Reduce use, reuse items, and recycle whenever possible. Never burn or dump in nature.",
-        "poor_disposal_effects": "Improper disposal leads to soil and water pollution, harms wildlife, and causes long-term environmental damage. Plastics can persist for hundreds of years."
-    }
-}
-
 # --- Dataset loading ---
 logger.info(f"Loading dataset from {DATASET_PATH}")
 try:
@@ -81,14 +113,18 @@ except Exception as e:
     sys.exit(1)
 
 # --- Split train/val/test ---
-logger.info("Splitting dataset (80% train, 10% val, 10% test)")
-split = dataset["train"].train_test_split(test_size=0.2, seed=42)
-val_test = split["test"].train_test_split(test_size=0.5, seed=42)
-dataset = DatasetDict({
-    "train": split["train"],
-    "val": val_test["train"],
-    "test": val_test["test"]
-})
+if SPLIT_FILE:
+    logger.info(f"Splitting dataset as listed in {SPLIT_FILE}")
+    dataset = apply_split_file(dataset["train"], SPLIT_FILE)
+else:
+    logger.info("Splitting dataset (80% train, 10% val, 10% test)")
+    split = dataset["train"].train_test_split(test_size=0.2, seed=42)
+    val_test = split["test"].train_test_split(test_size=0.5, seed=42)
+    dataset = DatasetDict({
+        "train": split["train"],
+        "val": val_test["train"],
+        "test": val_test["test"]
+    })
 
 logger.info(f"Train samples: {len(dataset['train'])}")
 logger.info(f"Val samples: {len(dataset['val'])}")
@@ -97,15 +133,23 @@ logger.info(f"Test samples: {len(dataset['test'])}")
 # --- Preprocessing ---
 logger.info("Setting up transforms and processor")
 image_processor = AutoImageProcessor.from_pretrained("google/vit-base-patch16-224", use_fast=True)
+# Same resize and normalization as the processor, split so images can be stored as uint8
+# and normalized per batch (the serving API preprocesses with the same class)
+preprocessor = FastPreprocessor(image_processor)
 
-# Updated preprocessing function that's compatible with the trainer
 def transform_images(examples):
-    """Transform a batch of images"""
+    """Transform a batch of images into normalized pixel_values (lazy mode)"""
     images = [image.convert("RGB") if image.mode != "RGB" else image for image in examples["image"]]
     # Use the image processor directly instead of manual transforms
     inputs = image_processor(images, return_tensors="pt")
-    examples["pixel_values"] = inputs["pixel_values"]
-    return examples
+    return {"pixel_values": inputs["pixel_values"], "label": examples["label"]}
+
+def resize_images(examples):
+    """Resize a batch of images to uint8 (3, H, W) arrays for the cache (a quarter of float32)"""
+    return {
+        "pixel_values": [preprocessor.resize(image) for image in examples["image"]],
+        "label": examples["label"]
+    }
 
 # --- Relabel O/R folders to biodegradable/non_biodegradable ---
 def relabel_OR_to_standard(example):
@@ -137,52 +181,171 @@ dataset["train"] = dataset["train"].map(relabel_OR_to_standard)
 dataset["val"] = dataset["val"].map(relabel_OR_to_standard)
 dataset["test"] = dataset["test"].map(relabel_OR_to_standard)
 
-# Apply transforms
-logger.info("Applying transforms...")
-dataset["train"] = dataset["train"].map(transform_images, batched=True, batch_size=32)
-dataset["val"] = dataset["val"].map(transform_images, batched=True, batch_size=32)
-dataset["test"] = dataset["test"].map(transform_images, batched=True, batch_size=32)
+def data_fingerprint():
+    """Identifies the cached data: the source splits plus everything that affects preprocessing"""
+    key = {
+        "version": 1,
+        "splits": {name: dataset[name]._fingerprint for name in dataset},
+        "size": preprocessor.size,
+        "resample": int(preprocessor.resample),
+        "do_resize": preprocessor.do_resize,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+def build_cache():
+    """Load the uint8 cache for this data and processor, creating it on the first run"""
+    cache_path = os.path.join(DATA_CACHE_DIR, data_fingerprint())
+    if os.path.exists(os.path.join(cache_path, "dataset_dict.json")):
+        logger.info(f"Using preprocessed cache {cache_path}")
+        # Memory-mapped Arrow files: nothing is read until a batch needs it
+        return load_from_disk(cache_path)
+
+    logger.info(f"Building preprocessed cache {cache_path} with {PREPROCESS_NUM_PROC} processes...")
+    width, height = preprocessor.size
+    features = Features({
+        "pixel_values": Array3D(shape=(3, height, width), dtype="uint8"),
+        "label": dataset["train"].features["label"],
+    })
+    cached = DatasetDict({
+        name: split_data.map(
+            resize_images,
+            batched=True,
+            batch_size=64,
+            num_proc=PREPROCESS_NUM_PROC,
+            remove_columns=split_data.column_names,
+            features=features,
+            load_from_cache_file=False,
+        )
+        for name, split_data in dataset.items()
+    })
+    # Write to a temporary directory first, so an interrupted run never leaves a half-written cache
+    temp_path = cache_path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    cached.save_to_disk(temp_path)
+    os.replace(temp_path, cache_path)
+    # The intermediate map() files are a second copy of the cache
+    cached.cleanup_cache_files()
+    return load_from_disk(cache_path)
 
-# Set format for PyTorch
-dataset["train"].set_format("torch", columns=["pixel_values", "label"])
-dataset["val"].set_format("torch", columns=["pixel_values", "label"])
-dataset["test"].set_format("torch", columns=["pixel_values", "label"])
+if DATA_MODE == "cache":
+    dataset = build_cache()
+    dataset.set_format("torch", columns=["pixel_values", "label"])
+else:
+    # Preprocessed when a batch is fetched, in DATALOADER_WORKERS processes
+    for name in dataset:
+        dataset[name].set_transform(transform_images)
 
-# Updated collate function
 def collate_fn(batch):
     pixel_values = torch.stack([item["pixel_values"] for item in batch])
+    if pixel_values.dtype == torch.uint8:
+        # Cached images are normalized per batch
+        pixel_values = preprocessor.normalize(pixel_values)
     labels = torch.tensor([item["label"] for item in batch], dtype=torch.long)
     return {"pixel_values": pixel_values, "labels": labels}
 
+def fit_early_exit_head(model):
+    """Distill an early-exit head from `model`, report the cascade on the validation split and save it"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    for param in model.parameters():
+        param.requires_grad = False
+    loader_options = {
+        "collate_fn": collate_fn,
+        "num_workers": DATALOADER_WORKERS,
+        "pin_memory": torch.cuda.is_available()
+    }
+    train_loader = torch.utils.data.DataLoader(dataset["train"], batch_size=TRAIN_BATCH_SIZE, shuffle=True, **loader_options)
+    val_loader = torch.utils.data.DataLoader(dataset["val"], batch_size=EVAL_BATCH_SIZE, **loader_options)
+
+    logger.info(
+        f"Distilling an early-exit head after {EARLY_EXIT_LAYERS} layers "
+        f"({EARLY_EXIT_EPOCHS} epochs, temperature {DISTILL_TEMPERATURE}, alpha {DISTILL_ALPHA})"
+    )
+    head = distill_exit_head(
+        model, EarlyExitHead.for_model(model, EARLY_EXIT_LAYERS), train_loader,
+        epochs=EARLY_EXIT_EPOCHS, learning_rate=EARLY_EXIT_LR,
+        temperature=DISTILL_TEMPERATURE, alpha=DISTILL_ALPHA, device=device
+    )
+    report = evaluate_cascade(
+        model, head, ((batch["pixel_values"], batch["labels"]) for batch in val_loader), device=device
+    )
+    logger.info(f"Cascade on the validation split:\n{json.dumps(report, indent=2)}")
+    save_exit_head(head.cpu(), os.path.join(MODEL_SAVE_PATH, EARLY_EXIT_FILE))
+
 # --- Model ---
-id2label = {0: "biodegradable", 1: "non_biodegradable"}
-label2id = {v: k for k, v in id2label.items()}
+if EARLY_EXIT_ONLY:
+    logger.info(f"Loading trained model from {MODEL_SAVE_PATH}")
+    model = AutoModelForImageClassification.from_pretrained(MODEL_SAVE_PATH, local_files_only=True)
+    fit_early_exit_head(model)
+    sys.exit(0)
+
 logger.info("Loading ViT model")
 model = AutoModelForImageClassification.from_pretrained(
     "google/vit-base-patch16-224",
-    num_labels=2,
-    id2label=id2label,
-    label2id=label2id,
+    num_labels=len(ID2LABEL),
+    id2label=ID2LABEL,
+    label2id=LABEL2ID,
     ignore_mismatched_sizes=True
 )
 
+if FREEZE_BACKBONE:
+    for param in model.base_model.parameters():
+        param.requires_grad = False
+trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
+logger.info(f"Trainable parameters: {trainable:,} of {sum(p.numel() for p in model.parameters()):,}")
+
+class ThroughputCallback(TrainerCallback):
+    """Log training throughput (samples/sec) every `logging_steps` optimizer steps"""
+
+    def __init__(self, samples_per_step):
+        self.samples_per_step = samples_per_step
+        self.rates = []
+
+    def _reset(self, state):
+        self._started = time.perf_counter()
+        self._start_step = state.global_step
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._reset(state)
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        # Evaluation time is not training throughput
+        self._reset(state)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        steps = state.global_step - self._start_step
+        if steps < args.logging_steps:
+            return
+        rate = steps * self.samples_per_step / (time.perf_counter() - self._started)
+        self.rates.append(rate)
+        logger.info(f"Step {state.global_step}: {rate:.1f} samples/sec")
+        self._reset(state)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.rates:
+            logger.info(f"Average training throughput: {sum(self.rates) / len(self.rates):.1f} samples/sec")
+
 # --- Training ---
 logger.info("Setting up Trainer and TrainingArguments")
 training_args = TrainingArguments(
     output_dir=os.path.join(SCRIPT_DIR, "vit_trainer_output"),
-    per_device_train_batch_size=8,
-    per_device_eval_batch_size=8,
+    per_device_train_batch_size=TRAIN_BATCH_SIZE,
+    per_device_eval_batch_size=EVAL_BATCH_SIZE,
+    gradient_accumulation_steps=GRAD_ACCUM_STEPS,
     eval_strategy="epoch",  # Fixed parameter name
     save_strategy="epoch",
-    num_train_epochs=3,
-    learning_rate=2e-5,
+    num_train_epochs=NUM_EPOCHS,
+    learning_rate=LEARNING_RATE,
+    bf16=BF16,
     logging_dir=os.path.join(SCRIPT_DIR, "vit_logs"),
     logging_steps=10,
     load_best_model_at_end=True,
     metric_for_best_model="accuracy",
     save_total_limit=1,
     report_to=[],
-    dataloader_pin_memory=False,  # Disable pin memory to avoid the warning
+    dataloader_pin_memory=torch.cuda.is_available(),  # Pinning only helps host-to-GPU copies
+    dataloader_num_workers=DATALOADER_WORKERS,
+    dataloader_prefetch_factor=DATALOADER_PREFETCH if DATALOADER_WORKERS > 0 else None,
+    dataloader_persistent_workers=DATALOADER_WORKERS > 0,
     remove_unused_columns=False,  # Keep all columns
 )
 
@@ -199,6 +362,7 @@ trainer = Trainer(
     eval_dataset=dataset["val"],
     data_collator=collate_fn,
     compute_metrics=compute_metrics,
+    callbacks=[ThroughputCallback(TRAIN_BATCH_SIZE * GRAD_ACCUM_STEPS)],
 )
 
 logger.info("Starting training...")
@@ -245,4 +409,7 @@ try:
     test_processor = AutoImageProcessor.from_pretrained(MODEL_SAVE_PATH, local_files_only=True)
     logger.info("✅ Model can be loaded successfully!")
 except Exception as e:
-    logger.error(f"❌ Failed to load saved model: {e}")
\ No newline at end of file
+    logger.error(f"❌ Failed to load saved model: {e}")
+
+if EARLY_EXIT_LAYERS:
+    fit_early_exit_head(model)
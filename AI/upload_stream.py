@@ -0,0 +1,214 @@
+import struct
+import tempfile
+from flask import Request
+
+SUPPORTED_FORMATS = ("JPEG", "PNG", "WEBP")
+
+# JPEG start-of-frame markers carry the image dimensions
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Stop looking for dimensions after this many bytes and leave the check to the decoder
+SNIFF_LIMIT = 256 * 1024
+# Uploads larger than this are spooled to a temporary file, as Werkzeug does for its own file streams
+SPOOL_BYTES = 500 * 1024
+
+
+class UploadRejected(ValueError):
+    """An uploaded file was refused before decoding; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status, reason):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+def identify_format(head):
+    """Image format from the magic bytes, or None when unknown ('' when more bytes are needed)"""
+    if len(head) < 12:
+        return ""
+    head = bytes(head[:12])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "GIF"
+    if head[:2] == b"BM":
+        return "BMP"
+    return None
+
+
+def _jpeg_size(head):
+    offset = 2
+    length = len(head)
+    while offset + 4 <= length:
+        if head[offset] != 0xFF:
+            raise ValueError("Corrupt JPEG header")
+        marker = head[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            offset += 2
+            continue
+        if marker in _JPEG_SOF:
+            if offset + 9 > length:
+                return None
+            height, width = struct.unpack_from(">HH", head, offset + 5)
+            return width, height
+        segment_length = struct.unpack_from(">H", head, offset + 2)[0]
+        offset += 2 + segment_length
+    return None
+
+
+def image_size(image_format, head):
+    """(width, height) from the header bytes, or None if they are not in `head` yet"""
+    if image_format == "JPEG":
+        return _jpeg_size(head)
+    if image_format == "PNG":
+        if len(head) < 24:
+            return None
+        return struct.unpack_from(">II", head, 16)
+    if image_format == "WEBP":
+        if len(head) < 30:
+            return None
+        chunk = bytes(head[12:16])
+        if chunk == b"VP8 ":
+            width, height = struct.unpack_from("<HH", head, 26)
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = struct.unpack_from("<I", head, 21)[0]
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            width = int.from_bytes(bytes(head[24:27]), "little") + 1
+            height = int.from_bytes(bytes(head[27:30]), "little") + 1
+            return width, height
+        raise ValueError("Corrupt WEBP header")
+    if image_format == "GIF":
+        if len(head) < 10:
+            return None
+        return struct.unpack_from("<HH", head, 6)
+    if image_format == "BMP":
+        if len(head) < 26:
+            return None
+        width, height = struct.unpack_from("<ii", head, 18)
+        return abs(width), abs(height)
+    return None
+
+
+class SniffingUpload:
+    """Target for one uploaded file that checks it while it streams in.
+
+    Werkzeug writes each file part of a multipart body here chunk by chunk.
+    The format is identified from the magic bytes and the dimensions from
+    the header, usually within the first few kilobytes. Once a file is over
+    `max_bytes`, in an unsupported format or over `max_pixels`, the rest of
+    it is discarded instead of buffered, and reading it raises
+    UploadRejected. Other parts of the request are not affected, so
+    /predict/batch can still report per image. Like Werkzeug's own file
+    streams, the bytes are held in memory up to `spool_bytes` and spilled
+    to a temporary file beyond that, so large uploads waiting for the
+    model don't all sit in RAM.
+    """
+
+    def __init__(self, max_bytes=None, max_pixels=None, formats=SUPPORTED_FORMATS, spool_bytes=SPOOL_BYTES):
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.formats = tuple(formats)
+        self.format = None
+        self.dimensions = None
+        self.rejected = None
+        self.received = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_bytes, mode="w+b")
+        # The first bytes of the file, kept apart for sniffing until the header is checked
+        self._head = bytearray()
+        self._header_done = False
+
+    def write(self, data):
+        self.received += len(data)
+        if self.rejected is not None:
+            return len(data)
+        if self.max_bytes and self.received > self.max_bytes:
+            self._reject(f"Image file is larger than {self.max_bytes / (1024 * 1024):g} MB", 413, "upload_too_large")
+            return len(data)
+        written = self._file.write(data)
+        if not self._header_done:
+            self._head += data
+            self._sniff()
+        return written
+
+    def _reject(self, message, status, reason):
+        self.rejected = UploadRejected(message, status, reason)
+        # Drop what was buffered so far
+        self._head = bytearray()
+        self._file.seek(0)
+        self._file.truncate()
+
+    def _sniff(self):
+        try:
+            problem = self._check_header(self._head)
+        except (ValueError, struct.error):
+            problem = ("Corrupt image header", 400, "corrupt_image")
+        if problem is not None:
+            self._header_done = True
+            self._reject(*problem)
+        elif self.dimensions is not None or len(self._head) >= SNIFF_LIMIT:
+            # Dimensions buried behind large metadata are left to the decoder's check
+            self._header_done = True
+            self._head = bytearray()
+
+    def _check_header(self, head):
+        """Returns (message, status, reason) if the file must be refused"""
+        if self.format is None:
+            image_format = identify_format(head)
+            if image_format == "":
+                return None
+            if image_format not in self.formats:
+                message = f"Unsupported image format ({image_format or 'unknown'}); expected {', '.join(self.formats)}"
+                return message, 415, "unsupported_format"
+            self.format = image_format
+        self.dimensions = image_size(self.format, head)
+        if self.dimensions is not None and self.max_pixels:
+            width, height = self.dimensions
+            if width * height > self.max_pixels:
+                return f"Image is {width}x{height}, more than {self.max_pixels} pixels", 413, "image_too_large"
+        return None
+
+    def value(self):
+        """The uploaded bytes, read into memory for decoding; raises UploadRejected for refused files"""
+        if self.rejected is not None:
+            raise self.rejected
+        if self.format is None:
+            raise UploadRejected("Empty or truncated image upload", 400, "corrupt_image")
+        self._file.seek(0)
+        return self._file.read()
+
+    def __getattr__(self, name):
+        # seek, read, close, ... for Werkzeug and FileStorage go to the spooled file
+        if name == "_file":
+            raise AttributeError(name)
+        return getattr(self._file, name)
+
+
+class StreamingUploadRequest(Request):
+    """Flask request whose uploaded files stream into SniffingUpload buffers.
+
+    Subclass it and set the upload_* attributes, then install it with
+    `app.request_class`.
+    """
+
+    upload_max_bytes = None
+    upload_max_pixels = None
+    upload_formats = SUPPORTED_FORMATS
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SniffingUpload(self.upload_max_bytes, self.upload_max_pixels, self.upload_formats)
+
+
+def read_upload(file):
+    """Bytes of an uploaded FileStorage, raising UploadRejected if it was refused while streaming"""
+    if isinstance(file.stream, SniffingUpload):
+        return file.stream.value()
+    return file.read()
@@ -1,35 +1,749 @@
 import os
-import gc
-import json
-import requests
+import hmac
+import math
+import uuid
+import atexit
+import queue
+import logging
+import logging.handlers
+import threading
 from datetime import datetime
-from PIL import Image
 import torch
 import torch.nn.functional as F
-from torchvision import transforms
-from flask import Flask, request, jsonify
-from transformers import AutoImageProcessor, AutoModelForImageClassification
+from flask import Flask, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
+from startup import StartupState, find_model_file, load_pretrained
+from batching import MicroBatcher
+from backend_delivery import BackendDelivery
+from outbox import Outbox
+from prediction_cache import PredictionCache, content_digest, image_dhash
+from inference_backends import INFERENCE_BACKENDS, InferenceBackend, default_onnx_path
+from image_pipeline import (
+    FastPreprocessor, ImageTooLarge, decode_image, check_parity, check_decode_parity, parity_images, parity_jpegs
+)
+from metrics import MetricsRegistry, StageTimer, SlowRequestProfiler
+from memory import MemoryManager
+from upload_stream import StreamingUploadRequest, UploadRejected, read_upload
+from dedup_index import EmbeddingIndex, ClassifierInputHook, NearDuplicateLookup
+from model_registry import ModelRegistry, ModelVersion, model_key, version_id
+from cascade import EARLY_EXIT_FILE, CascadeClassifier, load_exit_head
+from labels import LABEL2INFO
+from rate_limit import RateLimiter, MemoryBucketStore, SQLiteBucketStore, ConcurrencyLimiter, client_key
+import fast_json
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- Logging setup ---
+# Records are handed to a background listener thread, so request threads never block on stdout
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s"))
+logging.basicConfig(level=LOG_LEVEL, handlers=[logging.handlers.QueueHandler(log_queue)], force=True)
+log_listener = None
+
+def start_log_listener():
+    """(Re)start the thread that writes queued log records; threads don't survive a fork"""
+    global log_listener
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+    log_listener.start()
+
+start_log_listener()
+atexit.register(lambda: log_listener.stop())
+logger = logging.getLogger("waste_classifier_api")
+
+# --- Metrics ---
+metrics = MetricsRegistry("waste_api")
+REQUESTS = metrics.counter("requests_total", "HTTP requests by route and status code", ("route", "status"))
+ERRORS = metrics.counter("errors_total", "Request errors by type", ("type",))
+PREDICTIONS = metrics.counter("predictions_total", "Predictions by label and source (model or cache)", ("label", "source"))
+CONFIDENCE = metrics.histogram(
+    "prediction_confidence", "Confidence of served predictions", ("label",),
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99, 1.0)
+)
+REQUEST_SECONDS = metrics.histogram("request_duration_seconds", "Request latency by route", ("route",))
+STAGE_SECONDS = metrics.histogram(
+    "stage_duration_seconds",
+    "Time per pipeline stage (upload, cache_lookup, decode, inference and backend_enqueue per request; "
+    "preprocess, forward, softmax and near_duplicate per batch)",
+    ("stage",)
+)
+MODEL_PREDICTIONS = metrics.counter(
+    "model_predictions_total", "Predictions by model version and role (active, candidate or shadow)", ("version", "role")
+)
+BACKEND_POST_SECONDS = metrics.histogram("backend_post_duration_seconds", "Backend POST latency by outcome", ("outcome",))
+ADMISSION = metrics.counter(
+    "admission_total", "Prediction requests by admission outcome (admitted, rate_limited or overloaded)", ("outcome",)
+)
+
+# Optional sampled profiler: keeps cProfile dumps of sampled requests slower than SLOW_REQUEST_MS
+profiler = SlowRequestProfiler(
+    sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", 0)),
+    slow_ms=float(os.environ.get("SLOW_REQUEST_MS", 1000)),
+    output_dir=os.environ.get("PROFILE_DIR", os.path.join(SCRIPT_DIR, "profiles"))
+)
+
+# Startup status ("starting" -> "warming" -> "ready") and phase timings, reported on /health
+startup = StartupState()
 
 # Set device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load processor and model
-processor = AutoImageProcessor.from_pretrained("Claudineuwa/waste_classifier_Isaac")
-model = AutoModelForImageClassification.from_pretrained("Claudineuwa/waste_classifier_Isaac").to(device)
+# Upload limits, enforced before anything is decoded
+MAX_UPLOAD_MB = float(os.environ.get("MAX_UPLOAD_MB", 64))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 40_000_000))
+MAX_IMAGE_MB = float(os.environ.get("MAX_IMAGE_MB", 20))
+ALLOWED_IMAGE_FORMATS = tuple(
+    f.strip().upper() for f in os.environ.get("ALLOWED_IMAGE_FORMATS", "JPEG,PNG,WEBP").split(",") if f.strip()
+)
+
+# Maximum number of images accepted by /predict/batch in one upload
+BATCH_MAX_IMAGES = int(os.environ.get("BATCH_MAX_IMAGES", 32))
+
+# Admission control for the prediction routes. Each client IP has a token bucket of
+# RATE_LIMIT_BURST images refilled at RATE_LIMIT_PER_SEC (0 disables rate limiting).
+RATE_LIMIT_PER_SEC = float(os.environ.get("RATE_LIMIT_PER_SEC", 5))
+# At least BATCH_MAX_IMAGES, so a full batch can always be paid for
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 32))
+# SQLite file holding the buckets for all workers; empty keeps them per process
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "")
+# Key anonymous clients by the first X-Forwarded-For address (only behind a proxy that sets it)
+RATE_LIMIT_TRUST_PROXY = os.environ.get("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+# Images decoded and classified at once per process; beyond it requests get 503 (0 = no limit)
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 64))
+OVERLOAD_RETRY_AFTER = os.environ.get("OVERLOAD_RETRY_AFTER", "1")
+# Browser origins allowed to call the API, comma-separated ("*" allows any)
+CORS_ALLOWED_ORIGINS = [
+    origin.strip() for origin in os.environ.get("CORS_ALLOWED_ORIGINS", "*").split(",") if origin.strip()
+]
+
+if RATE_LIMIT_PER_SEC > 0 and RATE_LIMIT_BURST < BATCH_MAX_IMAGES:
+    logger.warning(
+        "RATE_LIMIT_BURST (%g) is below BATCH_MAX_IMAGES (%d); raising it so a full batch can be paid for",
+        RATE_LIMIT_BURST, BATCH_MAX_IMAGES
+    )
+    RATE_LIMIT_BURST = float(BATCH_MAX_IMAGES)
+
+rate_limiter = RateLimiter(
+    RATE_LIMIT_PER_SEC,
+    RATE_LIMIT_BURST,
+    SQLiteBucketStore(RATE_LIMIT_STORE) if RATE_LIMIT_STORE else MemoryBucketStore()
+) if RATE_LIMIT_PER_SEC > 0 else None
+inference_limiter = ConcurrencyLimiter(MAX_IN_FLIGHT)
+
+# Garbage collection runs in the background when RSS grows, never per request
+memory_manager = MemoryManager(
+    interval=float(os.environ.get("GC_CHECK_INTERVAL", 5)),
+    growth_mb=float(os.environ.get("GC_RSS_GROWTH_MB", 64)),
+    max_interval=float(os.environ.get("GC_MAX_INTERVAL", 300)),
+    empty_cuda_cache=device.type == "cuda"
+)
+
+# Model source: a pinned local snapshot if present, else the Hugging Face cache, else the hub.
+# Create the snapshot with: python startup.py <MODEL_NAME> <MODEL_LOCAL_DIR> [MODEL_REVISION]
+MODEL_NAME = os.environ.get("MODEL_NAME", "Claudineuwa/waste_classifier_Isaac")
+MODEL_REVISION = os.environ.get("MODEL_REVISION") or None
+MODEL_LOCAL_DIR = os.environ.get("MODEL_LOCAL_DIR", os.path.join(SCRIPT_DIR, "models", MODEL_NAME.replace("/", "__")))
+
+# "blocking" loads the model at import (needed for gunicorn's preload), "background"
+# starts serving /health immediately and loads the model in a thread
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "blocking")
+
+# Inference backend: eager (fp32), int8, compile or onnx
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager")
+
+# Fast image path: reduced-size JPEG decoding and buffered normalization.
+# The fast preprocessor is only used if it matches the processor's output.
+FAST_DECODE = os.environ.get("FAST_DECODE", "1") == "1"
+FAST_PREPROCESS = os.environ.get("FAST_PREPROCESS", "1") == "1"
+PREPROCESS_PARITY_TOLERANCE = float(os.environ.get("PREPROCESS_PARITY_TOLERANCE", 1e-4))
+# Fast decoding is only used if it moves no class probability on the parity JPEGs by more than this
+DECODE_PARITY_TOLERANCE = float(os.environ.get("DECODE_PARITY_TOLERANCE", 0.05))
+
+# Near-duplicate index built with `python dedup_index.py build` (empty disables it). Uploads whose
+# embedding is this similar to an indexed image get that image's label. Needs the eager or int8 backend.
+DEDUP_INDEX_PATH = os.environ.get("DEDUP_INDEX_PATH", "")
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", 0.97))
+DEDUP_NPROBE = int(os.environ.get("DEDUP_NPROBE", 4))
+
+# Cascade mode: images the early-exit head (train.py EARLY_EXIT_LAYERS) is at least this confident
+# about are answered after its layers, the rest go on through the full model. 0 disables it.
+CASCADE_THRESHOLD = float(os.environ.get("CASCADE_THRESHOLD", 0))
+# Early-exit head file; empty uses the one saved with the model
+EARLY_EXIT_PATH = os.environ.get("EARLY_EXIT_PATH", "")
+
+# Model registry: versions resident in this process, the active one and the traffic split
+MODEL_MAX_RESIDENT = int(os.environ.get("MODEL_MAX_RESIDENT", 2))
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", 0))
+# Shared by all workers (and kept across restarts); empty keeps changes in the process that received them
+MODEL_REGISTRY_STATE = os.environ.get("MODEL_REGISTRY_STATE", "")
+MODEL_REGISTRY_POLL = float(os.environ.get("MODEL_REGISTRY_POLL", 10))
+# Token for the /admin routes (sent as X-Admin-Token); empty disables them
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+def load_model(source, revision=None, options=None):
+    """Load one model version, set up its inference backend and warm it up"""
+    options = options or {}
+    backend = options.get("backend", INFERENCE_BACKEND)
+    dedup_index = options.get("dedup_index")
+    # The first load is the service's startup; later ones only time themselves
+    phases = startup if not startup.ready else StartupState()
+
+    if source == MODEL_NAME and revision == MODEL_REVISION:
+        local_dir = MODEL_LOCAL_DIR
+    elif os.path.isdir(source):
+        local_dir = source
+    else:
+        local_dir = os.path.join(SCRIPT_DIR, "models", source.replace("/", "__"))
+
+    with phases.phase("load_model"):
+        processor, model, model_source = load_pretrained(source, revision, local_dir)
+        model = model.to(device)
+    version = version_id(source, revision, model.config, local_dir if model_source == "local snapshot" else None)
+    logger.info("Model version: %s", version)
+
+    with phases.phase("inference_backend"):
+        # Exports are cached per version, so a new checkpoint is never served from a stale export
+        inference = InferenceBackend(
+            model,
+            backend,
+            device=device,
+            onnx_path=options.get("onnx_path") or default_onnx_path(version, os.path.join(SCRIPT_DIR, "onnx"))
+        )
+    logger.info("Inference backend: %s", backend)
+
+    near_duplicates = embedding_hook = None
+    if dedup_index:
+        if backend not in ("eager", "int8"):
+            logger.warning("Near-duplicate lookup needs the eager or int8 backend, not %s; disabled", backend)
+        else:
+            with phases.phase("dedup_index"):
+                index = EmbeddingIndex.load(dedup_index)
+                embedding_hook = ClassifierInputHook(inference.model)
+                near_duplicates = NearDuplicateLookup(index, DEDUP_THRESHOLD, DEDUP_NPROBE)
+            logger.info("Near-duplicate index: %d images from %s (built with %s)", len(index), dedup_index, index.model_name)
+
+    cascade = None
+    cascade_threshold = float(options.get("cascade_threshold", CASCADE_THRESHOLD))
+    if cascade_threshold > 0:
+        head_path = options.get("early_exit") or find_model_file(source, EARLY_EXIT_FILE, revision, local_dir, model_source)
+        if backend not in ("eager", "int8"):
+            logger.warning("Cascade mode needs the eager or int8 backend, not %s; disabled", backend)
+        elif near_duplicates is not None:
+            # The lookup needs every image's full-model embedding, which early exits never compute
+            logger.warning("Cascade mode can't be combined with the near-duplicate index; disabled")
+        elif not head_path:
+            logger.warning("CASCADE_THRESHOLD is set but %s has no %s; cascade mode disabled", source, EARLY_EXIT_FILE)
+        else:
+            with phases.phase("early_exit"):
+                cascade = CascadeClassifier(inference.model, load_exit_head(head_path, device), cascade_threshold, device)
+            logger.info(
+                "Cascade mode: early exit after %d layers, threshold %.2f (%s)",
+                len(cascade.early_layers), cascade_threshold, head_path
+            )
+
+    fast_preprocessor = None
+    if FAST_PREPROCESS:
+        with phases.phase("preprocess_parity"):
+            candidate = FastPreprocessor(processor)
+            parity_diff = check_parity(processor, candidate, parity_images())
+        if parity_diff > PREPROCESS_PARITY_TOLERANCE:
+            logger.warning("Fast preprocessing differs from the processor by %.2e, using the processor", parity_diff)
+        else:
+            logger.info("Fast preprocessing enabled (max difference %.2e)", parity_diff)
+            fast_preprocessor = candidate
+
+    loaded = ModelVersion(
+        model_key(source, revision), version, inference, model.config.id2label, processor=processor,
+        fast_preprocessor=fast_preprocessor, near_duplicates=near_duplicates, embedding_hook=embedding_hook,
+        cascade=cascade
+    )
+    if FAST_DECODE:
+        with phases.phase("decode_parity"):
+            prob_diff, agreement = check_decode_parity(
+                processor, lambda images: preprocess(images, loaded), loaded.inference, parity_jpegs(), decode_size(loaded)
+            )
+        if prob_diff > DECODE_PARITY_TOLERANCE:
+            logger.warning(
+                "Fast decoding changes probabilities by up to %.4f (top-1 agreement %.2f), decoding at full size",
+                prob_diff, agreement
+            )
+            loaded.fast_decode = False
+        else:
+            logger.info("Fast decoding enabled (max probability difference %.4f, top-1 agreement %.2f)", prob_diff, agreement)
+    if not startup.ready:
+        startup.set_status("warming")
+    with phases.phase("warm_up"):
+        warm_up(loaded)
+    loaded.timings = dict(phases.timings)
+    return loaded
+
+def warm_up(version):
+    """Run throwaway forward passes so the first real request doesn't pay for lazy initialization"""
+    images = parity_images(count=max(1, BATCH_MAX_SIZE))
+    classify_images(images[:1], version)
+    if len(images) > 1:
+        classify_images(images, version)
+
+registry = ModelRegistry(
+    load_model,
+    max_resident=MODEL_MAX_RESIDENT,
+    memory_budget_mb=MODEL_MEMORY_BUDGET_MB,
+    state_path=MODEL_REGISTRY_STATE,
+    poll_interval=MODEL_REGISTRY_POLL,
+    on_unload=lambda: memory_manager.collect(reason="model_unloaded")
+)
+
+def start():
+    """Load the model according to STARTUP_MODE"""
+    def run():
+        try:
+            options = {
+                "dedup_index": DEDUP_INDEX_PATH,
+                "onnx_path": os.environ.get("ONNX_MODEL_PATH"),
+                "early_exit": EARLY_EXIT_PATH
+            }
+            registry.boot(MODEL_NAME, MODEL_REVISION, {k: v for k, v in options.items() if v})
+            startup.set_status("ready")
+        except Exception as e:
+            logger.exception("Startup failed: %s", e)
+            startup.set_status("failed", error=str(e))
+            if STARTUP_MODE != "background":
+                raise
+
+    if STARTUP_MODE == "background":
+        threading.Thread(target=run, name="model-loader", daemon=True).start()
+    else:
+        run()
+
+def decode_size(version):
+    """The size JPEGs are decoded to for `version`: its input size"""
+    return version.fast_preprocessor.size if version.fast_preprocessor is not None else (224, 224)
+
+def load_image(data, version):
+    """Decode an upload into an upright RGB image, straight to about `version`'s input size for JPEGs.
+
+    Both paths apply the EXIF orientation; only the reduced-scale decode
+    depends on FAST_DECODE and the startup parity check.
+    """
+    target_size = decode_size(version) if FAST_DECODE and version.fast_decode else None
+    return decode_image(data, target_size, max_pixels=MAX_IMAGE_PIXELS)
+
+def preprocess(images, version):
+    """Turn a list of RGB images into a pixel_values batch for `version`"""
+    if version.fast_preprocessor is not None:
+        return version.fast_preprocessor(images)
+    return version.processor(images=images, return_tensors="pt")["pixel_values"]
+
+# Micro-batching configuration
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 8))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 10))
 
-# Transform
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor()
-])
+def classify_images(images, version):
+    """Classify a list of PIL images with one model version.
 
-# Label mapping
-id2label = model.config.id2label
+    Returns a (label, confidence, probabilities, near_duplicate) prediction
+    per image, the probabilities being per label id and near_duplicate the
+    matching indexed image ({"key", "similarity"}) or None.
+    """
+    # Chunks of at most BATCH_MAX_SIZE keep the per-thread preprocessing buffers and
+    # activations the same size for /predict/batch as for batched /predict calls
+    results = []
+    for i in range(0, len(images), BATCH_MAX_SIZE):
+        results.extend(classify_chunk(images[i:i + BATCH_MAX_SIZE], version))
+    return results
+
+def classify_chunk(images, version):
+    """Classify a list of PIL images in one forward pass"""
+    timer = StageTimer(STAGE_SECONDS)
+    with timer.stage("preprocess"):
+        pixel_values = preprocess(images, version)
+
+    with torch.no_grad():
+        with timer.stage("forward"):
+            # In cascade mode only low-confidence images run the full model
+            logits = (version.cascade or version.inference)(pixel_values)
+        with timer.stage("softmax"):
+            probs = F.softmax(logits, dim=1)
+            conf, pred = torch.max(probs, dim=1)
+
+    results = [
+        (version.id2label[p], c, tuple(row), None) for p, c, row in zip(pred.tolist(), conf.tolist(), probs.tolist())
+    ]
+    if version.near_duplicates is not None:
+        with timer.stage("near_duplicate"):
+            results = apply_near_duplicates(results, version)
+    return results
+
+def apply_near_duplicates(results, version):
+    """Give near-duplicates of indexed images the indexed label, and record the match.
+
+    The confidence stays the model's probability for the returned label;
+    the similarity is reported in the separate near_duplicate field.
+    """
+    embeddings = version.embedding_hook.pop()
+    if embeddings is None:
+        return results
+    id2label = version.id2label
+    for i, match in enumerate(version.near_duplicates.match(embeddings)):
+        if match is not None:
+            label, similarity, key = match
+            _, _, probabilities, _ = results[i]
+            if id2label[label] != results[i][0]:
+                version.near_duplicates.count_override()
+                logger.debug("Near-duplicate of %s (%.3f): %s instead of %s", key, similarity, id2label[label], results[i][0])
+            results[i] = (
+                id2label[label], probabilities[label], probabilities, {"key": key, "similarity": round(similarity, 4)}
+            )
+    return results
+
+def classify_requests(items):
+    """Batcher function: (version, image) items, one forward pass per model version in the batch"""
+    results = [None] * len(items)
+    groups = {}
+    for i, (version, image) in enumerate(items):
+        groups.setdefault(id(version), (version, []))[1].append(i)
+    for version, indices in groups.values():
+        for i, result in zip(indices, classify_images([items[i][1] for i in indices], version)):
+            results[i] = result
+    return results
+
+# Concurrent /predict requests share forward passes through the batcher
+batcher = MicroBatcher(classify_requests, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+
+start()
+memory_manager.start()
+
+# Prediction cache: repeated uploads of the same photo skip the forward pass
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+# Perceptual matches answer a different upload with a cached result, so they are opt-in
+PREDICTION_CACHE_PHASH = os.environ.get("PREDICTION_CACHE_PHASH", "0") == "1"
+prediction_cache = PredictionCache(
+    max_entries=PREDICTION_CACHE_SIZE,
+    ttl=float(os.environ.get("PREDICTION_CACHE_TTL", 86400)),
+    path=os.environ.get(
+        "PREDICTION_CACHE_PATH",
+        os.path.join(SCRIPT_DIR, "prediction_cache.db")
+    ),
+    phash_distance=int(os.environ.get("PREDICTION_CACHE_PHASH_DISTANCE", 0)),
+    max_rows=int(os.environ.get("PREDICTION_CACHE_MAX_ROWS", 100000)),
+    prune_interval=float(os.environ.get("PREDICTION_CACHE_PRUNE_INTERVAL", 600))
+) if PREDICTION_CACHE_SIZE > 0 else None
+if prediction_cache is not None:
+    prediction_cache.prune()
+    # Expired rows are also deleted in the background while the service runs
+    prediction_cache.start()
+
+def lookup_prediction(data, timer, version):
+    """Check `version`'s prediction cache entries for an upload before classifying it.
+
+    Returns (cached (label, confidence, probabilities, near_duplicate) or None, cache key,
+    decoded image). The image is only decoded when the raw bytes are not
+    already cached, so an exact hit returns None for it.
+    """
+    digest = None
+    if prediction_cache is not None:
+        with timer.stage("cache_lookup"):
+            digest = content_digest(data)
+            cached = prediction_cache.get(version.version, digest)
+        if cached is not None:
+            return cached, (digest, None, None), None
+
+    with timer.stage("decode"):
+        image = load_image(data, version)
+    phash = None
+    if prediction_cache is not None:
+        if PREDICTION_CACHE_PHASH:
+            # Re-encoded copies of a photo we have already classified, at the same size
+            with timer.stage("cache_lookup"):
+                phash = image_dhash(image)
+                cached = prediction_cache.get_similar(version.version, phash, image.size)
+            if cached is not None:
+                return cached, (digest, phash, image.size), image
+        else:
+            prediction_cache.miss()
+    return None, (digest, phash, image.size), image
+
+def remember_prediction(cache_key, prediction, version):
+    """Store a prediction of `version` under the upload's content hash (and perceptual hash)"""
+    if prediction_cache is not None:
+        prediction_cache.put(version.version, cache_key[0], cache_key[1], *prediction, size=cache_key[2])
 
 # Backend URL configuration
 BACKEND_URL = os.environ.get("BACKEND_URL", "https://trash2treasure-backend.onrender.com/wasteSubmission")
+# Bulk endpoint taking {"submissions": [...]}, if the backend has one; empty posts each submission to BACKEND_URL
+BACKEND_BULK_URL = os.environ.get("BACKEND_BULK_URL") or None
+
+def build_classification_data(result, confidence, filename, version, submission_id=None, near_duplicate=None):
+    """Build the submission record sent to the backend for one image classified by `version`"""
+    data = {
+        "submission_id": submission_id or uuid.uuid4().hex,
+        "prediction": result,
+        "confidence": f"{confidence:.4f}",
+        "timestamp": datetime.now().isoformat(),
+        "image_filename": filename,
+        "model_version": version.version,
+        "device": str(device)
+    }
+    if near_duplicate is not None:
+        data["near_duplicate"] = near_duplicate
+    return data
+
+# Durable outbox: submissions are kept on disk until the backend accepts them (empty path disables it)
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH", os.path.join(SCRIPT_DIR, "outbox.db"))
+outbox = Outbox(
+    OUTBOX_PATH,
+    lease=float(os.environ.get("OUTBOX_LEASE", 120)),
+    retention_hours=float(os.environ.get("OUTBOX_RETENTION_HOURS", 24))
+) if OUTBOX_PATH else None
+
+# Backend submissions are delivered in the background so /predict never waits on the backend
+backend_delivery = BackendDelivery(
+    BACKEND_URL,
+    bulk_url=BACKEND_BULK_URL,
+    workers=int(os.environ.get("BACKEND_WORKERS", 4)),
+    max_queue=int(os.environ.get("BACKEND_QUEUE_SIZE", 10000)),
+    max_retries=int(os.environ.get("BACKEND_MAX_RETRIES", 3)),
+    backoff_base=float(os.environ.get("BACKEND_RETRY_BACKOFF", 0.5)),
+    coalesce_max=int(os.environ.get("BACKEND_COALESCE_MAX", 1)),
+    timeout=float(os.environ.get("BACKEND_TIMEOUT", 10)),
+    outbox=outbox,
+    replay_interval=float(os.environ.get("OUTBOX_REPLAY_INTERVAL", 5)),
+    replay_batch=int(os.environ.get("OUTBOX_REPLAY_BATCH", 100)),
+    on_post=lambda seconds, outcome: BACKEND_POST_SECONDS.observe(seconds, outcome)
+)
+atexit.register(backend_delivery.close)
+
+# Disposal guidance per label, encoded once and embedded as-is in ?details=1 responses
+LABEL_DETAILS = {info["label"]: fast_json.PreSerialized(info) for info in LABEL2INFO.values()}
+
+def response_options(args):
+    """The top_k, details and compact query parameters of a prediction request.
+
+    Raises ValueError for a top_k that is not a non-negative integer.
+    """
+    try:
+        top_k = int(args.get("top_k") or 0)
+    except ValueError:
+        top_k = -1
+    if top_k < 0:
+        raise ValueError("'top_k' must be a non-negative integer")
+
+    def flag(name):
+        return (args.get(name) or "").lower() in ("1", "true", "yes")
+
+    return {"top_k": top_k, "details": flag("details"), "compact": flag("compact")}
+
+def top_labels(prediction, id2label, k):
+    """The k most likely labels with their probabilities"""
+    result, confidence, probabilities, _ = prediction
+    if probabilities is None:
+        # Older cache entries only know the label they gave
+        return [{"label": result, "probability": round(confidence, 4)}]
+    ranked = sorted(range(len(probabilities)), key=probabilities.__getitem__, reverse=True)[:k]
+    return [{"label": id2label[i], "probability": round(probabilities[i], 4)} for i in ranked]
+
+def prediction_fields(prediction, version, options):
+    """Label and confidence of one prediction, its near-duplicate match, plus top-k and disposal details if asked for"""
+    result, confidence, _, near_duplicate = prediction
+    # Compact responses carry the confidence as a number rather than a formatted string
+    fields = {"prediction": result, "confidence": round(confidence, 4) if options["compact"] else f"{confidence:.4f}"}
+    if near_duplicate is not None:
+        fields["near_duplicate"] = near_duplicate
+    if options["top_k"]:
+        fields["top_k"] = top_labels(prediction, version.id2label, options["top_k"])
+    if options["details"]:
+        fields["details"] = LABEL_DETAILS.get(result)
+    return fields
+
+def prediction_body(prediction, cached, version, backend_result, options):
+    """/predict response body, shared with the ASGI app"""
+    fields = prediction_fields(prediction, version, options)
+    if options["compact"]:
+        return {**fields, "model_version": version.version, "backend_status": backend_result["backend_status"]}
+    return {
+        **fields,
+        "success": True,
+        "cached": cached,
+        "model_version": version.version,
+        "message": "Classification successful",
+        "backend_response": backend_result
+    }
+
+def queue_for_backend(submissions, auth_header, bulk=False):
+    """Hand submissions to the delivery pipeline and describe the outcome for the client"""
+    if bulk:
+        status = backend_delivery.submit_bulk(submissions, auth_header)
+    else:
+        status = backend_delivery.submit(submissions[0], auth_header)
+
+    submission_ids = [submission["submission_id"] for submission in submissions]
+    if status == "dropped":
+        logger.error("Backend delivery queue is full, %d submission(s) dropped", len(submissions))
+        return {"backend_status": "error", "message": "Backend delivery queue is full", "submission_ids": submission_ids}
+    return {"backend_status": status, "submission_ids": submission_ids}
+
+# Serving state; the gunicorn hooks in gunicorn.conf.py update it in each worker process
+serving_state = {
+    "mode": "single-process",
+    "ready": True,
+    "shutting_down": False,
+    "torch_threads": torch.get_num_threads()
+}
+
+def on_worker_start(torch_threads):
+    """Called in a freshly forked worker, before it accepts requests"""
+    # The log listener thread stays behind in the master process
+    start_log_listener()
+    memory_manager.start()
+    if prediction_cache is not None:
+        prediction_cache.start()
+    registry.start()
+    torch.set_num_threads(max(1, int(torch_threads)))
+    serving_state.update({
+        "mode": "multi-process",
+        "ready": False,
+        "shutting_down": False,
+        "torch_threads": torch.get_num_threads()
+    })
+
+def on_worker_ready():
+    serving_state["ready"] = True
+
+def on_worker_exit():
+    """Stop taking work and give queued backend submissions a chance to go out"""
+    serving_state.update({"ready": False, "shutting_down": True})
+    backend_delivery.close(timeout=float(os.environ.get("SHUTDOWN_FLUSH_TIMEOUT", 10)))
+
+def record_prediction(result, confidence, source, version):
+    PREDICTIONS.inc(result, source)
+    CONFIDENCE.observe(confidence, result)
+    registry.record(version)
+    MODEL_PREDICTIONS.inc(version.version, "active" if version is registry.active else "candidate")
+
+def run_shadow(shadow, image, result):
+    """Also classify `image` with the shadow model, off the request path, and compare it with `result`"""
+    def compare(future):
+        error = future.exception() is not None
+        registry.record_shadow(shadow, result, None if error else future.result()[0], error=error)
+        if not error:
+            MODEL_PREDICTIONS.inc(shadow.version, "shadow")
+
+    batcher.submit((shadow, image)).add_done_callback(compare)
+
+def error_response(message, status, error_type, headers=None):
+    ERRORS.inc(error_type)
+    return jsonify({"error": message, "success": False}), status, headers or {}
+
+def check_rate_limit(remote_addr, forwarded_for=None, cost=1, consume=True):
+    """Retry-After value if the client has used up its rate limit, else None. Shared with the ASGI app"""
+    if rate_limiter is None:
+        return None
+    key = client_key(remote_addr, forwarded_for if RATE_LIMIT_TRUST_PROXY else None)
+    wait = rate_limiter.check(key, cost, consume)
+    if not wait:
+        return None
+    ADMISSION.inc("rate_limited")
+    return str(max(1, math.ceil(wait)))
+
+def acquire_inference(cost=1):
+    """Take `cost` in-flight slots, or False when the server is full. Shared with the ASGI app"""
+    admitted = inference_limiter.try_acquire(cost)
+    ADMISSION.inc("admitted" if admitted else "overloaded")
+    return admitted
+
+def cors_origin(origin):
+    """Access-Control-Allow-Origin for a request's Origin header, or None if it is not allowed"""
+    if "*" in CORS_ALLOWED_ORIGINS:
+        return "*"
+    return origin if origin in CORS_ALLOWED_ORIGINS else None
+
+def rate_limited(cost=1, consume=True):
+    """429 response if this request's client is over its rate limit, else None"""
+    retry_after = check_rate_limit(request.remote_addr, request.headers.get("X-Forwarded-For"), cost, consume)
+    if retry_after is None:
+        return None
+    return error_response("Rate limit exceeded, retry later", 429, "rate_limited", {"Retry-After": retry_after})
+
+def overloaded(cost=1):
+    """503 response if the server can't take `cost` more images now, else None.
+
+    Admitted requests hold their slots until the request ends.
+    """
+    if not acquire_inference(cost):
+        return error_response("Server is busy, retry shortly", 503, "overloaded", {"Retry-After": OVERLOAD_RETRY_AFTER})
+    g.inference_slots = cost
+    return None
+
+def admin_action(action, payload):
+    """Carry out an /admin/models action; returns (body, status code). Shared with the ASGI app"""
+    # A worker that has not served a prediction yet still follows the change
+    registry.start()
+    try:
+        if action == "load":
+            if not payload.get("source"):
+                return {"error": "'source' (hub model name or checkpoint directory) is required", "success": False}, 400
+            if payload.get("backend") and payload["backend"] not in INFERENCE_BACKENDS:
+                return {"error": f"'backend' must be one of {', '.join(INFERENCE_BACKENDS)}", "success": False}, 400
+            options = {name: payload[name] for name in ("backend", "dedup_index", "early_exit") if payload.get(name)}
+            if payload.get("cascade_threshold") is not None:
+                try:
+                    options["cascade_threshold"] = float(payload["cascade_threshold"])
+                except (TypeError, ValueError):
+                    return {"error": "'cascade_threshold' must be a number", "success": False}, 400
+            key = registry.add(payload["source"], payload.get("revision"), bool(payload.get("activate")), options)
+            return {"success": True, "model": key, "status": "loading", "registry": registry.describe()}, 202
+        if action == "activate":
+            registry.activate(payload.get("model"))
+        elif action == "unload":
+            registry.remove(payload.get("model"))
+        elif action == "traffic":
+            registry.set_traffic(payload.get("model"), payload.get("percent", 0), payload.get("mode", "ab"))
+        elif action != "list":
+            return {"error": f"Unknown action '{action}'", "success": False}, 404
+    except KeyError:
+        return {"error": f"Model '{payload.get('model')}' is not in the registry", "success": False}, 404
+    except (TypeError, ValueError) as e:
+        return {"error": str(e), "success": False}, 400
+    return {"success": True, "registry": registry.describe()}, 200
+
+def admin_authorized(token):
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def model_not_ready():
+    """503 response for prediction requests that arrive before the model is ready"""
+    ERRORS.inc("model_not_ready")
+    response = jsonify({
+        "error": f"Model is not ready yet (status: {startup.status})",
+        "success": False
+    })
+    response.headers["Retry-After"] = "5"
+    return response, 503
+
+class APIRequest(StreamingUploadRequest):
+    # Uploaded files are checked while they stream in and refused ones are not buffered
+    upload_max_bytes = int(MAX_IMAGE_MB * 1024 * 1024) if MAX_IMAGE_MB > 0 else None
+    upload_max_pixels = MAX_IMAGE_PIXELS or None
+    upload_formats = ALLOWED_IMAGE_FORMATS
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify through fast_json: orjson when it is installed, and pre-serialized values embedded as-is"""
+
+    def dumps(self, obj, **kwargs):
+        return fast_json.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return fast_json.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = args[0] if len(args) == 1 else (args or kwargs)
+        return self._app.response_class(fast_json.dumps(obj), mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.request_class = APIRequest
+app.json = FastJSONProvider(app)
+# Werkzeug rejects larger bodies with 413 before reading them
+app.config["MAX_CONTENT_LENGTH"] = int(MAX_UPLOAD_MB * 1024 * 1024) if MAX_UPLOAD_MB > 0 else None
 
 # ROOT ROUTE - Test if server is working
 @app.route("/", methods=["GET"])
@@ -38,117 +752,353 @@ def home():
         "message": "Waste Classification API is running successfully!",
         "server_info": {
             "device": str(device),
-            "model_loaded": model is not None,
+            "model_loaded": startup.ready,
             "backend_url": BACKEND_URL,
             "routes_available": [
                 "GET  / - This route (server status)",
                 "GET  /health - Health check",
-                "POST /predict - Image classification and send to backend"
+                "GET  /metrics - Prometheus metrics",
+                "POST /predict - Image classification and send to backend",
+                "POST /predict/batch - Classify many images ('images' field) in one request"
             ]
         }
     })
 
-# HEALTH CHECK ROUTE
-@app.route("/health", methods=["GET"])
-def health_check():
-    return jsonify({
-        "status": "healthy",
+# METRICS ROUTE - Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def collect_gauges():
+    """Point-in-time values for /metrics, read from the components' own stats"""
+    batching = batcher.stats()
+    delivery = backend_delivery.stats()
+    gauges = {
+        "ready": ("1 if the model is loaded and warmed up", 1 if startup.ready else 0),
+        "batch_queue_depth": ("Requests waiting for the micro-batcher", batching["queue_depth"]),
+        "batch_size_avg": ("Average recent batch size", batching["avg_batch_size"]),
+        "batch_queue_wait_p99_seconds": ("p99 micro-batcher queue wait", batching["queue_wait_ms"]["p99"] / 1000.0),
+        "backend_queue_depth": ("Submissions waiting for delivery", delivery["queue_depth"]),
+        "backend_in_flight": ("Backend POSTs in flight", delivery["in_flight"]),
+        "backend_delivered": ("Submissions delivered since start", delivery["delivered"]),
+        "backend_failed": ("Submissions that ran out of retries since start", delivery["failed"]),
+    }
+    memory = memory_manager.stats()
+    gauges["rss_bytes"] = ("Resident set size of this process", (memory["rss_mb"] or 0) * 1048576)
+    gauges["rss_high_water_bytes"] = ("Highest RSS sampled since start", memory["rss_high_water_mb"] * 1048576)
+    gauges["gc_collections"] = ("Background garbage collections since start", memory["collections"])
+    if outbox is not None:
+        gauges["outbox_pending"] = ("Submissions pending in the outbox", outbox.stats()["pending"])
+    if prediction_cache is not None:
+        cache = prediction_cache.stats()
+        gauges["cache_entries"] = ("Predictions held in memory", cache["size"])
+        gauges["cache_hits"] = ("Cache hits (exact and perceptual) since start", cache["hits"] + cache["perceptual_hits"])
+        gauges["cache_misses"] = ("Cache misses since start", cache["misses"])
+        gauges["cache_evictions"] = ("Cache evictions since start", cache["evictions"])
+    gauges["inference_in_flight"] = ("Images being decoded or classified in this process", inference_limiter.stats()["in_flight"])
+    gauges["models_resident"] = ("Model versions loaded in this process", len(registry.versions))
+    gauges["models_resident_bytes"] = ("Approximate memory held by resident model weights", registry.resident_bytes())
+    gauges["model_swaps"] = ("Active model swaps since start", registry.swaps)
+    active = registry.active
+    if active is not None and active.near_duplicates is not None:
+        dedup = active.near_duplicates.stats()
+        gauges["near_duplicate_matches"] = ("Predictions answered from the near-duplicate index", dedup["matches"])
+        gauges["near_duplicate_overrides"] = ("Near-duplicate answers that changed the model's label", dedup["overrides"])
+    if active is not None and active.cascade is not None:
+        cascade = active.cascade.stats()
+        gauges["cascade_images"] = ("Images classified in cascade mode since start", cascade["images"])
+        gauges["cascade_escalated"] = ("Cascade images escalated to the full model since start", cascade["escalated"])
+        gauges["cascade_saved_seconds"] = ("Estimated forward time saved by early exits since start", cascade["estimated_saved_ms"] / 1000.0)
+    return gauges
+
+metrics.add_gauges(collect_gauges)
+
+# Per-request timing, metrics and sampled profiling
+@app.before_request
+def start_request_timer():
+    g.timer = StageTimer(STAGE_SECONDS)
+    g.profile = profiler.start()
+
+def finish_request_timer(response):
+    timer = getattr(g, "timer", None)
+    if timer is None:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    seconds = timer.elapsed()
+    REQUESTS.inc(route, str(response.status_code))
+    REQUEST_SECONDS.observe(seconds, route)
+    profiler.finish(getattr(g, "profile", None), seconds, route)
+    if route.startswith("/predict"):
+        logger.info(
+            "%s %s status=%d total_ms=%.1f stages=%s",
+            request.method, route, response.status_code, seconds * 1000.0, timer.as_ms()
+        )
+
+def health_report():
+    """/health body and status code, shared with the ASGI app"""
+    # Load balancers should only route to workers that report ready
+    if serving_state["shutting_down"]:
+        status = "shutting_down"
+    elif not startup.ready:
+        status = startup.status
+    elif serving_state["ready"]:
+        status = "ready"
+    else:
+        status = "starting"
+    active = registry.active
+    return {
+        "status": status,
         "device": str(device),
-        "model_loaded": model is not None,
+        "model_loaded": startup.ready,
         "backend_url": BACKEND_URL,
         "message": "Server is running successfully",
-        "version": "2.0"
-    })
+        "version": "2.0",
+        "startup": startup.describe(),
+        "model_version": active.version if active is not None else None,
+        "inference_backend": active.inference.describe() if active is not None else None,
+        "fast_decode": FAST_DECODE and active is not None and active.fast_decode,
+        "fast_preprocess": active is not None and active.fast_preprocessor is not None,
+        "json_encoder": fast_json.backend(),
+        "models": registry.describe(),
+        "batching": batcher.stats(),
+        "backend_delivery": backend_delivery.stats(),
+        "outbox": outbox.stats() if outbox is not None else None,
+        "prediction_cache": prediction_cache.stats() if prediction_cache is not None else None,
+        "near_duplicates": active.near_duplicates.stats() if active is not None and active.near_duplicates is not None else None,
+        "cascade": active.cascade.stats() if active is not None and active.cascade is not None else None,
+        "memory": memory_manager.stats(),
+        "admission": {
+            "rate_limit": rate_limiter.stats() if rate_limiter is not None else None,
+            "concurrency": inference_limiter.stats()
+        },
+        "limits": {
+            "max_upload_mb": MAX_UPLOAD_MB,
+            "max_image_mb": MAX_IMAGE_MB,
+            "max_image_pixels": MAX_IMAGE_PIXELS,
+            "image_formats": list(ALLOWED_IMAGE_FORMATS)
+        },
+        "worker": {**serving_state, "pid": os.getpid()}
+    }, 200 if status == "ready" else 503
+
+# HEALTH CHECK ROUTE
+@app.route("/health", methods=["GET"])
+def health_check():
+    report, status_code = health_report()
+    return jsonify(report), status_code
 
 # PREDICTION ROUTE - Classify image and send to backend
 @app.route("/predict", methods=["POST"])
 def predict_image():
-    print("Received request to /predict")
+    logger.debug("Received request to /predict")
     
-    if "image" not in request.files:
-        print("No image in request")
-        return jsonify({"error": "No image uploaded", "success": False}), 400
+    if not startup.ready:
+        return model_not_ready()
+
+    # Refused before the upload is read
+    rejected = rate_limited()
+    if rejected is not None:
+        return rejected
 
-    file = request.files["image"]
-    print(f"Received image: {file.filename}")
+    timer = g.timer
+    with timer.stage("upload"):
+        file = request.files.get("image")
+
+    if file is None:
+        logger.info("No image in request")
+        return error_response("No image uploaded", 400, "no_image")
+
+    logger.debug("Received image: %s", file.filename)
 
     try:
-        image = Image.open(file).convert("RGB")
-        print(f"Image loaded: {image.size}")
-        
-        inputs = processor(images=image, return_tensors="pt").to(device)
-        
-        with torch.no_grad():
-            outputs = model(**inputs)
-            logits = outputs.logits
-            probs = F.softmax(logits, dim=1)
-            conf, pred = torch.max(probs, dim=1)
-        
-        result = id2label[pred.item()]
-        confidence = conf.item()
+        options = response_options(request.args)
+    except ValueError as e:
+        return error_response(str(e), 400, "invalid_option")
+
+    rejected = overloaded()
+    if rejected is not None:
+        return rejected
+
+    try:
+        # The same user token always lands on the same side of an A/B split
+        version, shadow = registry.route(request.headers.get("Authorization"))
+        cached, cache_key, image = lookup_prediction(read_upload(file), timer, version)
+        if cached is not None:
+            prediction = cached
+            logger.debug("Prediction served from cache")
+        else:
+            logger.debug("Image loaded: %s", image.size)
+            with timer.stage("inference"):
+                prediction = batcher.predict((version, image))
+            if shadow is not None:
+                run_shadow(shadow, image, prediction[0])
+
+        if image is not None:
+            remember_prediction(cache_key, prediction, version)
+        result, confidence, _, near_duplicate = prediction
+        record_prediction(result, confidence, "cache" if cached is not None else "model", version)
         
-        print(f"Prediction: {result}, Confidence: {confidence:.4f}")
+        logger.debug("Prediction: %s, Confidence: %.4f", result, confidence)
         
         # Prepare data to send to backend
-        classification_data = {
-            "prediction": result,
-            "confidence": f"{confidence:.4f}",
-            "timestamp": datetime.now().isoformat(),
-            "image_filename": file.filename,
-            "model_version": "Claudineuwa/waste_classifier_Isaac",
-            "device": str(device)
-        }
+        # Clients may send X-Submission-Id so a retried upload is not submitted twice
+        classification_data = build_classification_data(
+            result, confidence, file.filename, version,
+            submission_id=request.headers.get("X-Submission-Id"), near_duplicate=near_duplicate
+        )
         
         # Send data to backend
+        auth_header = request.headers.get('Authorization')
+        if not auth_header:
+            return error_response("Missing Authorization header", 401, "unauthorized")
+
+        with timer.stage("backend_enqueue"):
+            backend_result = queue_for_backend([classification_data], auth_header)
+        
+        return jsonify(prediction_body(prediction, cached is not None, version, backend_result, options))
+
+    except UploadRejected as e:
+        return error_response(str(e), e.status, e.reason)
+
+    except ImageTooLarge as e:
+        return error_response(str(e), 413, "image_too_large")
+
+    except Exception as e:
+        logger.exception("Error in prediction: %s", e)
+        return error_response(f"Classification failed: {str(e)}", 500, type(e).__name__)
+
+# BATCH PREDICTION ROUTE - Classify many images from one upload
+@app.route("/predict/batch", methods=["POST"])
+def predict_batch():
+    if not startup.ready:
+        return model_not_ready()
+
+    # Checked before the body is parsed, so a client over its limit can't make us read a tray,
+    # but only charged once the images are counted and the batch is accepted
+    rejected = rate_limited(consume=False)
+    if rejected is not None:
+        return rejected
+
+    timer = g.timer
+    with timer.stage("upload"):
+        files = request.files.getlist("images")
+    logger.debug("Received request to /predict/batch with %d images", len(files))
+
+    if not files:
+        return error_response("No images uploaded (use the 'images' field)", 400, "no_image")
+
+    if len(files) > BATCH_MAX_IMAGES:
+        return error_response(f"Too many images: {len(files)} (maximum {BATCH_MAX_IMAGES})", 413, "too_many_images")
+
+    try:
+        options = response_options(request.args)
+    except ValueError as e:
+        return error_response(str(e), 400, "invalid_option")
+
+    # A batch counts as one request per image; the burst always covers BATCH_MAX_IMAGES
+    rejected = rate_limited(len(files)) or overloaded(len(files))
+    if rejected is not None:
+        return rejected
+
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return error_response("Missing Authorization header", 401, "unauthorized")
+
+    version, _ = registry.route(auth_header)
+
+    # Decode every image first; unreadable ones are reported in place
+    results = [None] * len(files)
+    predictions = {}
+    images = []
+    pending = []
+    for index, file in enumerate(files):
         try:
-            auth_header = request.headers.get('Authorization')
-            if not auth_header:
-                return jsonify({"error": "Missing Authorization header", "success": False}), 401
-
-            backend_response = requests.post(
-                f"{BACKEND_URL}",
-                json=classification_data,
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": auth_header
-                },
-                timeout=10
-            )
-            
-            if backend_response.status_code == 200:
-                print("Data successfully sent to backend")
-                backend_result = backend_response.json()
+            cached, cache_key, image = lookup_prediction(read_upload(file), timer, version)
+        except Exception as e:
+            logger.info("Could not read image %s: %s", file.filename, e)
+            if isinstance(e, UploadRejected):
+                ERRORS.inc(e.reason)
             else:
-                print(f"Backend returned status {backend_response.status_code}")
-                backend_result = {"backend_status": "error", "message": "Failed to send to backend"}
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending to backend: {str(e)}")
-            backend_result = {"backend_status": "error", "message": f"Backend connection failed: {str(e)}"}
-        
+                ERRORS.inc("image_too_large" if isinstance(e, ImageTooLarge) else "unreadable_image")
+            error = f"Could not read image: {str(e)}"
+            if options["compact"]:
+                results[index] = {"error": error}
+            else:
+                results[index] = {"index": index, "image_filename": file.filename, "success": False, "error": error}
+            continue
+
+        if cached is not None:
+            predictions[index] = (cached, True)
+            if image is not None:
+                remember_prediction(cache_key, cached, version)
+        else:
+            images.append(image)
+            pending.append((index, cache_key))
+
+    if images:
+        try:
+            with timer.stage("inference"):
+                classified = classify_images(images, version)
+        except Exception as e:
+            logger.exception("Error in batch prediction: %s", e)
+            return error_response(f"Classification failed: {str(e)}", 500, type(e).__name__)
+
+        for (index, cache_key), prediction in zip(pending, classified):
+            remember_prediction(cache_key, prediction, version)
+            predictions[index] = (prediction, False)
+
+    backend_result = None
+    if predictions:
+        submissions = []
+        for index in sorted(predictions):
+            prediction, was_cached = predictions[index]
+            result, confidence, _, near_duplicate = prediction
+            record_prediction(result, confidence, "cache" if was_cached else "model", version)
+            filename = files[index].filename
+            submissions.append(build_classification_data(result, confidence, filename, version, near_duplicate=near_duplicate))
+            fields = prediction_fields(prediction, version, options)
+            if options["compact"]:
+                results[index] = fields
+            else:
+                results[index] = {"index": index, "image_filename": filename, **fields, "cached": was_cached, "success": True}
+
+        # One bulk call for the whole tray when BACKEND_BULK_URL is set, else one post per image
+        with timer.stage("backend_enqueue"):
+            backend_result = queue_for_backend(submissions, auth_header, bulk=True)
+
+    if options["compact"]:
         return jsonify({
-            "prediction": result,
-            "confidence": f"{confidence:.4f}",
-            "success": True,
-            "message": "Classification successful",
-            "backend_response": backend_result
+            "model_version": version.version,
+            "results": results,
+            "backend_status": backend_result["backend_status"] if backend_result else None
         })
+    return jsonify({
+        "success": bool(predictions),
+        "message": f"Classified {len(predictions)} of {len(files)} images",
+        "model_version": version.version,
+        "results": results,
+        "backend_response": backend_result
+    })
 
-    except Exception as e:
-        print(f"Error in prediction: {str(e)}")
-        return jsonify({
-            "error": f"Classification failed: {str(e)}", 
-            "success": False
-        }), 500
-
-    finally:
-        # Clean up memory
-        for var in ['inputs', 'outputs', 'probs', 'conf', 'pred', 'image']:
-            if var in locals():
-                del locals()[var]
-        gc.collect()
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+# ADMIN ROUTES - Model registry, guarded by ADMIN_TOKEN (X-Admin-Token header)
+@app.route("/admin/models", methods=["GET"])
+def admin_models():
+    return admin_response("list")
+
+@app.route("/admin/models/<action>", methods=["POST"])
+def admin_models_action(action):
+    return admin_response(action)
+
+def admin_response(action):
+    if not ADMIN_TOKEN:
+        return error_response("Admin API is disabled (set ADMIN_TOKEN)", 404, "admin_disabled")
+    if not admin_authorized(request.headers.get("X-Admin-Token")):
+        return error_response("Invalid admin token", 403, "admin_forbidden")
+    payload = request.get_json(silent=True)
+    payload = payload if isinstance(payload, dict) else {}
+    body, status = admin_action(action, payload)
+    if status < 400:
+        logger.info("Admin %s: %s", action, payload)
+    return jsonify(body), status
 
 # ERROR HANDLERS
 @app.errorhandler(404)
@@ -158,10 +1108,20 @@ def not_found(error):
         "available_routes": [
             "GET  /",
             "GET  /health", 
-            "POST /predict"
+            "GET  /metrics",
+            "POST /predict",
+            "POST /predict/batch"
         ]
     }), 404
 
+@app.errorhandler(413)
+def payload_too_large(error):
+    ERRORS.inc("upload_too_large")
+    return jsonify({
+        "error": f"Upload too large (maximum {MAX_UPLOAD_MB:g} MB)",
+        "success": False
+    }), 413
+
 @app.errorhandler(405)
 def method_not_allowed(error):
     return jsonify({
@@ -169,10 +1129,21 @@ def method_not_allowed(error):
         "message": "Check the HTTP method (GET/POST) for this route"
     }), 405
 
+@app.teardown_request
+def release_inference_slots(error=None):
+    slots = g.pop("inference_slots", 0)
+    if slots:
+        inference_limiter.release(slots)
+
 # Handle CORS for React Native (if needed)
 @app.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
+    finish_request_timer(response)
+    origin = cors_origin(request.headers.get("Origin"))
+    if origin is not None:
+        response.headers.add('Access-Control-Allow-Origin', origin)
+    if origin != "*":
+        response.headers.add('Vary', 'Origin')
     response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
     response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
     return response
@@ -180,19 +1151,18 @@ def after_request(response):
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     
-    print("=" * 50)
-    print(" Starting Waste Classification API")
-    print("=" * 50)
-    print(f"Server URL: http://0.0.0.0:{port}")
-    print(f"External URL: http://192.168.0.109:{port}")
-    print(f"Backend URL: {BACKEND_URL}")
-    print(f"Device: {device}")
-    print(f"Model loaded: {model is not None}")
-    print("\nAvailable Routes:")
-    print(f"• GET  http://192.168.0.109:{port}/")
-    print(f"• GET  http://192.168.0.109:{port}/health")
-    print(f"• POST http://192.168.0.109:{port}/predict")
-    print("\nReady to classify images and send data to backend!")
-    print("=" * 50)
+    logger.info("Starting Waste Classification API")
+    logger.info("Server URL: http://0.0.0.0:%d", port)
+    logger.info("External URL: http://192.168.0.109:%d", port)
+    logger.info("Backend URL: %s", BACKEND_URL)
+    logger.info("Device: %s", device)
+    logger.info("Inference backend: %s", INFERENCE_BACKEND)
+    logger.info("Model loaded: %s (%s)", startup.ready, startup.status)
+    logger.info(
+        "Routes: GET /, GET /health, GET /metrics, POST /predict, POST /predict/batch on http://192.168.0.109:%d",
+        port
+    )
     
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    # Development server only; use `gunicorn -c gunicorn.conf.py waste_classification_api:app` in production
+    debug = os.environ.get("FLASK_DEBUG", "0") == "1"
+    app.run(host="0.0.0.0", port=port, debug=debug, use_reloader=debug, threaded=True)
\ No newline at end of file